@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+
+"""
+Benchmark of the association of stations to volcanoes of tonus-db-populate.
+
+Compares the previous association (inventory.select around each volcano
+and gps2dist_azimuth for each station found) with
+tonus.database.inventory_rows (one haversine distance matrix) on a
+synthetic inventory, and checks that both find the same stations for the
+same volcanoes.
+"""
+
+
+# Python Standard Library
+import argparse
+import time
+
+# Other dependencies
+import numpy as np
+
+from obspy import UTCDateTime
+from obspy.core.inventory import Channel, Inventory, Network, Station
+from obspy.geodetics.base import gps2dist_azimuth, kilometers2degrees
+from tonus.database import inventory_rows
+
+# Local files
+
+
+__author__ = 'Leonardo van der Laat'
+__email__ = 'lvmzxc@gmail.com'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--volcanoes', default=2000, type=int)
+    parser.add_argument('--stations', default=20000, type=int)
+    parser.add_argument('--maxradius', default=20, type=float, help='km')
+    parser.add_argument(
+        '--reference', default=100, type=int,
+        help='Volcanoes associated with the previous method (extrapolated)'
+    )
+    return parser.parse_args()
+
+
+def synthetic(n_volcanoes, n_stations, seed=0):
+    """
+    Volcanoes and stations in a 20x20 degrees region, stations clustered
+    around the volcanoes.
+    """
+    rng = np.random.default_rng(seed)
+    volcanoes = [
+        (f'V{i}', lat, lon)
+        for i, (lat, lon) in enumerate(rng.uniform(0, 20, (n_volcanoes, 2)))
+    ]
+    centers = rng.integers(0, n_volcanoes, n_stations)
+    coordinates = (
+        np.array([v[1:] for v in volcanoes])[centers] +
+        rng.normal(0, 0.15, (n_stations, 2))
+    )
+    start_date = UTCDateTime(2010, 1, 1)
+    stations = [
+        Station(
+            f'S{i}', lat, lon, 1000, start_date=start_date,
+            channels=[
+                Channel('HHZ', '', lat, lon, 1000, 0, start_date=start_date,
+                        sample_rate=100)
+            ]
+        )
+        for i, (lat, lon) in enumerate(coordinates)
+    ]
+    return volcanoes, Inventory(networks=[Network('XX', stations=stations)])
+
+
+def previous(inventory, volcanoes, maxradius):
+    stations = {}
+    for volcano, latitude, longitude in volcanoes:
+        _inventory = inventory.select(
+            latitude=latitude, longitude=longitude,
+            maxradius=kilometers2degrees(maxradius)
+        )
+        for network in _inventory:
+            for station in network:
+                key = (station.code, station.latitude, station.longitude)
+                if key in stations:
+                    continue
+                distance = int(gps2dist_azimuth(
+                    latitude, longitude, station.latitude, station.longitude
+                )[0])
+                stations[key] = (volcano, distance)
+    return stations
+
+
+def main():
+    args = parse_args()
+
+    volcanoes, inventory = synthetic(args.volcanoes, args.stations)
+
+    t0 = time.time()
+    reference = previous(inventory, volcanoes[:args.reference], args.maxradius)
+    t_previous = (time.time() - t0)*args.volcanoes/args.reference
+
+    t0 = time.time()
+    stations, channels = inventory_rows(inventory, volcanoes, args.maxradius)
+    t_matrix = time.time() - t0
+
+    _stations, _ = inventory_rows(
+        inventory, volcanoes[:args.reference], args.maxradius
+    )
+    equal = {
+        key: (row[7], row[8]) for key, row in _stations.items()
+    } == reference
+
+    print(f'{args.volcanoes} volcanoes, {args.stations} stations')
+    print(f'inventory.select: {t_previous:.1f} s (extrapolated)')
+    print(f'distance matrix:  {t_matrix:.1f} s, {len(stations)} stations')
+    print(f'same association: {equal}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+
+"""
+Benchmark of the tonality (CFT) kernels on a 24 h, 100 Hz synthetic trace.
+
+Compares the reference per-frame argsort kernel (_get_cft) against the
+vectorized top-k kernel (_get_cft_topk) used by get_cft, on the same
+spectra, and checks that both outputs agree.
+"""
+
+
+# Python Standard Library
+import argparse
+import time
+
+# Other dependencies
+import numpy as np
+
+from obspy import Trace, UTCDateTime
+from scipy.fft import rfft
+from scipy.signal.windows import tukey
+from tonus.detection.obspy2numpy import st2windowed_data
+from tonus.detection.process import _get_cft, _get_cft_topk
+
+# Local files
+
+
+__author__ = 'Leonardo van der Laat'
+__email__ = 'lvmzxc@gmail.com'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--hours', default=24, type=float, help='Duration')
+    parser.add_argument('--sampling_rate', default=100, type=float)
+    parser.add_argument('--short_win', default=10, type=float)
+    parser.add_argument('--overlap', default=0.9, type=float)
+    parser.add_argument('--pad', default=0.1, type=float)
+    parser.add_argument('--k', default=3, type=int)
+    parser.add_argument('--bin_width', default=1, type=float)
+    return parser.parse_args()
+
+
+def synthetic_trace(hours, sampling_rate, seed=0):
+    """
+    Noise with tonal episodes (fundamental and overtones) every 10 minutes.
+    """
+    rng = np.random.default_rng(seed)
+    npts = int(hours * 3600 * sampling_rate)
+    t = np.arange(npts) / sampling_rate
+    data = rng.normal(size=npts)
+    for t0 in np.arange(0, t[-1], 600):
+        idx = (t >= t0) & (t < t0 + 60)
+        f1 = rng.uniform(1, 5)
+        for n in range(1, 4):
+            data[idx] += 3/n * np.sin(2*np.pi*n*f1*t[idx])
+    return Trace(
+        data=data,
+        header=dict(sampling_rate=sampling_rate, starttime=UTCDateTime(0))
+    )
+
+
+def spectra(tr, short_win, overlap, pad, bin_width):
+    utcdatetimes, data_windowed = st2windowed_data(tr, short_win, overlap)
+    data_windowed = data_windowed[0].astype(float)
+    data_windowed *= tukey(data_windowed.shape[1], alpha=pad)
+    freq = np.fft.rfftfreq(data_windowed.shape[1], tr.stats.delta)
+    nyquist = tr.stats.sampling_rate/2
+    _bin_width = int(bin_width*len(freq)/nyquist)
+    return np.abs(rfft(data_windowed)), _bin_width
+
+
+def timeit(func, *args):
+    t0 = time.perf_counter()
+    out = func(*args)
+    return out, time.perf_counter() - t0
+
+
+def main():
+    args = parse_args()
+
+    tr = synthetic_trace(args.hours, args.sampling_rate)
+    Sxx, _bin_width = spectra(
+        tr, args.short_win, args.overlap, args.pad, args.bin_width
+    )
+    print(f'Frames: {Sxx.shape[0]}, bins: {Sxx.shape[1]}, '
+          f'bin width: {_bin_width} samples, k: {args.k}')
+
+    # Compile the numba kernel before timing
+    _get_cft(Sxx[:2], args.k, _bin_width)
+
+    ref, t_ref = timeit(_get_cft, Sxx, args.k, _bin_width)
+    new, t_new = timeit(_get_cft_topk, Sxx, args.k, _bin_width)
+
+    rel = np.nanmax(np.abs(new - ref) / np.abs(ref))
+    print(f'argsort kernel: {t_ref:8.3f} s')
+    print(f'top-k kernel:   {t_new:8.3f} s')
+    print(f'speed-up:       {t_ref/t_new:8.1f}x')
+    print(f'max rel. diff:  {rel:.2e}')
+    return
+
+
+if __name__ == '__main__':
+    main()
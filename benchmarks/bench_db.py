@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+
+
+"""
+Benchmark of the queries of the database before and after the migrations.
+
+Creates a scratch database in a local PostgreSQL server (dropped first if
+it exists), with the schema of bin/schema.sql and a synthetic multi-year
+catalog of events, codas, coda peaks and tremor, generated by the server.
+Runs the access paths of tonus.gui.queries, check_event and the batch
+scripts, applies the migrations of bin/migrations (tonus-db migrate) and
+runs them again, reporting the latencies and the scans of the query plans.
+With --interval, the tables are then partitioned (tonus-db partition) and
+the queries, and their time-bounded versions, run once more.
+"""
+
+
+# Python Standard Library
+import argparse
+import os
+import re
+import statistics
+import time
+
+from collections import Counter
+
+# Other dependencies
+import psycopg2
+
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from tonus.database import PARTITION_INTERVALS, migrate, partition_tables
+
+# Local files
+
+
+__author__ = 'Leonardo van der Laat'
+__email__ = 'lvmzxc@gmail.com'
+
+
+BIN_DIRPATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bin'
+)
+
+# Synthetic catalog, events in time order (as inserted by the batch scripts)
+POPULATE = """
+INSERT INTO volcano(volcano, latitude, longitude)
+SELECT 'V' || v, 10 + v*0.1, -84 - v*0.1
+FROM generate_series(1, %(volcanoes)s) AS v;
+
+INSERT INTO station(network, station, latitude, longitude, volcano_id,
+                    distance, volcano)
+SELECT 'XX', 'S' || s, 10, -84, v.id, 1000, v.volcano
+FROM volcano AS v, generate_series(1, %(stations)s) AS s;
+
+INSERT INTO channel(network, station, location, channel, volcano,
+                    sample_rate, station_id)
+SELECT 'XX', s.station, '', c, s.volcano, 100, s.id
+FROM station AS s, unnest(ARRAY['HHZ', 'HHN', 'HHE']) AS c;
+
+INSERT INTO event(starttime, endtime, volcano_id)
+SELECT t, t + interval '2 minutes', volcano_id
+FROM (
+    SELECT
+        timestamp '2015-01-01' + random()*(%(years)s*interval '365 days')
+        AS t,
+        v.id AS volcano_id
+    FROM volcano AS v, generate_series(1, %(events)s) AS e
+) AS e
+ORDER BY t;
+
+INSERT INTO coda(channel_id, t1, t2, t3, event_id, q_alpha)
+SELECT
+    c.id, e.starttime, e.starttime + interval '10 s',
+    e.starttime + interval '60 s', e.id, random()*100
+FROM event AS e
+INNER JOIN volcano AS v ON e.volcano_id = v.id
+INNER JOIN channel AS c ON c.volcano = v.volcano
+WHERE random() < %(fraction)s
+ORDER BY e.id;
+
+INSERT INTO coda_peaks(frequency, amplitude, q_f, coda_id)
+SELECT p*1.5, random(), random()*500, coda.id
+FROM coda, generate_series(1, %(peaks)s) AS p
+ORDER BY coda.id;
+
+INSERT INTO tremor(event_id, channel_id, starttime, endtime, fmin, fmax,
+                   fmean, n_harmonics, amplitude, lp)
+SELECT
+    e.id, c.id, e.starttime, e.endtime, 1, 10, 3, 3, random(), false
+FROM event AS e
+INNER JOIN volcano AS v ON e.volcano_id = v.id
+INNER JOIN channel AS c ON c.volcano = v.volcano
+WHERE random() < %(fraction)s / 4
+ORDER BY e.id;
+"""
+
+QUERIES = {
+    'volcanoes with codas': """
+        SELECT volcano FROM volcano
+        WHERE id IN (
+            SELECT DISTINCT volcano_id FROM event
+            WHERE EXISTS (
+                SELECT 1 FROM coda WHERE coda.event_id = event.id LIMIT 1
+            )
+        );
+    """,
+    'channels with codas': """
+        SELECT channel.station, channel.channel, channel.id
+        FROM channel
+        INNER JOIN station ON channel.station_id = station.id
+        INNER JOIN volcano ON station.volcano_id = volcano.id
+        WHERE volcano.volcano = %(volcano)s
+        AND EXISTS (
+            SELECT 1 FROM coda WHERE coda.channel_id = channel.id LIMIT 1
+        );
+    """,
+    'coda peaks of a channel': """
+        SELECT
+            coda.t1, coda.t2, coda.t3, coda.channel_id, coda.event_id,
+            coda_peaks.frequency, coda_peaks.q_f, coda_peaks.amplitude,
+            channel.station, channel.channel
+        FROM coda_peaks
+        INNER JOIN coda ON coda_peaks.coda_id = coda.id
+        INNER JOIN channel ON coda.channel_id = channel.id
+        WHERE coda.channel_id IN %(channel_ids)s;
+    """,
+    'events of a channel': """
+        SELECT event.starttime, event.id, coda.channel_id
+        FROM event
+        INNER JOIN coda ON coda.event_id = event.id
+        WHERE coda.channel_id IN %(channel_ids)s;
+    """,
+    'tremor of a channel': """
+        SELECT
+            tremor.starttime, tremor.endtime, tremor.lp, tremor.fmean,
+            tremor.channel_id, channel.station, channel.channel
+        FROM tremor
+        INNER JOIN channel ON tremor.channel_id = channel.id
+        WHERE tremor.channel_id IN %(channel_ids)s;
+    """,
+    'check_event': """
+        SELECT event.* FROM event
+        INNER JOIN volcano ON event.volcano_id = volcano.id
+        AND volcano.volcano = %(volcano)s
+        AND starttime BETWEEN %(starttime)s AND %(endtime)s;
+    """,
+    'codas of an event': """
+        SELECT * FROM coda WHERE event_id = %(event_id)s;
+    """,
+    'events of a window': """
+        SELECT id FROM event
+        WHERE volcano_id = %(volcano_id)s
+        AND starttime = %(starttime)s AND endtime = %(endtime)s
+        ORDER BY id LIMIT 1;
+    """,
+    'tremor done': """
+        SELECT event_id, channel_id FROM tremor
+        WHERE event_id = ANY(%(event_ids)s);
+    """,
+    'events of a month': """
+        SELECT count(*) FROM event
+        WHERE starttime BETWEEN %(starttime)s AND %(starttime)s
+        + interval '30 days';
+    """,
+}
+
+# Time-bounded access paths, after 0002_event_starttime
+TIME_QUERIES = {
+    'coda peaks of a channel in a month': """
+        SELECT
+            coda.t1, coda.t2, coda.t3, coda.channel_id, coda.event_id,
+            coda_peaks.frequency, coda_peaks.q_f, coda_peaks.amplitude,
+            channel.station, channel.channel
+        FROM coda_peaks
+        INNER JOIN coda ON coda_peaks.coda_id = coda.id
+        INNER JOIN channel ON coda.channel_id = channel.id
+        WHERE coda.channel_id IN %(channel_ids)s
+        AND coda.event_starttime >= %(month)s
+        AND coda.event_starttime < %(month)s + interval '1 month'
+        AND coda_peaks.event_starttime >= %(month)s
+        AND coda_peaks.event_starttime < %(month)s + interval '1 month';
+    """,
+    'events of a channel in a month': """
+        SELECT event.starttime, event.id, coda.channel_id
+        FROM event
+        INNER JOIN coda ON coda.event_id = event.id
+        WHERE coda.channel_id IN %(channel_ids)s
+        AND coda.event_starttime >= %(month)s
+        AND coda.event_starttime < %(month)s + interval '1 month'
+        AND event.starttime >= %(month)s
+        AND event.starttime < %(month)s + interval '1 month';
+    """,
+    'tremor of a channel in a month': """
+        SELECT
+            tremor.starttime, tremor.endtime, tremor.lp, tremor.fmean,
+            tremor.channel_id, channel.station, channel.channel
+        FROM tremor
+        INNER JOIN channel ON tremor.channel_id = channel.id
+        WHERE tremor.channel_id IN %(channel_ids)s
+        AND tremor.event_starttime >= %(month)s
+        AND tremor.event_starttime < %(month)s + interval '1 month';
+    """,
+}
+
+# Suffix of the partitions in the names of the tables and indexes
+PARTITION_SUFFIX = re.compile(r'_\d{4}(_\d{2})?(?=_|$)')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--user', default='postgres')
+    parser.add_argument('--password', default='')
+    parser.add_argument(
+        '--database', default='tonus_bench',
+        help='Scratch database, dropped and created again'
+    )
+    parser.add_argument('--volcanoes', default=10, type=int)
+    parser.add_argument(
+        '--stations', default=5, type=int, help='Per volcano'
+    )
+    parser.add_argument('--years', default=5, type=int)
+    parser.add_argument(
+        '--events', default=10000, type=int, help='Per volcano'
+    )
+    parser.add_argument(
+        '--fraction', default=0.3, type=float,
+        help='Fraction of the channels with a coda in each event'
+    )
+    parser.add_argument(
+        '--peaks', default=4, type=int, help='Peaks per coda'
+    )
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument(
+        '--interval', choices=PARTITION_INTERVALS,
+        help='Partition the tables after the migrations'
+    )
+    return parser.parse_args()
+
+
+def create_database(args):
+    db = dict(host=args.host, user=args.user, password=args.password)
+    conn = psycopg2.connect(database='postgres', **db)
+    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    cur = conn.cursor()
+    cur.execute(f'DROP DATABASE IF EXISTS {args.database};')
+    cur.execute(f'CREATE DATABASE {args.database};')
+    conn.close()
+
+    conn = psycopg2.connect(database=args.database, **db)
+    with open(os.path.join(BIN_DIRPATH, 'schema.sql'), 'r') as f:
+        schema = f.read()
+    with conn:
+        conn.cursor().execute(schema)
+    return conn
+
+
+def populate(args, conn):
+    with conn:
+        cur = conn.cursor()
+        cur.execute(POPULATE, vars(args))
+    analyze(conn)
+
+    cur = conn.cursor()
+    for table in 'event coda coda_peaks tremor'.split():
+        cur.execute(f'SELECT count(*) FROM {table};')
+        print(f'{table}: {cur.fetchone()[0]} rows')
+    conn.commit()
+
+
+def analyze(conn):
+    conn.autocommit = True
+    conn.cursor().execute('VACUUM ANALYZE;')
+    conn.autocommit = False
+
+
+def parameters(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM volcano WHERE volcano = 'V1';")
+    volcano_id = cur.fetchone()[0]
+    cur.execute(
+        'SELECT id FROM channel WHERE volcano = %s ORDER BY id LIMIT 1;',
+        ('V1',)
+    )
+    channel_ids = cur.fetchone()
+    cur.execute(
+        'SELECT id, starttime, endtime FROM event WHERE volcano_id = %s '
+        'ORDER BY starttime OFFSET (SELECT count(*)/2 FROM event '
+        'WHERE volcano_id = %s) LIMIT 1;',
+        (volcano_id, volcano_id)
+    )
+    event_id, starttime, endtime = cur.fetchone()
+    cur.execute(
+        'SELECT id FROM event WHERE volcano_id = %s '
+        'ORDER BY starttime LIMIT 500;', (volcano_id,)
+    )
+    event_ids = [row[0] for row in cur.fetchall()]
+    conn.commit()
+    return dict(
+        volcano='V1', volcano_id=volcano_id, channel_ids=channel_ids,
+        event_id=event_id, starttime=starttime, endtime=endtime,
+        event_ids=event_ids, month=starttime.replace(
+            day=1, hour=0, minute=0, second=0, microsecond=0
+        )
+    )
+
+
+def scans(plan):
+    """
+    Scan nodes of a plan (EXPLAIN FORMAT JSON), e.g. 'Seq Scan on coda' or
+    'Index Scan on coda_event_id_idx', those of the partitions of a table
+    counted together, e.g. 'Seq Scan on coda (x12)'.
+    """
+    def _scans(plan):
+        nodes = []
+        if 'Scan' in plan['Node Type']:
+            relation = plan.get('Index Name', plan.get('Relation Name'))
+            relation = PARTITION_SUFFIX.sub('', relation)
+            nodes.append(f"{plan['Node Type']} on {relation}")
+        for subplan in plan.get('Plans', []):
+            nodes.extend(_scans(subplan))
+        return nodes
+
+    return sorted(
+        node if n == 1 else f'{node} (x{n})'
+        for node, n in Counter(_scans(plan)).items()
+    )
+
+
+def run(conn, params, repeat, queries):
+    results = {}
+    cur = conn.cursor()
+    for name, query in queries.items():
+        latencies = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            cur.execute(query, params)
+            cur.fetchall()
+            latencies.append(time.perf_counter() - t0)
+        cur.execute('EXPLAIN (FORMAT JSON) ' + query, params)
+        plan = cur.fetchone()[0][0]['Plan']
+        results[name] = (statistics.median(latencies), scans(plan))
+    conn.commit()
+    return results
+
+
+def main():
+    args = parse_args()
+
+    conn = create_database(args)
+    t0 = time.time()
+    populate(args, conn)
+    print(f'Populated in {time.time() - t0:.1f} s')
+    params = parameters(conn)
+
+    phases = {}
+    phases['before'] = run(conn, params, args.repeat, QUERIES)
+
+    t0 = time.time()
+    migrate(os.path.join(BIN_DIRPATH, 'migrations'), conn)
+    analyze(conn)
+    print(f'Migrated in {time.time() - t0:.1f} s')
+
+    queries = {**QUERIES, **TIME_QUERIES}
+    phases['after'] = run(conn, params, args.repeat, queries)
+
+    if args.interval is not None:
+        t0 = time.time()
+        with open(os.path.join(BIN_DIRPATH, 'partitioned.sql'), 'r') as f:
+            sql = f.read()
+        partitions = partition_tables(sql, args.interval, conn)
+        analyze(conn)
+        print(
+            f'Partitioned in {time.time() - t0:.1f} s '
+            f'({len(partitions)} partitions)'
+        )
+        phases['partitioned'] = run(conn, params, args.repeat, queries)
+
+    for name in queries:
+        print(f'\n{name}:')
+        for phase, results in phases.items():
+            if name not in results:
+                continue
+            latency, _scans = results[name]
+            print(
+                f'  {phase + ":":12s} {latency*1e3:7.1f} ms  '
+                f"{', '.join(_scans)}"
+            )
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
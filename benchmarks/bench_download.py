@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+
+"""
+Benchmark of the waveform download manager against a local stand-in FDSN
+dataselect server.
+
+The server serves a synthetic day of several stations, waits in proportion
+to the samples sent (a slow link) and fails a fraction of the requests
+with HTTP 500. The same day is downloaded with one get_waveforms call and
+with tonus.waveserver.Downloader, and the data of both are checked against
+the synthetic day.
+"""
+
+
+# Python Standard Library
+import argparse
+import io
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Other dependencies
+import numpy as np
+
+from obspy import Stream, Trace, UTCDateTime
+from obspy.clients.fdsn import Client
+from tonus.waveserver import Downloader
+
+# Local files
+
+
+__author__ = 'Leonardo van der Laat'
+__email__ = 'lvmzxc@gmail.com'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--hours', default=24, type=float, help='Duration')
+    parser.add_argument('--stations', default=4, type=int)
+    parser.add_argument('--sampling_rate', default=100, type=float)
+    parser.add_argument(
+        '--rate', default=2e6, type=float,
+        help='Samples per second sent by the server'
+    )
+    parser.add_argument(
+        '--failure', default=0.2, type=float,
+        help='Fraction of the requests failed by the server'
+    )
+    parser.add_argument('--chunk_length', default=3600, type=float)
+    parser.add_argument('--workers', default=8, type=int)
+    return parser.parse_args()
+
+
+def synthetic_stream(hours, stations, sampling_rate, seed=0):
+    rng = np.random.default_rng(seed)
+    starttime = UTCDateTime(2010, 1, 1)
+    npts = int(hours*3600*sampling_rate)
+    return Stream([
+        Trace(
+            data=rng.integers(-1000, 1000, npts).astype(np.int32),
+            header=dict(
+                network='XX', station=f'S{i:02d}', location='',
+                channel='HHZ', sampling_rate=sampling_rate,
+                starttime=starttime
+            )
+        )
+        for i in range(stations)
+    ])
+
+
+def serve(st, rate, failure, seed=0):
+    """
+    Starts the stand-in server in a thread, returns it.
+    """
+    rng = np.random.default_rng(seed)
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            return
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if not url.path.endswith('/query'):
+                self.send_error(404)
+                return
+            with lock:
+                fail = rng.random() < failure
+            if fail:
+                self.send_error(500)
+                return
+
+            q = {k: v[0] for k, v in parse_qs(url.query).items()}
+            _st = Stream()
+            for station in q.get('station', '*').split(','):
+                _st += st.select(
+                    network=q.get('network'), station=station,
+                    channel=q.get('channel')
+                )
+            _st = _st.slice(
+                UTCDateTime(q['starttime']), UTCDateTime(q['endtime'])
+            )
+            if len(_st) == 0:
+                self.send_response(204)
+                self.end_headers()
+                return
+            time.sleep(sum(tr.stats.npts for tr in _st)/rate)
+
+            buf = io.BytesIO()
+            _st.write(buf, format='MSEED')
+            data = buf.getvalue()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/vnd.fdsn.mseed')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def check(st, st_ref):
+    if len(st) != len(st_ref):
+        return False
+    for tr, tr_ref in zip(st.sort(), st_ref.copy().sort()):
+        if (
+            tr.stats.starttime != tr_ref.stats.starttime
+            or not np.array_equal(tr.data, tr_ref.data)
+        ):
+            return False
+    return True
+
+
+def main():
+    args = parse_args()
+
+    st_ref = synthetic_stream(args.hours, args.stations, args.sampling_rate)
+    starttime = st_ref[0].stats.starttime
+    endtime = st_ref[0].stats.endtime
+    stations = ','.join(tr.stats.station for tr in st_ref)
+
+    for failure in [0, args.failure]:
+        server = serve(st_ref, args.rate, failure)
+        client = Client(
+            f'http://127.0.0.1:{server.server_port}',
+            _discover_services=False
+        )
+        print(f'Failure rate {failure:.0%}')
+
+        t0 = time.time()
+        try:
+            st = client.get_waveforms(
+                'XX', stations, '*', 'HHZ', starttime, endtime
+            )
+            print(
+                f'  single request: {time.time() - t0:.2f} s, '
+                f'equal: {check(st, st_ref)}'
+            )
+        except Exception as e:
+            print(f'  single request: {time.time() - t0:.2f} s, failed: {e}')
+
+        downloader = Downloader(
+            client, chunk_length=args.chunk_length, workers=args.workers,
+            retries=5, backoff=0.1
+        )
+        t0 = time.time()
+        st = downloader.get_waveforms(
+            'XX', stations, '*', 'HHZ', starttime, endtime
+        )
+        print(
+            f'  Downloader:     {time.time() - t0:.2f} s, '
+            f'equal: {check(st, st_ref)}'
+        )
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
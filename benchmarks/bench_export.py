@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+
+"""
+Benchmark of the CSV export of the coda peaks of a multi-year catalog.
+
+Loads a synthetic catalog in a scratch database (see bench_db.py) and
+exports the coda peaks of all the channels of a volcano by loading the
+whole result with pandas.read_sql_query, as before, and by streaming it
+from a server-side cursor with tonus.gui.queries.export_data. Each export
+runs in its own process, whose peak memory is reported.
+"""
+
+
+# Python Standard Library
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+# Other dependencies
+import pandas as pd
+import psycopg2
+
+from bench_db import BIN_DIRPATH, create_database, parse_args, populate
+from tonus.database import migrate
+from tonus.gui.queries import export_data
+
+# Local files
+
+
+__author__ = 'Leonardo van der Laat'
+__email__ = 'lvmzxc@gmail.com'
+
+
+QUERY = """
+SELECT
+    coda.t1, coda.t2, coda.t3,
+    coda.channel_id, coda.event_id,
+    coda_peaks.frequency, coda_peaks.q_f,
+    coda_peaks.amplitude,
+    channel.station, channel.channel
+FROM
+    coda_peaks
+INNER JOIN
+    coda
+ON
+    coda_peaks.coda_id = coda.id
+INNER JOIN
+    channel
+ON
+    coda.channel_id = channel.id
+WHERE
+    coda.channel_id IN ({});
+"""
+
+
+def read_sql(db, channel_ids, filepath):
+    conn = psycopg2.connect(**db)
+    df = pd.read_sql_query(QUERY.format(','.join(channel_ids)), conn)
+    df['stacha'] = df.station+' '+df.channel+' '+df.channel_id.apply(str)
+    df.to_csv(filepath, index=False)
+    conn.close()
+    return len(df)
+
+
+def stream(db, channel_ids, filepath):
+    conn = psycopg2.connect(**db)
+    n = export_data(filepath, channel_ids, 'coda', conn)
+    conn.close()
+    return n
+
+
+def _run(function, args, queue):
+    t0 = time.time()
+    n = function(*args)
+    queue.put((
+        n, time.time() - t0,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+    ))
+
+
+def run(function, *args):
+    """
+    Runs the function in a new process, returns its result, duration and
+    peak memory (MB).
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_run, args=(function, args, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    args = parse_args()
+
+    conn = create_database(args)
+    populate(args, conn)
+    migrate(os.path.join(BIN_DIRPATH, 'migrations'), conn)
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM channel WHERE volcano = 'V1';")
+    channel_ids = [str(row[0]) for row in cur.fetchall()]
+    conn.close()
+
+    db = dict(
+        host=args.host, user=args.user, password=args.password,
+        database=args.database
+    )
+    with tempfile.TemporaryDirectory() as dirpath:
+        for name, function in [('read_sql_query', read_sql),
+                               ('export_data', stream)]:
+            filepath = os.path.join(dirpath, f'{name}.csv')
+            n, duration, maxrss = run(function, db, channel_ids, filepath)
+            size = os.path.getsize(filepath)/1024**2
+            print(
+                f'{name:15s} {n} rows ({size:.0f} MB) in {duration:.1f} s, '
+                f'peak memory {maxrss:.0f} MB'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+
+"""
+Benchmark of the spectrum smoothing (sliding median) kernels.
+
+Compares scipy.ndimage.median_filter, applied to all the spectra at once,
+against scipy.signal.medfilt applied to each spectrum (as
+tonus.process.coda.get_peaks and tonus.process.tremor.get_harmonics), for
+kernel sizes from 11 to 2001 bins, and checks that both outputs agree.
+"""
+
+
+# Python Standard Library
+import argparse
+import time
+
+# Other dependencies
+import numpy as np
+
+from scipy.ndimage import median_filter
+from scipy.signal import medfilt
+
+# Local files
+
+
+__author__ = 'Leonardo van der Laat'
+__email__ = 'lvmzxc@gmail.com'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--frames', default=20, type=int,
+                        help='Number of spectra')
+    parser.add_argument('--bins', default=2**16, type=int,
+                        help='Frequency bins per spectrum')
+    parser.add_argument('--kernels', default=[11, 51, 201, 501, 1001, 2001],
+                        type=int, nargs='+', help='Kernel sizes (bins)')
+    return parser.parse_args()
+
+
+def timeit(func, *args):
+    t0 = time.perf_counter()
+    out = func(*args)
+    return out, time.perf_counter() - t0
+
+
+def medfilt_rows(Sxx, kernel_size):
+    return np.array([medfilt(Sx, kernel_size=kernel_size) for Sx in Sxx])
+
+
+def median_filter_2d(Sxx, kernel_size):
+    return median_filter(
+        Sxx, size=(1, kernel_size), mode='constant', cval=0
+    )
+
+
+def main():
+    args = parse_args()
+
+    rng = np.random.default_rng(0)
+    Sxx = np.abs(rng.normal(size=(args.frames, args.bins)))
+
+    print(f'Spectra: {args.frames}, bins: {args.bins}')
+    print(f'{"kernel":>8}{"2-D [s]":>14}{"medfilt [s]":>12}'
+          f'{"speed-up":>10}{"max |diff|":>12}')
+    for kernel_size in args.kernels:
+        ref, t_ref = timeit(median_filter_2d, Sxx, kernel_size)
+        new, t_new = timeit(medfilt_rows, Sxx, kernel_size)
+        diff = np.abs(new - ref).max()
+        print(f'{kernel_size:>8}{t_ref:>14.3f}{t_new:>12.3f}'
+              f'{t_ref/t_new:>9.1f}x{diff:>12.2e}')
+    return
+
+
+if __name__ == '__main__':
+    main()
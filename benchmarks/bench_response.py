@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+
+"""
+Benchmark of the response removal of many events of the same channels.
+
+Removes the response of a series of event windows (same channels, length
+and sampling rate, as in the interface and the batch scripts) with
+obspy.Stream.remove_response and with tonus.preprocess.remove_response,
+which reuses the frequency responses, and checks that both agree.
+"""
+
+
+# Python Standard Library
+import argparse
+import time
+
+# Other dependencies
+import numpy as np
+
+from obspy import Stream, Trace, read_inventory
+from tonus.preprocess import ResponseCache, remove_response
+
+# Local files
+
+
+__author__ = 'Leonardo van der Laat'
+__email__ = 'lvmzxc@gmail.com'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--events', default=200, type=int)
+    parser.add_argument('--duration', default=120, type=float)
+    parser.add_argument('--sampling_rate', default=100, type=float)
+    return parser.parse_args()
+
+
+def event_streams(inventory, events, duration, sampling_rate, seed=0):
+    """
+    Noise on the channels of the inventory (obspy example inventory).
+    """
+    rng = np.random.default_rng(seed)
+    channels = inventory.select(network='BW', station='RJOB')[0][0]
+    starttime = channels[0].start_date + 86400
+    npts = int(duration*sampling_rate)
+    return [
+        Stream([
+            Trace(
+                data=rng.normal(size=npts)*1e3,
+                header=dict(
+                    network='BW', station='RJOB',
+                    location=channel.location_code, channel=channel.code,
+                    sampling_rate=sampling_rate,
+                    starttime=starttime + i*3600
+                )
+            )
+            for channel in channels
+        ])
+        for i in range(events)
+    ]
+
+
+def main():
+    args = parse_args()
+
+    inventory = read_inventory()
+    streams = event_streams(
+        inventory, args.events, args.duration, args.sampling_rate
+    )
+
+    t0 = time.time()
+    reference = []
+    for st in streams:
+        reference.append(st.copy().remove_response(inventory))
+    t_obspy = time.time() - t0
+
+    cache = ResponseCache(inventory)
+    t0 = time.time()
+    results = []
+    for st in streams:
+        results.append(remove_response(st.copy(), inventory, cache=cache))
+    t_cache = time.time() - t0
+
+    error = max(
+        np.abs(tr.data - tr_ref.data).max()
+        for st, st_ref in zip(results, reference)
+        for tr, tr_ref in zip(st, st_ref)
+    )
+    n = sum(len(st) for st in streams)
+    print(f'{args.events} events, {n} traces')
+    print(f'obspy:  {t_obspy:.2f} s')
+    print(f'cached: {t_cache:.2f} s ({t_obspy/t_cache:.1f}x)')
+    print(f'hits {cache.hits}, misses {cache.misses}, max error {error:.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+
+"""
+Benchmark of the YIN fundamental frequency backends of detect_f1.
+
+Compares the per-window loop (yin_block, O(W^2) per window) against the
+single compiled parallel kernel over all windows (detect_f1_batch) and the
+FFT difference function of all windows at once (yin_fft, O(W log W)) on a
+synthetic harmonic tremor sampled at 100 Hz, for windows of 10 to 60 s.
+"""
+
+
+# Python Standard Library
+import argparse
+import time
+
+# Other dependencies
+import numpy as np
+
+from obspy import Trace
+from tonus.process.tremor import detect_f1
+
+# Local files
+
+
+__author__ = 'Leonardo van der Laat'
+__email__ = 'lvmzxc@gmail.com'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--duration', default=600, type=float,
+                        help='Duration of the trace (s)')
+    parser.add_argument('--sampling_rate', default=100, type=float)
+    parser.add_argument('--windows', default=[10, 20, 30, 60], type=float,
+                        nargs='+', help='Window lengths (s)')
+    parser.add_argument('--overlap', default=0.9, type=float)
+    parser.add_argument('--freqmin', default=1, type=float)
+    parser.add_argument('--thresh', default=0.5, type=float)
+    parser.add_argument('--backends', default=['loop', 'batch', 'fft'],
+                        nargs='+', help='The first one is the reference')
+    return parser.parse_args()
+
+
+def synthetic_tremor(duration, sampling_rate, seed=0):
+    """
+    Gliding harmonic tremor (fundamental and 2 overtones) in noise.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(0, duration, 1/sampling_rate)
+    f1 = 2 + 0.5*np.sin(2*np.pi*t/duration)
+    phase = 2*np.pi*np.cumsum(f1)/sampling_rate
+    data = sum(np.sin(n*phase)/n for n in range(1, 4))
+    data += 0.3*rng.normal(size=len(t))
+    return Trace(data=data, header=dict(sampling_rate=sampling_rate))
+
+
+def main():
+    args = parse_args()
+    tr = synthetic_tremor(args.duration, args.sampling_rate)
+
+    # Compile the numba kernels before timing
+    for backend in args.backends:
+        detect_f1(tr.slice(endtime=tr.stats.starttime+30), 10, args.overlap,
+                  args.freqmin, args.thresh, backend=backend)
+
+    header = f'{"window [s]":>10}' + ''.join(
+        f'{b + " [s]":>12}' for b in args.backends
+    ) + ''.join(
+        f'{b + " x":>10}{"max |dF1|":>12}' for b in args.backends[1:]
+    )
+    print(header)
+    for window_s in args.windows:
+        times, results = [], []
+        for backend in args.backends:
+            t0 = time.perf_counter()
+            results.append(detect_f1(tr, window_s, args.overlap,
+                                     args.freqmin, args.thresh,
+                                     backend=backend))
+            times.append(time.perf_counter() - t0)
+        line = f'{window_s:>10.0f}' + ''.join(f'{t:>12.3f}' for t in times)
+        for _time, result in zip(times[1:], results[1:]):
+            diff = np.nanmax(np.abs(result[2] - results[0][2]))
+            line += f'{times[0]/_time:>9.1f}x{diff:>12.2e}'
+        print(line)
+    return
+
+
+if __name__ == '__main__':
+    main()
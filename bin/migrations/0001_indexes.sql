@@ -0,0 +1,45 @@
+-- Indexes of the access paths of tonus.gui.queries, the check_event of the
+-- interface and the batch scripts (only the primary keys were indexed).
+
+-- Redundant with event_pk
+DROP INDEX IF EXISTS discrete_id_idx;
+
+-- Events of a volcano in a time range (check_event, get_or_insert_events)
+CREATE INDEX IF NOT EXISTS event_volcano_id_starttime_idx
+    ON event USING btree (volcano_id, starttime, endtime);
+
+-- Time ranges over all the volcanoes, events are inserted in time order
+CREATE INDEX IF NOT EXISTS event_starttime_brin_idx
+    ON event USING brin (starttime);
+
+-- Codas of a list of channels (_get_coda_data), covering the columns read.
+-- coda_un already indexes (channel_id, event_id), not the rest.
+CREATE INDEX IF NOT EXISTS coda_channel_id_idx
+    ON coda USING btree (channel_id) INCLUDE (id, event_id, t1, t2, t3);
+
+-- Codas of an event (check_event) and cascade of the event deletes
+CREATE INDEX IF NOT EXISTS coda_event_id_idx
+    ON coda USING btree (event_id);
+
+-- Peaks of the codas (_get_coda_data) and cascade of the coda deletes
+CREATE INDEX IF NOT EXISTS coda_peaks_coda_id_idx
+    ON coda_peaks USING btree (coda_id) INCLUDE (frequency, amplitude, q_f);
+
+-- Tremor of a list of channels (_get_tremor_data, get_stacha_with_event)
+CREATE INDEX IF NOT EXISTS tremor_channel_id_event_id_idx
+    ON tremor USING btree (channel_id, event_id);
+
+-- Tremor of the events (get_tremor_done, get_volcanoes_with_event)
+CREATE INDEX IF NOT EXISTS tremor_event_id_idx
+    ON tremor USING btree (event_id);
+
+-- Channels and stations of a volcano (get_channel_ids,
+-- get_stacha_with_event) and cascade of the station deletes
+CREATE INDEX IF NOT EXISTS channel_volcano_idx
+    ON channel USING btree (volcano);
+
+CREATE INDEX IF NOT EXISTS channel_station_id_idx
+    ON channel USING btree (station_id);
+
+CREATE INDEX IF NOT EXISTS station_volcano_id_idx
+    ON station USING btree (volcano_id);
@@ -0,0 +1,26 @@
+-- Start time of the event in the tables of its results, the partition key
+-- of the partitioned schema (tonus-db partition) and the time bounds of
+-- the queries of the interface.
+
+ALTER TABLE coda ADD COLUMN IF NOT EXISTS event_starttime timestamp(3) NULL;
+ALTER TABLE coda_peaks
+    ADD COLUMN IF NOT EXISTS event_starttime timestamp(3) NULL;
+ALTER TABLE tremor
+    ADD COLUMN IF NOT EXISTS event_starttime timestamp(3) NULL;
+
+UPDATE coda SET event_starttime = event.starttime
+FROM event
+WHERE coda.event_id = event.id AND coda.event_starttime IS NULL;
+
+UPDATE coda_peaks SET event_starttime = coda.event_starttime
+FROM coda
+WHERE coda_peaks.coda_id = coda.id AND coda_peaks.event_starttime IS NULL;
+
+UPDATE tremor SET event_starttime = event.starttime
+FROM event
+WHERE tremor.event_id = event.id AND tremor.event_starttime IS NULL;
+
+-- Interval of the partitions, no row if the tables are not partitioned
+CREATE TABLE IF NOT EXISTS partitioning (
+    interval varchar NOT NULL
+);
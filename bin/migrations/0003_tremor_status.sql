@@ -0,0 +1,18 @@
+-- Event channels processed by tonus-tremor-batch and their outcome
+-- (TREMOR_STATUSES of tonus.database), also those without a tremor, so
+-- that a resumed run skips them. No foreign key to the events, whose
+-- primary key changes when the tables are partitioned.
+
+CREATE TABLE IF NOT EXISTS tremor_status (
+    event_id int8 NOT NULL,
+    channel_id int8 NOT NULL,
+    status varchar NOT NULL,
+    processed_at timestamptz NOT NULL DEFAULT now(),
+    CONSTRAINT tremor_status_pk PRIMARY KEY (event_id, channel_id),
+    CONSTRAINT tremor_status_fk FOREIGN KEY (channel_id) REFERENCES channel(id)
+);
+
+-- Event channels already in the tremor table
+INSERT INTO tremor_status(event_id, channel_id, status)
+SELECT DISTINCT event_id, channel_id, 'tremor' FROM tremor
+ON CONFLICT DO NOTHING;
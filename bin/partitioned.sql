@@ -0,0 +1,85 @@
+-- Tables of the events and their results partitioned by the start time of
+-- the event (tonus.database.partition_tables), replacing those of
+-- schema.sql after the migrations up to 0002. The partitions are created
+-- by tonus.database.create_partitions. The partition key is part of the
+-- primary keys and of the foreign keys between these tables.
+
+CREATE TABLE event (
+    id int4 NOT NULL DEFAULT nextval('event_id_seq'),
+    starttime timestamp(3) NOT NULL,
+    endtime timestamp(3) NULL,
+    volcano_id int8  NULL,
+    CONSTRAINT event_pk PRIMARY KEY (id, starttime),
+    CONSTRAINT event_fk FOREIGN KEY (volcano_id) REFERENCES volcano(id) ON DELETE CASCADE
+) PARTITION BY RANGE (starttime);
+
+CREATE TABLE coda (
+    channel_id int8 NOT NULL,
+    t1 timestamptz(3) NULL,
+    t2 timestamptz(3) NULL,
+    t3 timestamptz(3) NULL,
+    event_id int8 NOT NULL,
+    q_alpha float8 NULL,
+    id int4 NOT NULL DEFAULT nextval('coda_id_seq'),
+    event_starttime timestamp(3) NOT NULL,
+    CONSTRAINT coda_pk PRIMARY KEY (id, event_starttime),
+    CONSTRAINT coda_un UNIQUE (channel_id, event_id, event_starttime),
+    CONSTRAINT coda_times_fk FOREIGN KEY (event_id, event_starttime) REFERENCES "event"(id, starttime) ON DELETE CASCADE ON UPDATE CASCADE,
+    CONSTRAINT coda_times_fk_1 FOREIGN KEY (channel_id) REFERENCES channel(id)
+) PARTITION BY RANGE (event_starttime);
+
+CREATE TABLE coda_peaks (
+    frequency float8 NULL,
+    amplitude float8 NULL,
+    q_f float8 NULL,
+    coda_id int8 NOT NULL,
+    id int4 NOT NULL DEFAULT nextval('coda_peaks_id_seq'),
+    event_starttime timestamp(3) NOT NULL,
+    CONSTRAINT coda_peaks_pk PRIMARY KEY (id, event_starttime),
+    CONSTRAINT coda_peaks_fk FOREIGN KEY (coda_id, event_starttime) REFERENCES coda(id, event_starttime) ON DELETE CASCADE ON UPDATE CASCADE
+) PARTITION BY RANGE (event_starttime);
+
+CREATE TABLE tremor (
+    id int4 NOT NULL DEFAULT nextval('tremor_id_seq'),
+    event_id int8 NOT NULL,
+    channel_id int8 NOT NULL,
+    starttime timestamptz(3) NULL,
+    endtime timestamptz(3) NULL,
+    fmin float8 NULL,
+    fmax float8 NULL,
+    fmean float8 NULL,
+    fstd float8 NULL,
+    fmedian float8 NULL,
+    n_harmonics int4 NULL,
+    amplitude float8 NULL,
+    lp_time timestamp(3) NULL,
+    lp bool NOT NULL,
+    odd bool NULL,
+    harmonics _int4 NULL,
+    event_starttime timestamp(3) NOT NULL,
+    CONSTRAINT harmonic_pk PRIMARY KEY (id, event_starttime),
+    CONSTRAINT harmonic_fk FOREIGN KEY (event_id, event_starttime) REFERENCES "event"(id, starttime) ON UPDATE CASCADE,
+    CONSTRAINT harmonic_fk_1 FOREIGN KEY (channel_id) REFERENCES channel(id)
+) PARTITION BY RANGE (event_starttime);
+
+-- Indexes of 0001_indexes.sql, created on every partition
+CREATE INDEX event_volcano_id_starttime_idx
+    ON event USING btree (volcano_id, starttime, endtime);
+
+CREATE INDEX event_starttime_brin_idx
+    ON event USING brin (starttime);
+
+CREATE INDEX coda_channel_id_idx
+    ON coda USING btree (channel_id) INCLUDE (id, event_id, t1, t2, t3);
+
+CREATE INDEX coda_event_id_idx
+    ON coda USING btree (event_id);
+
+CREATE INDEX coda_peaks_coda_id_idx
+    ON coda_peaks USING btree (coda_id) INCLUDE (frequency, amplitude, q_f);
+
+CREATE INDEX tremor_channel_id_event_id_idx
+    ON tremor USING btree (channel_id, event_id);
+
+CREATE INDEX tremor_event_id_idx
+    ON tremor USING btree (event_id);
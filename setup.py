@@ -35,8 +35,11 @@ if __name__ == '__main__':
         scripts=[
             'bin/tonus',
             'bin/tonus-db',
+            'bin/tonus-coda-batch',
             'bin/tonus-db-populate',
             'bin/tonus-detect',
+            'bin/tonus-index',
+            'bin/tonus-tremor-batch',
         ],
         zip_safe=False
     )
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+
+"""
+The incremental coincidence trigger of the follow mode gives the same
+events as obspy.signal.trigger.coincidence_trigger.
+"""
+
+
+# Python Standard Library
+
+# Other dependencies
+import numpy as np
+import pytest
+
+from obspy import Stream, Trace, UTCDateTime
+from obspy.signal.trigger import coincidence_trigger
+
+# Local files
+from tonus.detection.realtime import CoincidenceTrigger
+
+
+__author__ = 'Leonardo van der Laat'
+__email__ = 'lvmzxc@gmail.com'
+
+
+THR_ON = 3
+THR_OFF = 1.5
+SAMPLING_RATE = 2.
+
+
+def cft_stream(seed=0):
+    """
+    Characteristic functions of 3 stations: noise, short triggers, a
+    200 s plateau above thr_on, a trigger dipping between the thresholds
+    and samples exactly at the thresholds.
+    """
+    rng = np.random.default_rng(seed)
+    starttime = UTCDateTime(2020, 1, 1)
+    npts = int(3600*SAMPLING_RATE)
+    st = Stream()
+    for k, station in enumerate(['S1', 'S2', 'S3']):
+        data = rng.uniform(0, 1, npts)
+
+        def window(start, duration, value):
+            i = int((start + 3*k)*SAMPLING_RATE)
+            data[i:i + int(duration*SAMPLING_RATE)] = value
+
+        window(100, 20, 5)
+        window(1000, 200, 5)
+        window(1500, 90, 2)
+        window(1510, 5, 5)
+        window(1550, 5, 5)
+        window(2000, 10, THR_ON)
+        window(2010, 5, THR_OFF)
+        window(2500, 30, 5)
+        window(2600, 10, 5 if k < 2 else 0.5)
+        data[-20:] = 0
+        st += Trace(
+            data=data,
+            header=dict(
+                network='XX', station=station, channel='CFT',
+                sampling_rate=SAMPLING_RATE, starttime=starttime
+            )
+        )
+    return st
+
+
+def follow(st, chunk, **kwargs):
+    trigger = CoincidenceTrigger(THR_ON, THR_OFF, 2, **kwargs)
+    events = []
+    t = st[0].stats.starttime
+    while t < st[0].stats.endtime:
+        _st = st.slice(t, t + chunk - st[0].stats.delta)
+        events += trigger.process(_st)
+        t += chunk
+    return events
+
+
+def summary(events):
+    return [
+        (
+            round(event['time'].timestamp, 3),
+            round(event['duration'], 3),
+            sorted(event['trace_ids'])
+        )
+        for event in events
+    ]
+
+
+@pytest.mark.parametrize('delete_long_trigger', [False, True])
+@pytest.mark.parametrize('chunk', [1, 37, 600])
+def test_same_events_as_coincidence_trigger(delete_long_trigger, chunk):
+    st = cft_stream()
+    kwargs = dict(
+        max_trigger_length=60, delete_long_trigger=delete_long_trigger
+    )
+    expected = coincidence_trigger(
+        None, THR_ON, THR_OFF, st.copy(), 2, **kwargs
+    )
+    events = follow(st, chunk, **kwargs)
+    assert len(expected) > 0
+    assert summary(events) == summary(expected)
@@ -10,7 +10,10 @@ from . import gui
 from . import process
 from . import config
 from . import database
+from . import filters
 from . import preprocess
+from . import wavecache
+from . import waveindex
 from . import waveserver
 
 
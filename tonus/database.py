@@ -7,9 +7,16 @@
 
 # Python Standard Library
 import logging
+import os
+import weakref
+
+from datetime import datetime, timedelta
 
 # Other dependencies
+import numpy as np
+
 from obspy.geodetics.base import kilometers2degrees, gps2dist_azimuth
+from psycopg2.extras import execute_values
 
 # Local files
 
@@ -18,6 +25,26 @@ __author__ = 'Leonardo van der Laat'
 __email__ = 'lvmzxc@gmail.com'
 
 
+# Key of the advisory lock held while migrating
+MIGRATIONS_LOCK = 7150
+
+# Partitioned tables (tonus-db partition) and their partition keys
+PARTITIONED_TABLES = {
+    'event': 'starttime',
+    'coda': 'event_starttime',
+    'coda_peaks': 'event_starttime',
+    'tremor': 'event_starttime',
+}
+PARTITION_INTERVALS = ['month', 'year']
+
+# Outcomes of the event channels processed by tonus-tremor-batch
+# (tremor_status table)
+TREMOR_STATUSES = ['tremor', 'no tremor', 'error', 'no data']
+
+# Tables of each connection with the event_starttime column
+_event_starttime_tables = weakref.WeakKeyDictionary()
+
+
 def get_column_names(table_name, conn):
     query = f"""
     SELECT
@@ -40,129 +67,328 @@ def get_column_names(table_name, conn):
     return columns
 
 
-def insert_volcano_stations(
-    inventory, volcano, latitude, longitude, maxradius, conn
-):
-    print('\n', volcano.center(80, '-'))
+def _datetime(t):
+    return None if t is None else t.datetime
 
-    query_volcano = """
-    INSERT INTO volcano
-        (volcano, latitude, longitude)
-    VALUES
-        (%s, %s, %s)
-    RETURNING id
+
+def _round_seconds(dt):
+    # As stored in the timestamp(0) columns
+    if dt is None:
+        return None
+    return (dt + timedelta(microseconds=500000)).replace(microsecond=0)
+
+
+def nearby_stations(volcanoes, stations, maxradius, chunk_size=10**7):
     """
-    values = (volcano, latitude, longitude)
-    try:
-        with conn:
-            cur = conn.cursor()
-            cur.execute(query_volcano, values)
-    except Exception as e:
-        print(e)
-        _query = f"SELECT id FROM volcano WHERE volcano = '{volcano}';"
-
-        with conn:
-            cur = conn.cursor()
-            cur.execute(_query)
-    volcano_id = cur.fetchone()[0]
+    Pairs of volcanoes and stations within a distance, from the great
+    circle distances (haversine, spherical Earth as obspy's
+    kilometers2degrees) computed as a matrix.
 
-    try:
-        _inventory = inventory.select(
-            latitude=latitude, longitude=longitude,
-            maxradius=kilometers2degrees(maxradius)
+    Parameters:
+    -----------
+    volcanoes, stations : numpy.ndarray
+        Latitudes and longitudes (degrees), arrays of shape (n, 2).
+    maxradius : float
+        Maximum distance (km).
+    chunk_size : int
+        Maximum number of distances computed at once (memory).
+
+    Returns:
+    --------
+    i, j : numpy.ndarray
+        Indexes of the volcanoes and stations of the pairs, sorted by
+        volcano and station.
+    """
+    volcanoes = np.radians(np.asarray(volcanoes, dtype=float).reshape(-1, 2))
+    stations = np.radians(np.asarray(stations, dtype=float).reshape(-1, 2))
+    maxangle = np.radians(kilometers2degrees(maxradius))
+    # Compared as the haversine of the angle, monotonic in [0, pi]
+    maxhav = np.sin(min(maxangle, np.pi)/2)**2
+
+    lat2, lon2 = stations[:, 0], stations[:, 1]
+    step = max(chunk_size // max(len(stations), 1), 1)
+    i, j = [], []
+    for k in range(0, len(volcanoes), step):
+        lat1 = volcanoes[k:k+step, 0:1]
+        lon1 = volcanoes[k:k+step, 1:2]
+        hav = (
+            np.sin((lat2 - lat1)/2)**2 +
+            np.cos(lat1)*np.cos(lat2)*np.sin((lon2 - lon1)/2)**2
+        )
+        _i, _j = np.nonzero(hav <= maxhav)
+        i.append(_i + k)
+        j.append(_j)
+    if not i:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    return np.concatenate(i), np.concatenate(j)
+
+
+def inventory_rows(inventory, volcanoes, maxradius):
+    """
+    Station and channel rows of the stations of an inventory within
+    maxradius km of each volcano. A station near several volcanoes is
+    associated to the first one of the list.
+
+    Parameters:
+    -----------
+    inventory : obspy.Inventory
+    volcanoes : list of (volcano, latitude, longitude)
+    maxradius : float
+        Maximum distance between volcano and stations (km).
+
+    Returns:
+    --------
+    stations : dict
+        (station, latitude, longitude): (network, station, latitude,
+        longitude, elevation, start_date, end_date, volcano, distance).
+    channels : dict
+        (station, latitude, longitude): list of (network, station,
+        location, channel, sample_rate, start_date, end_date, sensor,
+        data_logger).
+    """
+    _stations = [
+        (network, station) for network in inventory for station in network
+    ]
+    i, j = nearby_stations(
+        [(latitude, longitude) for _, latitude, longitude in volcanoes],
+        [(s.latitude, s.longitude) for _, s in _stations],
+        maxradius
+    )
+
+    stations = {}
+    channels = {}
+    for _i, _j in zip(i, j):
+        volcano, latitude, longitude = volcanoes[_i]
+        network, station = _stations[_j]
+        key = (station.code, station.latitude, station.longitude)
+        if key in stations:
+            continue
+        distance = int(gps2dist_azimuth(
+            latitude, longitude, station.latitude, station.longitude
+        )[0])
+        stations[key] = (
+            network.code, station.code, station.latitude,
+            station.longitude, station.elevation,
+            _datetime(station.start_date), _datetime(station.end_date),
+            volcano, distance
         )
-    except Exception as e:
-        logging.warning(e)
+        channels[key] = [
+            (
+                network.code,
+                station.code,
+                channel.location_code,
+                channel.code,
+                channel.sample_rate,
+                _datetime(channel.start_date),
+                _datetime(channel.end_date),
+                getattr(channel.sensor, 'description', None),
+                getattr(channel.data_logger, 'description', None),
+            )
+            for channel in station
+        ]
+
+    for k in sorted(set(range(len(volcanoes))) - set(i.tolist())):
         logging.warning(
-            f'No stations within {maxradius} km of {volcano} volcano.'
+            f'No stations within {maxradius} km of {volcanoes[k][0]} volcano.'
         )
-        return
+    return stations, channels
 
-    station_columns = get_column_names('station', conn)
-    values_fmt = ', '.join('%s' for c in station_columns)
 
-    query_station = f"""
-    INSERT INTO
-        station ({', '.join(station_columns)})
-    VALUES
-        ({values_fmt})
-    RETURNING
-        id
+def load_inventory(inventory, volcanoes, maxradius, conn):
     """
+    Loads the volcanoes and the stations and channels of the inventory
+    around them (see inventory_rows), with a few bulk statements in one
+    transaction.
 
-    channel_columns = get_column_names('channel', conn)
-    values_fmt = ', '.join('%s' for c in channel_columns)
+    Loading again updates the rows: existing volcanoes (same name),
+    stations (same code and coordinates) and channels (same station,
+    location, channel and start date) are updated, the rest inserted.
+    Existing stations keep their volcano.
 
-    query_channel = f"""
-    INSERT INTO
-        channel ({', '.join(channel_columns)})
-    VALUES
-        ({values_fmt});
+    Parameters:
+    -----------
+    inventory : obspy.Inventory
+    volcanoes : list of (volcano, latitude, longitude)
+    maxradius : float
+        Maximum distance between volcano and stations (km).
+    conn : psycopg2 connection
+
+    Returns:
+    --------
+    n_stations, n_channels : int
+        Number of stations and channels inserted.
     """
+    _volcanoes = {}
+    for volcano, latitude, longitude in volcanoes:
+        _volcanoes.setdefault(volcano, (volcano, latitude, longitude))
+    volcanoes = list(_volcanoes.values())
 
-    for network in _inventory:
-        for station in network:
-            print(station.code)
-            distance = int(gps2dist_azimuth(
-                latitude, longitude, station.latitude, station.longitude
-            )[0])
+    stations, channels = inventory_rows(inventory, volcanoes, maxradius)
 
-            if station.end_date is None:
-                end_date = None
-            else:
-                end_date = station.end_date.datetime
+    with conn:
+        cur = conn.cursor()
+        cur.execute(
+            'LOCK TABLE volcano, station, channel '
+            'IN SHARE ROW EXCLUSIVE MODE;'
+        )
 
-            values = [
-                network.code, station.code, station.latitude,
-                station.longitude, station.elevation,
-                station.start_date.datetime, end_date, volcano_id, distance,
-                volcano
-            ]
+        rows = execute_values(
+            cur,
+            """
+            INSERT INTO
+                volcano (volcano, latitude, longitude)
+            VALUES
+                %s
+            ON CONFLICT (volcano) DO UPDATE SET
+                latitude = EXCLUDED.latitude,
+                longitude = EXCLUDED.longitude
+            RETURNING
+                volcano, id
+            """,
+            volcanoes,
+            fetch=True
+        )
+        volcano_ids = dict(rows)
+
+        # Stations
+        cur.execute('SELECT station, latitude, longitude, id, volcano '
+                    'FROM station ORDER BY id;')
+        existing = {}
+        for station, latitude, longitude, station_id, volcano in cur:
+            existing.setdefault(
+                (station, latitude, longitude), (station_id, volcano)
+            )
 
-            try:
-                with conn:
-                    cur = conn.cursor()
-                    cur.execute(query_station, values)
-                    station_id = cur.fetchone()[0]
-            except Exception as e:
-                logging.warning(e)
-                continue
-
-            for channel in station:
-
-                if channel.end_date is None:
-                    end_date = None
-                else:
-                    end_date = channel.end_date.datetime
-
-                if channel.sensor is None:
-                    sensor = None
-                else:
-                    sensor = channel.sensor.description
-
-                if channel.data_logger is None:
-                    data_logger = None
-                else:
-                    data_logger = channel.data_logger.description
-
-                values = [
-                    network.code,
-                    station.code,
-                    channel.location_code,
-                    channel.code,
-                    volcano,
-                    channel.sample_rate,
-                    channel.start_date.datetime,
-                    end_date,
-                    sensor,
-                    data_logger,
+        new_stations = [
+            row[:7] + (volcano_ids[row[7]], row[8], row[7])
+            for key, row in stations.items() if key not in existing
+        ]
+        updated_stations = [
+            (existing[key][0], row[0], row[4], row[5], row[6])
+            for key, row in stations.items() if key in existing
+        ]
+        rows = execute_values(
+            cur,
+            """
+            INSERT INTO
+                station (network, station, latitude, longitude, elevation,
+                    start_date, end_date, volcano_id, distance, volcano)
+            VALUES
+                %s
+            RETURNING
+                station, latitude, longitude, id, volcano
+            """,
+            new_stations,
+            fetch=True
+        )
+        for station, latitude, longitude, station_id, volcano in rows:
+            existing[(station, latitude, longitude)] = (station_id, volcano)
+
+        execute_values(
+            cur,
+            """
+            UPDATE
+                station
+            SET
+                network = v.network,
+                elevation = v.elevation,
+                start_date = v.start_date,
+                end_date = v.end_date
+            FROM
+                (VALUES %s) AS v (id, network, elevation, start_date,
+                    end_date)
+            WHERE
+                station.id = v.id
+            """,
+            updated_stations,
+            template='(%s, %s, %s, %s::timestamp, %s::timestamp)'
+        )
+
+        # Channels
+        station_ids = [existing[key][0] for key in stations]
+        cur.execute(
+            """
+            SELECT
+                station_id, location, channel, start_date, id
+            FROM
+                channel
+            WHERE
+                station_id = ANY(%s);
+            """,
+            (station_ids,)
+        )
+        channel_ids = {row[:4]: row[4] for row in cur}
+
+        new_channels, updated_channels = [], []
+        for key, rows in channels.items():
+            station_id, volcano = existing[key]
+            for (
+                network, station, location, channel, sample_rate,
+                start_date, end_date, sensor, data_logger
+            ) in rows:
+                channel_key = (
+                    station_id, location, channel, _round_seconds(start_date)
+                )
+                if channel_key in channel_ids:
+                    # None if repeated in the inventory
+                    if channel_ids[channel_key] is not None:
+                        updated_channels.append((
+                            channel_ids[channel_key], sample_rate, end_date,
+                            sensor, data_logger
+                        ))
+                    continue
+                channel_ids[channel_key] = None
+                new_channels.append((
+                    network, station, location, channel, volcano,
+                    sample_rate, start_date, end_date, sensor, data_logger,
                     station_id
-                ]
+                ))
 
-                with conn:
-                    cur = conn.cursor()
-                    cur.execute(query_channel, values)
-    return
+        execute_values(
+            cur,
+            """
+            INSERT INTO
+                channel (network, station, location, channel, volcano,
+                    sample_rate, start_date, end_date, sensor, data_logger,
+                    station_id)
+            VALUES
+                %s
+            """,
+            new_channels
+        )
+        execute_values(
+            cur,
+            """
+            UPDATE
+                channel
+            SET
+                sample_rate = v.sample_rate,
+                end_date = v.end_date,
+                sensor = v.sensor,
+                data_logger = v.data_logger
+            FROM
+                (VALUES %s) AS v (id, sample_rate, end_date, sensor,
+                    data_logger)
+            WHERE
+                channel.id = v.id
+            """,
+            updated_channels,
+            template='(%s, %s::float8, %s::timestamp, %s::varchar, '
+                     '%s::varchar)'
+        )
+
+    return len(new_stations), len(new_channels)
+
+
+def insert_volcano_stations(
+    inventory, volcano, latitude, longitude, maxradius, conn
+):
+    """
+    Loads one volcano and its stations, see load_inventory.
+    """
+    return load_inventory(
+        inventory, [(volcano, latitude, longitude)], maxradius, conn
+    )
 
 
 def remove_duplicates(conn):
@@ -180,5 +406,645 @@ def remove_duplicates(conn):
     return
 
 
+def get_volcano_id(volcano, conn):
+    with conn:
+        cur = conn.cursor()
+        cur.execute('SELECT id FROM volcano WHERE volcano = %s;', (volcano,))
+        row = cur.fetchone()
+    if row is None:
+        raise ValueError(f'Volcano {volcano} not in the database')
+    return row[0]
+
+
+def get_channel_ids(volcano, conn):
+    """
+    Returns:
+    --------
+    channel_ids : dict
+        Channel id of each (station, channel) of the volcano.
+    """
+    query = """
+    SELECT
+        id, station, channel
+    FROM
+        channel
+    WHERE
+        volcano = %s
+    ORDER BY
+        id;
+    """
+    with conn:
+        cur = conn.cursor()
+        cur.execute(query, (volcano,))
+        rows = cur.fetchall()
+    channel_ids = {}
+    for channel_id, station, channel in rows:
+        channel_ids.setdefault((station, channel), channel_id)
+    return channel_ids
+
+
+def _check_event_starttime(cur, tables):
+    # Checked once per connection
+    checked = _event_starttime_tables.setdefault(cur.connection, set())
+    if checked.issuperset(tables):
+        return
+    cur.execute(
+        """
+        SELECT
+            table_name
+        FROM
+            information_schema.columns
+        WHERE
+            table_schema = current_schema()
+        AND
+            table_name = ANY(%s)
+        AND
+            column_name = 'event_starttime';
+        """,
+        (list(tables),)
+    )
+    found = set(row[0] for row in cur.fetchall())
+    missing = sorted(set(tables) - found)
+    if missing:
+        raise ValueError(
+            f'Column event_starttime missing in {", ".join(missing)}, '
+            'run tonus-db migrate'
+        )
+    checked.update(found)
+
+
+def check_event_starttime(tables, conn):
+    """
+    Raises a ValueError if the tables have not the event_starttime column
+    (the database is not migrated up to 0002_event_starttime, run tonus-db
+    migrate). The functions of this module that insert into them call it,
+    the column is looked up once per connection.
+
+    Parameters:
+    -----------
+    tables : list of str
+        E.g. ['coda', 'coda_peaks'].
+    conn : psycopg2 connection
+    """
+    with conn:
+        cur = conn.cursor()
+        _check_event_starttime(cur, tables)
+    return
+
+
+def insert_event(starttime, endtime, volcano_id, conn):
+    query = """
+    INSERT INTO
+        event(starttime, endtime, volcano_id)
+    VALUES
+        (%s, %s, %s)
+    RETURNING
+        id
+    """
+    with conn:
+        cur = conn.cursor()
+        _create_partitions(cur, starttime, starttime)
+        cur.execute(query, (starttime, endtime, volcano_id))
+        event_id = cur.fetchone()[0]
+    return event_id
+
+
+def insert_coda(
+    event_id, event_starttime, channel_id, t1, t2, t3, q_alpha, frequency,
+    amplitude, q_f, conn
+):
+    """
+    Insert the coda of a channel and all its peaks in one transaction,
+    event_starttime is the start time of the event (as inserted).
+    """
+    query_coda = """
+    INSERT INTO
+        coda(channel_id, t1, t2, t3, event_id, q_alpha, event_starttime)
+    VALUES
+        (%s, %s, %s, %s, %s, %s, %s)
+    RETURNING
+        id
+    """
+    query_peaks = """
+    INSERT INTO
+        coda_peaks(coda_id, frequency, amplitude, q_f, event_starttime)
+    VALUES
+        %s
+    """
+    with conn:
+        cur = conn.cursor()
+        _check_event_starttime(cur, ['coda', 'coda_peaks'])
+        if q_alpha is not None:
+            q_alpha = float(q_alpha)
+        cur.execute(
+            query_coda,
+            (channel_id, t1, t2, t3, event_id, q_alpha, event_starttime)
+        )
+        coda_id = cur.fetchone()[0]
+        values = [
+            (
+                coda_id, round(float(f), 3), float(a), round(float(q), 2),
+                event_starttime
+            )
+            for f, a, q in zip(frequency, amplitude, q_f)
+        ]
+        if values:
+            execute_values(cur, query_peaks, values)
+    return coda_id
+
+
+def get_or_insert_events(events, volcano_id, conn):
+    """
+    Event ids of a list of (starttime, endtime) windows of a volcano,
+    existing events with the same window (to the millisecond, as stored)
+    are reused (so that an interrupted batch can be resumed), the rest are
+    inserted, in one transaction.
+
+    Returns:
+    --------
+    event_ids : list of int
+    """
+    query_select = """
+    SELECT
+        id
+    FROM
+        event
+    WHERE
+        volcano_id = %s
+    AND
+        starttime = %s::timestamp(3)
+    AND
+        endtime = %s::timestamp(3)
+    ORDER BY
+        id
+    LIMIT 1;
+    """
+    query_insert = """
+    INSERT INTO
+        event(starttime, endtime, volcano_id)
+    VALUES
+        (%s, %s, %s)
+    RETURNING
+        id
+    """
+    event_ids = []
+    with conn:
+        cur = conn.cursor()
+        if events:
+            starttimes = [starttime for starttime, _ in events]
+            _create_partitions(cur, min(starttimes), max(starttimes))
+        for starttime, endtime in events:
+            cur.execute(query_select, (volcano_id, starttime, endtime))
+            row = cur.fetchone()
+            if row is None:
+                cur.execute(query_insert, (starttime, endtime, volcano_id))
+                row = cur.fetchone()
+            event_ids.append(row[0])
+    return event_ids
+
+
+def get_tremor_done(event_ids, conn, retry=()):
+    """
+    Parameters:
+    -----------
+    event_ids : list of int
+    conn : psycopg2 connection
+    retry : list of str
+        Statuses (see TREMOR_STATUSES) of the event channels to process
+        again, e.g. ['error', 'no data'].
+
+    Returns:
+    --------
+    done : set
+        (event_id, channel_id) pairs already processed (in the
+        tremor_status table, or with a row in the tremor table).
+    """
+    query = """
+    SELECT
+        event_id, channel_id
+    FROM
+        tremor_status
+    WHERE
+        event_id = ANY(%(event_ids)s)
+    AND
+        NOT status = ANY(%(retry)s)
+    UNION
+    SELECT
+        event_id, channel_id
+    FROM
+        tremor
+    WHERE
+        event_id = ANY(%(event_ids)s);
+    """
+    with conn:
+        cur = conn.cursor()
+        cur.execute(
+            query, dict(event_ids=list(event_ids), retry=list(retry))
+        )
+        done = set(cur.fetchall())
+    return done
+
+
+def insert_tremor(rows, conn, statuses=()):
+    """
+    Bulk insert into the tremor table, in one transaction with the status
+    of the event channels (tremor_status table, 'tremor' for the rows).
+
+    Parameters:
+    -----------
+    rows : list of dict
+        With the keys event_id, event_starttime (start time of the event,
+        as inserted), channel_id, starttime, endtime, fmin, fmax, fmean,
+        fstd, fmedian, n_harmonics, amplitude, lp_time, lp, odd and
+        harmonics.
+    statuses : list of (event_id, channel_id, status)
+        Status of the event channels processed without a tremor (see
+        TREMOR_STATUSES).
+    """
+    columns = [
+        'event_id', 'channel_id', 'starttime', 'endtime', 'fmin', 'fmax',
+        'fmean', 'fstd', 'fmedian', 'n_harmonics', 'amplitude', 'lp_time',
+        'lp', 'odd', 'harmonics', 'event_starttime'
+    ]
+    query = f"""
+    INSERT INTO
+        tremor({', '.join(columns)})
+    VALUES
+        %s
+    """
+    query_status = """
+    INSERT INTO
+        tremor_status(event_id, channel_id, status)
+    VALUES
+        %s
+    ON CONFLICT (event_id, channel_id) DO UPDATE SET
+        status = excluded.status, processed_at = now()
+    """
+    # One status per event channel (a channel with gaps has several rows)
+    status = {
+        (event_id, channel_id): _status
+        for event_id, channel_id, _status in statuses
+    }
+    for row in rows:
+        status[(row['event_id'], row['channel_id'])] = 'tremor'
+    if not status:
+        return
+    with conn:
+        cur = conn.cursor()
+        if rows:
+            _check_event_starttime(cur, ['tremor'])
+            values = [
+                tuple(row[column] for column in columns) for row in rows
+            ]
+            execute_values(cur, query, values)
+        execute_values(
+            cur, query_status,
+            [key + (_status,) for key, _status in status.items()]
+        )
+    return
+
+
+def list_migrations(directory):
+    """
+    Versioned SQL migrations of a directory, files named
+    <version>_<name>.sql (e.g. 0001_indexes.sql).
+
+    Returns:
+    --------
+    migrations : list of (version, name, filepath)
+        Sorted by version.
+    """
+    migrations = []
+    for filename in os.listdir(directory):
+        root, ext = os.path.splitext(filename)
+        version, _, name = root.partition('_')
+        if ext != '.sql' or not version.isdigit():
+            continue
+        migrations.append(
+            (int(version), name, os.path.join(directory, filename))
+        )
+    migrations.sort()
+    versions = [version for version, _, _ in migrations]
+    if len(set(versions)) != len(versions):
+        raise ValueError(f'Duplicate migration versions in {directory}')
+    return migrations
+
+
+def get_applied_migrations(conn):
+    """
+    Versions of the migrations applied to the database (schema_migrations
+    table, created if needed).
+
+    Returns:
+    --------
+    versions : set of int
+    """
+    query = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version int4 NOT NULL,
+        name varchar NULL,
+        applied_at timestamptz NOT NULL DEFAULT now(),
+        CONSTRAINT schema_migrations_pk PRIMARY KEY (version)
+    );
+    """
+    with conn:
+        cur = conn.cursor()
+        cur.execute(query)
+        cur.execute('SELECT version FROM schema_migrations;')
+        versions = set(row[0] for row in cur.fetchall())
+    return versions
+
+
+def migrate(directory, conn, target=None, dry_run=False):
+    """
+    Applies the pending migrations of a directory (see list_migrations) in
+    order of version, each one in its own transaction together with its
+    row in schema_migrations. A failed migration is rolled back and the
+    following ones are not applied. Concurrent runs wait for each other
+    (advisory lock).
+
+    Parameters:
+    -----------
+    directory : str
+        Directory of the SQL files.
+    conn : psycopg2 connection
+    target : int, optional
+        Last version to apply, all by default.
+    dry_run : bool
+        Only return the pending migrations.
+
+    Returns:
+    --------
+    migrations : list of (version, name, filepath)
+        Migrations applied (pending if dry_run).
+    """
+    get_applied_migrations(conn)
+
+    cur = conn.cursor()
+    cur.execute('SELECT pg_advisory_lock(%s);', (MIGRATIONS_LOCK,))
+    conn.commit()
+    try:
+        applied = get_applied_migrations(conn)
+        pending = [
+            migration for migration in list_migrations(directory)
+            if migration[0] not in applied
+            and (target is None or migration[0] <= target)
+        ]
+        if dry_run:
+            return pending
+
+        for version, name, filepath in pending:
+            logging.info(f'Applying migration {version} ({name})')
+            with open(filepath, 'r') as f:
+                sql = f.read()
+            with conn:
+                cur = conn.cursor()
+                cur.execute(sql)
+                cur.execute(
+                    'INSERT INTO schema_migrations(version, name) '
+                    'VALUES (%s, %s);',
+                    (version, name)
+                )
+    finally:
+        cur = conn.cursor()
+        cur.execute('SELECT pg_advisory_unlock(%s);', (MIGRATIONS_LOCK,))
+        conn.commit()
+    return pending
+
+
+def _partitions(starttime, endtime, interval):
+    """
+    (suffix, lower, upper) of the partitions covering [starttime, endtime],
+    e.g. ('2020_01', 2020-01-01, 2020-02-01).
+    """
+    if interval == 'year':
+        lower = datetime(starttime.year, 1, 1)
+    else:
+        lower = datetime(starttime.year, starttime.month, 1)
+    while lower <= endtime:
+        if interval == 'year':
+            upper = datetime(lower.year + 1, 1, 1)
+            suffix = f'{lower.year}'
+        else:
+            upper = datetime(
+                lower.year + lower.month // 12, lower.month % 12 + 1, 1
+            )
+            suffix = f'{lower.year}_{lower.month:02d}'
+        yield suffix, lower, upper
+        lower = upper
+
+
+def _get_partitioning(cur):
+    # The partitioning table is created by 0002_event_starttime
+    cur.execute("SELECT to_regclass('partitioning') IS NOT NULL;")
+    if not cur.fetchone()[0]:
+        return None
+    cur.execute('SELECT interval FROM partitioning;')
+    row = cur.fetchone()
+    return None if row is None else row[0]
+
+
+def get_partitioning(conn):
+    """
+    Returns:
+    --------
+    interval : str or None
+        Interval of the partitions ('month' or 'year'), None if the tables
+        are not partitioned (or the database is not migrated).
+    """
+    with conn:
+        cur = conn.cursor()
+        interval = _get_partitioning(cur)
+    return interval
+
+
+def _create_partitions(cur, starttime, endtime):
+    interval = _get_partitioning(cur)
+    if interval is None or starttime is None:
+        return []
+
+    # Rounded to milliseconds by the timestamp(3) columns
+    endtime += timedelta(milliseconds=1)
+
+    partitions = [
+        (f'{table}_{suffix}', table, lower, upper)
+        for suffix, lower, upper in _partitions(starttime, endtime, interval)
+        for table in PARTITIONED_TABLES
+    ]
+    cur.execute(
+        'SELECT name FROM unnest(%s) AS name WHERE to_regclass(name) IS NULL;',
+        ([name for name, _, _, _ in partitions],)
+    )
+    missing = set(row[0] for row in cur.fetchall())
+    created = []
+    for name, table, lower, upper in partitions:
+        if name not in missing:
+            continue
+        cur.execute(
+            f'CREATE TABLE {name} PARTITION OF {table} '
+            'FOR VALUES FROM (%s) TO (%s);',
+            (lower, upper)
+        )
+        created.append(name)
+    return created
+
+
+def create_partitions(starttime, endtime, conn):
+    """
+    Creates the missing partitions of the partitioned tables for the
+    events starting between starttime and endtime, if the tables are
+    partitioned (tonus-db partition). The functions of this module that
+    insert events call it, the rest must before inserting events.
+
+    Parameters:
+    -----------
+    starttime, endtime : datetime.datetime
+    conn : psycopg2 connection
+
+    Returns:
+    --------
+    created : list of str
+        Names of the partitions created.
+    """
+    with conn:
+        cur = conn.cursor()
+        created = _create_partitions(cur, starttime, endtime)
+    return created
+
+
+def partition_tables(sql, interval, conn):
+    """
+    Replaces the event, coda, coda_peaks and tremor tables by tables
+    partitioned by the start time of the events, and moves their rows to
+    the new tables, in one transaction (the tables are locked meanwhile).
+    The database must be migrated up to 0002_event_starttime.
+
+    Parameters:
+    -----------
+    sql : str
+        Definition of the partitioned tables (bin/partitioned.sql).
+    interval : str
+        Interval of the partitions, 'month' or 'year'.
+    conn : psycopg2 connection
+
+    Returns:
+    --------
+    partitions : list of str
+        Names of the partitions created.
+    """
+    if interval not in PARTITION_INTERVALS:
+        raise ValueError(f'Interval must be one of {PARTITION_INTERVALS}')
+    check_event_starttime(['coda', 'coda_peaks', 'tremor'], conn)
+    if get_partitioning(conn) is not None:
+        raise ValueError('The tables are already partitioned')
+
+    tables = list(PARTITIONED_TABLES)
+    with conn:
+        cur = conn.cursor()
+        cur.execute(
+            f'LOCK TABLE {", ".join(tables)} IN ACCESS EXCLUSIVE MODE;'
+        )
+        cur.execute('SELECT count(*) FROM event WHERE starttime IS NULL;')
+        n = cur.fetchone()[0]
+        if n > 0:
+            raise ValueError(f'{n} events without start time')
+
+        # Rename the tables and their indexes (and so their constraints)
+        for table in tables:
+            cur.execute(f'ALTER TABLE {table} RENAME TO {table}_heap;')
+            cur.execute(
+                'SELECT c.relname FROM pg_index AS i '
+                'INNER JOIN pg_class AS c ON c.oid = i.indexrelid '
+                'WHERE i.indrelid = %s::regclass;',
+                (f'{table}_heap',)
+            )
+            for (index,) in cur.fetchall():
+                cur.execute(f'ALTER INDEX {index} RENAME TO {index}_heap;')
+
+        cur.execute(sql)
+        cur.execute('INSERT INTO partitioning(interval) VALUES (%s);',
+                    (interval,))
+        cur.execute('SELECT min(starttime), max(starttime) FROM event_heap;')
+        partitions = _create_partitions(cur, *cur.fetchone())
+
+        queries = {
+            'event': """
+            INSERT INTO
+                event(id, starttime, endtime, volcano_id)
+            SELECT
+                id, starttime, endtime, volcano_id
+            FROM
+                event_heap;
+            """,
+            'coda': """
+            INSERT INTO
+                coda(channel_id, t1, t2, t3, event_id, q_alpha, id,
+                     event_starttime)
+            SELECT
+                c.channel_id, c.t1, c.t2, c.t3, c.event_id, c.q_alpha, c.id,
+                e.starttime
+            FROM
+                coda_heap AS c
+            INNER JOIN
+                event_heap AS e
+            ON
+                c.event_id = e.id;
+            """,
+            'coda_peaks': """
+            INSERT INTO
+                coda_peaks(frequency, amplitude, q_f, coda_id, id,
+                           event_starttime)
+            SELECT
+                p.frequency, p.amplitude, p.q_f, p.coda_id, p.id, e.starttime
+            FROM
+                coda_peaks_heap AS p
+            INNER JOIN
+                coda_heap AS c
+            ON
+                p.coda_id = c.id
+            INNER JOIN
+                event_heap AS e
+            ON
+                c.event_id = e.id;
+            """,
+            'tremor': """
+            INSERT INTO
+                tremor(id, event_id, channel_id, starttime, endtime, fmin,
+                       fmax, fmean, fstd, fmedian, n_harmonics, amplitude,
+                       lp_time, lp, odd, harmonics, event_starttime)
+            SELECT
+                t.id, t.event_id, t.channel_id, t.starttime, t.endtime,
+                t.fmin, t.fmax, t.fmean, t.fstd, t.fmedian, t.n_harmonics,
+                t.amplitude, t.lp_time, t.lp, t.odd, t.harmonics, e.starttime
+            FROM
+                tremor_heap AS t
+            INNER JOIN
+                event_heap AS e
+            ON
+                t.event_id = e.id;
+            """,
+        }
+        for table in tables:
+            cur.execute(queries[table])
+            n_moved = cur.rowcount
+            cur.execute(f'SELECT count(*) FROM {table}_heap;')
+            n = cur.fetchone()[0]
+            if n_moved < n:
+                logging.warning(
+                    f'{n - n_moved} rows of {table} without event dropped'
+                )
+            logging.info(f'{n_moved} rows of {table} moved')
+
+            # Keep the sequence of the ids
+            cur.execute(
+                f'ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id;'
+            )
+
+        cur.execute(
+            f'DROP TABLE {", ".join(f"{table}_heap" for table in tables)};'
+        )
+    return partitions
+
+
 if __name__ == '__main__':
     pass
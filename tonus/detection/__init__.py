@@ -8,6 +8,7 @@
 from . import obspy2numpy
 from . import preprocess
 from . import process
+from . import realtime
 
 
 __author__ = 'Leonardo van der Laat'
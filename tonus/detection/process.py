@@ -6,17 +6,22 @@
 
 
 # Python Standard Library
+import warnings
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
 
 # Other dependencies
 import numpy as np
-import pandas as pd
 
 from numba import jit
+from obspy import Trace
 from scipy.fft import rfft
 from scipy.signal.windows import tukey
-from tonus.detection.obspy2numpy import st2windowed_data
+from skimage.util.shape import view_as_windows
 
 # Local files
+from tonus.filters import BandpassFilter
 
 
 __author__ = 'Leonardo van der Laat'
@@ -113,6 +118,186 @@ def _get_cft(Sxx, k, _bin_width):
     return cft
 
 
+def _get_cft_topk(Sxx, k, _bin_width, chunk_size=4096):
+    """
+    Compute the characteristic function (Tonality) for spectral data.
+
+    Vectorized equivalent of _get_cft. Instead of sorting every spectrum,
+    the k coherent peaks are picked by repeated arg-max over a
+    non-maximum-suppression mask, i.e. after a peak is accepted the bins
+    within half a bin width around it are masked out for all frames at once.
+    The slices around the peaks are then gathered into a single
+    (n_frames, k, _bin_width) array and normalized and reduced to medians in
+    batch.
+
+    The output matches _get_cft within floating point rounding
+    (rtol=1e-12). The only other difference comes from spectra with exactly
+    tied amplitudes, where both functions may pick a different one of the
+    tied bins.
+
+    Parameters:
+    ----------
+    Sxx : numpy.ndarray
+        Input spectral data as an Nx2 numpy.ndarray.
+    k : int
+        Number of frequency peaks to identify.
+    _bin_width : float
+        Width of frequency bins for peak detection (in samples).
+    chunk_size : int
+        Number of frames processed at once, bounds the memory used.
+
+    Returns:
+    -------
+    cft : numpy.ndarray
+        Computed characteristic function (tonality) values
+    """
+    n_frames, n_bins = Sxx.shape
+    cft = np.zeros(n_frames, dtype=np.float64)
+
+    # Bins suppressed around an accepted peak: |i - idx| < _bin_width/2
+    reach = int(np.ceil(_bin_width/2)) - 1
+    offsets = np.arange(-reach, reach+1) if reach >= 0 else np.zeros(1, int)
+
+    # Positions inside the slice of each peak
+    p = np.arange(_bin_width)
+
+    for j0 in range(0, n_frames, chunk_size):
+        S = Sxx[j0:j0+chunk_size].astype(np.float64)
+        n = len(S)
+        rows = np.arange(n)
+
+        # Pick the peaks, highest first, suppressing their neighbourhood
+        masked = S.copy()
+        peaks = np.zeros((n, k), dtype=np.int64)
+        valid = np.zeros((n, k), dtype=bool)
+        for i in range(k):
+            idx = masked.argmax(axis=1)
+            valid[:, i] = masked[rows, idx] > -np.inf
+            peaks[:, i] = idx
+            cols = np.clip(idx[:, None] + offsets, 0, n_bins-1)
+            masked[rows[:, None], cols] = -np.inf
+            masked[rows, idx] = -np.inf
+
+        # Slice boundaries, int() truncates towards zero as in _get_cft
+        left = np.trunc(peaks - _bin_width/2).astype(np.int64)
+        right = np.trunc(peaks + _bin_width/2).astype(np.int64)
+        left_pad = np.maximum(-left, 0)
+        right_pad = np.maximum(right - n_bins + 1, 0)
+        left = np.maximum(left, 0)
+        right = np.minimum(right, n_bins-1)
+
+        # Gather the slices: (n, k, _bin_width)
+        src = left[..., None] + p - left_pad[..., None]
+        inside = (
+            (p >= left_pad[..., None]) &
+            (p < (left_pad + right - left)[..., None])
+        )
+        src = np.clip(src, 0, n_bins-1)
+        gathered = S[rows[:, None, None], src]
+        Sx_slice = np.where(inside, gathered, 0.)
+
+        # Pad slices beyond the spectrum edges with the median of the slice
+        padded = valid & ((left_pad > 0) | (right_pad > 0))
+        if padded.any():
+            _inside = inside[padded]
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                med = np.nanmedian(
+                    np.where(_inside, gathered[padded], np.nan), axis=1
+                )
+            fill = (
+                (p < left_pad[padded][:, None]) |
+                (p >= _bin_width - right_pad[padded][:, None]) &
+                (right_pad[padded][:, None] > 0)
+            )
+            Sx_slice[padded] = np.where(
+                fill, med[:, None], Sx_slice[padded]
+            )
+
+        # Normalize, median and tonality
+        with np.errstate(divide='ignore', invalid='ignore'):
+            Sx_slice /= Sx_slice.max(axis=2, keepdims=True)
+            med = np.median(Sx_slice, axis=2)
+            c = np.where(valid, 1/med, 0.)
+        cft[j0:j0+n] = c.sum(axis=1)
+    return cft
+
+
+def _get_cft_array(
+    data, sampling_rate, short_win, overlap, pad, k, bin_width, long_win
+):
+    """
+    Compute the smoothed characteristic function of a 1D array of samples.
+
+    Core of get_cft, works on plain arrays so that it can run on shared
+    memory in worker processes (see get_cft_parallel).
+
+    Parameters:
+    -----------
+    data : numpy.ndarray
+        1D array with the waveform samples.
+    sampling_rate : float
+        Sampling rate of the data (Hz).
+    short_win, overlap, pad, k, bin_width, long_win
+        See get_cft.
+
+    Returns:
+    --------
+    cft : numpy.ndarray
+        Characteristic function, one sample per short window.
+    """
+    # Slice the data into windows
+    window_pts = int(short_win * sampling_rate)
+    step = window_pts - int(window_pts * overlap)
+    n_windows = (len(data) - window_pts) // step + 1
+    data = data[:(n_windows - 1)*step + window_pts]
+    data_windowed = view_as_windows(data, window_pts, step)
+
+    # Cumulative tonality computation
+    cft = _get_tonality(data_windowed, sampling_rate, pad, k, bin_width)
+
+    # Smooth the characteristic function
+    delta = short_win - overlap*short_win
+    _long_win = int(long_win/delta)
+    return cft / _rolling_mean(cft, _long_win)
+
+
+def _get_tonality(data_windowed, sampling_rate, pad, k, bin_width):
+    """
+    Tonality of each window of a (n_windows, window_pts) array.
+    """
+    data_windowed = data_windowed.astype(float)
+    data_windowed *= tukey(data_windowed.shape[1], alpha=pad)  # taper
+
+    # Frequency array
+    freq = np.fft.rfftfreq(data_windowed.shape[1], 1/sampling_rate)
+
+    # Determine the bin width in samples
+    nyquist = sampling_rate/2
+    fft_sampling_rate = len(freq)/nyquist  # Samples per Hz
+    _bin_width = int(bin_width*fft_sampling_rate)
+
+    # FFT computation
+    Sxx = np.abs(rfft(data_windowed))
+
+    return _get_cft_topk(Sxx, k, _bin_width)
+
+
+def _rolling_mean(x, n):
+    """
+    Trailing mean over n samples, NaN for the first n-1 samples.
+
+    Each mean is computed from its own window only, so the result for a
+    sample does not depend on where the array starts (unlike a running sum).
+    This is what allows CFTStream to reproduce get_cft exactly.
+    """
+    n = max(n, 1)
+    mean = np.full(len(x), np.nan)
+    if len(x) >= n:
+        mean[n-1:] = view_as_windows(x, n).mean(axis=1)
+    return mean
+
+
 def get_cft(tr, short_win, overlap, pad, k, bin_width, long_win):
     """
     Compute the characteristic function (cumulative tonality)
@@ -143,41 +328,280 @@ def get_cft(tr, short_win, overlap, pad, k, bin_width, long_win):
     -----
     - This function modifies the input 'tr' object in-place.
     """
-    # Slice the data into windows
-    utcdatetimes, data_windowed = st2windowed_data(tr, short_win, overlap)
+    cft = _get_cft_array(
+        tr.data, tr.stats.sampling_rate, short_win, overlap, pad, k,
+        bin_width, long_win
+    )
+    _set_cft(tr, cft, short_win, overlap)
+    return
 
-    data_windowed = data_windowed[0]
-    data_windowed = data_windowed.astype(float)
-    data_windowed *= tukey(data_windowed.shape[1], alpha=pad)  # taper
 
-    # Frequency array
-    freq = np.fft.rfftfreq(data_windowed.shape[1], tr.stats.delta)
+def _set_cft(tr, cft, short_win, overlap):
+    """
+    Replace the data of the tr object by its characteristic function
+    """
+    delta = short_win - overlap*short_win
+    starttime = tr.stats.starttime + short_win/2  # Center of the 1st window
+    tr.data = cft
+    tr.stats.delta = delta
+    tr.stats.sampling_rate = 1/delta
+    tr.stats.starttime = starttime
+    return
 
-    # Determine the bin width in samples
-    nyquist = tr.stats.sampling_rate/2
-    fft_sampling_rate = len(freq)/nyquist  # Samples per Hz
-    _bin_width = int(bin_width*fft_sampling_rate)
 
-    # FFT computation
-    Sxx = np.abs(rfft(data_windowed))
+def _get_cft_shm(
+    shm_in_name, shm_out_name, in_offset, npts, out_offset, n_out,
+    sampling_rate, params
+):
+    """
+    Worker task of get_cft_parallel.
 
-    # Cumulative tonality computation
-    cft = _get_cft(Sxx, k, _bin_width)
+    Reads a trace from the input shared memory block and writes its
+    characteristic function into the output shared memory block, so that
+    neither the waveforms nor the results are pickled.
+    """
+    shm_in = SharedMemory(name=shm_in_name)
+    shm_out = SharedMemory(name=shm_out_name)
+    try:
+        data = np.ndarray(
+            (npts,), dtype=np.float64, buffer=shm_in.buf,
+            offset=in_offset*8
+        )
+        out = np.ndarray(
+            (n_out,), dtype=np.float64, buffer=shm_out.buf,
+            offset=out_offset*8
+        )
+        out[:] = _get_cft_array(data, sampling_rate, *params)
+        del data, out
+    finally:
+        shm_in.close()
+        shm_out.close()
+    return
 
-    # Smooth the characteristic function
-    delta = short_win - overlap*short_win
-    _long_win = int(long_win/delta)
-    cf = pd.Series(cft)
-    cft = cf / cf.rolling(_long_win).mean()
-    cft = cft.to_numpy()
 
-    # Replace data of the tr object
-    tr.data = cft
-    tr.stats.delta = delta
-    tr.stats.sampling_rate = 1/delta
-    tr.stats.starttime = utcdatetimes[0]
+def get_cft_parallel(
+    st, short_win, overlap, pad, k, bin_width, long_win, workers=None
+):
+    """
+    Compute the characteristic function of every trace of a stream in
+    parallel.
+
+    The traces are copied once into a shared memory block, each worker
+    process computes the characteristic function of one trace and writes it
+    into a second shared memory block. The results are identical to calling
+    get_cft on each trace.
+
+    Parameters:
+    -----------
+    st : obspy.Stream
+        The seismic data to analyze.
+    short_win, overlap, pad, k, bin_width, long_win
+        See get_cft.
+    workers : int
+        Number of worker processes. Defaults to the number of CPUs. With 1
+        worker the traces are processed serially, without shared memory.
+
+    Returns:
+    --------
+    None
+
+    Note:
+    -----
+    - This function modifies the traces of 'st' in-place.
+    """
+    if workers == 1 or len(st) < 2:
+        for tr in st:
+            get_cft(tr, short_win, overlap, pad, k, bin_width, long_win)
+        return
+
+    params = (short_win, overlap, pad, k, bin_width, long_win)
+
+    # Layout of the traces and of their characteristic functions
+    in_offsets, out_offsets, n_outs = [], [], []
+    in_size, out_size = 0, 0
+    for tr in st:
+        window_pts = int(short_win * tr.stats.sampling_rate)
+        step = window_pts - int(window_pts * overlap)
+        n_out = (tr.stats.npts - window_pts) // step + 1
+        in_offsets.append(in_size)
+        out_offsets.append(out_size)
+        n_outs.append(n_out)
+        in_size += tr.stats.npts
+        out_size += n_out
+
+    shm_in = SharedMemory(create=True, size=max(in_size, 1)*8)
+    shm_out = SharedMemory(create=True, size=max(out_size, 1)*8)
+    try:
+        data = np.ndarray((in_size,), dtype=np.float64, buffer=shm_in.buf)
+        for tr, in_offset in zip(st, in_offsets):
+            data[in_offset:in_offset+tr.stats.npts] = tr.data
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    _get_cft_shm, shm_in.name, shm_out.name, in_offset,
+                    tr.stats.npts, out_offset, n_out, tr.stats.sampling_rate,
+                    params
+                )
+                for tr, in_offset, out_offset, n_out in zip(
+                    st, in_offsets, out_offsets, n_outs
+                )
+            ]
+            for future in futures:
+                future.result()
+
+        out = np.ndarray((out_size,), dtype=np.float64, buffer=shm_out.buf)
+        for tr, out_offset, n_out in zip(st, out_offsets, n_outs):
+            cft = out[out_offset:out_offset+n_out].copy()
+            _set_cft(tr, cft, short_win, overlap)
+        del data, out
+    finally:
+        shm_in.close()
+        shm_in.unlink()
+        shm_out.close()
+        shm_out.unlink()
     return
 
 
+class CFTStream:
+    """
+    Incremental characteristic function (cumulative tonality).
+
+    Takes successive, contiguous chunks of a waveform and returns only the
+    new characteristic function samples. The state needed to continue the
+    computation is carried over between chunks: the samples of the partial
+    short window, the Butterworth bandpass filter state and the last
+    characteristic function values of the long window mean. Memory does not
+    grow with the length of the data.
+
+    The concatenated output is identical to calling
+    tonus.detection.preprocess.butter_bandpass_filter (when freqmin,
+    freqmax and order are given) and get_cft on the concatenated chunks.
+
+    Parameters:
+    -----------
+    short_win, overlap, pad, k, bin_width, long_win
+        See get_cft.
+    freqmin : float, optional
+        Lower frequency of the bandpass filter (Hz).
+    freqmax : float, optional
+        Higher frequency of the bandpass filter (Hz).
+    order : int, optional
+        Order of the bandpass filter.
+
+    Example:
+    --------
+    >>> stream = CFTStream(10, 0.9, 0.1, 3, 1, 60, 3, 16, 4)
+    >>> for tr in chunks:
+    >>>     cft = stream.process(tr)
+    """
+    def __init__(
+        self, short_win, overlap, pad, k, bin_width, long_win,
+        freqmin=None, freqmax=None, order=None
+    ):
+        self.short_win = short_win
+        self.overlap = overlap
+        self.pad = pad
+        self.k = k
+        self.bin_width = bin_width
+        self.long_win = long_win
+        self.freqmin = freqmin
+        self.freqmax = freqmax
+        self.order = order
+
+        self.delta = short_win - overlap*short_win
+        self._long_win = max(int(long_win/self.delta), 1)
+
+        self.sampling_rate = None
+        self.starttime = None  # Start of the first chunk
+        self.endtime = None  # Expected time of the next sample
+        self._filter = None
+        self._buffer = np.zeros(0)
+        self._history = np.zeros(0)
+        self._n_frames = 0
+
+    def _start(self, tr):
+        self.sampling_rate = tr.stats.sampling_rate
+        self.starttime = tr.stats.starttime
+        self.endtime = tr.stats.starttime
+        self.window_pts = int(self.short_win * self.sampling_rate)
+        self.step = self.window_pts - int(self.window_pts * self.overlap)
+
+        if self.freqmin is not None:
+            self._filter = BandpassFilter(
+                self.sampling_rate, self.freqmin, self.freqmax, self.order
+            )
+
+    def process(self, tr):
+        """
+        Process the next chunk of data.
+
+        Parameters:
+        -----------
+        tr : obspy.Trace
+            Chunk of waveform, must start one sample after the end of the
+            previous chunk.
+
+        Returns:
+        --------
+        cft : obspy.Trace
+            The new characteristic function samples (may be empty).
+        """
+        if self.sampling_rate is None:
+            self._start(tr)
+        elif tr.stats.sampling_rate != self.sampling_rate:
+            raise ValueError(
+                f'Sampling rate changed from {self.sampling_rate} to '
+                f'{tr.stats.sampling_rate}'
+            )
+        elif abs(tr.stats.starttime - self.endtime) > .5/self.sampling_rate:
+            raise ValueError(
+                f'Chunk starting at {tr.stats.starttime} is not contiguous, '
+                f'expected {self.endtime}'
+            )
+        self.endtime = tr.stats.starttime + tr.stats.npts/self.sampling_rate
+
+        data = tr.data.astype(np.float64)
+        if self._filter is not None:
+            data = self._filter.process(data)
+
+        # Complete windows available
+        data = np.concatenate([self._buffer, data])
+        n_windows = max((len(data) - self.window_pts) // self.step + 1, 0)
+
+        stats = tr.stats.copy()
+        stats.delta = self.delta
+        stats.sampling_rate = 1/self.delta
+        stats.starttime = (
+            self.starttime + self.short_win/2 + self._n_frames*self.delta
+        )
+
+        stats.npts = n_windows
+
+        if n_windows == 0:
+            self._buffer = data
+            return Trace(data=np.zeros(0), header=stats)
+
+        data_windowed = view_as_windows(
+            data[:(n_windows - 1)*self.step + self.window_pts],
+            self.window_pts,
+            self.step
+        )
+        cft = _get_tonality(
+            data_windowed, self.sampling_rate, self.pad, self.k,
+            self.bin_width
+        )
+
+        # Smooth with the long window mean, carrying the last values over
+        cf = np.concatenate([self._history, cft])
+        mean = _rolling_mean(cf, self._long_win)[len(self._history):]
+
+        self._history = cf[max(len(cf) - (self._long_win - 1), 0):]
+        self._buffer = data[n_windows*self.step:].copy()
+        self._n_frames += n_windows
+
+        return Trace(data=cft / mean, header=stats)
+
+
 if __name__ == '__main__':
     pass
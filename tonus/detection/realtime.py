@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+
+
+"""
+Real-time detection of tonal signals.
+
+Waveforms are polled from a waveserver client (tonus.waveserver.connect) or
+from a directory where files are dropped, the characteristic function of
+each channel is updated incrementally (tonus.detection.process.CFTStream)
+and a network coincidence trigger emits the events as soon as they close.
+"""
+
+
+# Python Standard Library
+import logging
+import os
+import time
+
+from fnmatch import fnmatch
+
+# Other dependencies
+import numpy as np
+
+from obspy import read, Stream, UTCDateTime
+
+# Local files
+from tonus.detection.process import CFTStream
+
+
+__author__ = 'Leonardo van der Laat'
+__email__ = 'lvmzxc@gmail.com'
+
+
+class WaveserverSource:
+    """
+    Polls a waveserver client for the data since the previous poll.
+
+    The last sample received of each channel is kept, and each poll
+    requests the data from the earliest of them, so that the data that
+    reaches the server late is requested again (the data already received
+    is trimmed by the Detector). A channel without new data for max_latency
+    seconds is given up until then: its data is requested from the end of
+    the last poll on.
+
+    Parameters:
+    -----------
+    client : obspy client
+        FDSN or Earthworm client (see tonus.waveserver.connect).
+    network, station, location, channel : list of str
+        Codes requested, wildcards are allowed.
+    delay : float
+        Seconds behind real time requested, to let the server receive the
+        data.
+    lookback : float
+        Seconds of data requested in the first poll.
+    max_latency : float
+        Seconds a channel is waited for.
+    """
+    def __init__(
+        self, client, network, station, location, channel, delay=10,
+        lookback=600, max_latency=300
+    ):
+        self.client = client
+        self.network = network
+        self.station = station
+        self.location = location
+        self.channel = channel
+        self.delay = delay
+        self.max_latency = max_latency
+        # Start of the data of the channels not received yet
+        self.starttime = UTCDateTime() - delay - lookback
+        # Time of the next sample of each channel
+        self.cursors = {}
+
+    def poll(self):
+        """
+        Returns:
+        --------
+        st : obspy.Stream
+            New data (and the data already received of the channels
+            requested again).
+        backlog : float
+            Seconds of data requested.
+        """
+        endtime = UTCDateTime() - self.delay
+        starttime = min(self.cursors.values(), default=self.starttime)
+        backlog = endtime - starttime
+        if backlog <= 0:
+            return Stream(), 0
+        try:
+            st = self.client.get_waveforms(
+                ','.join(self.network),
+                ','.join(self.station),
+                ','.join(self.location),
+                ','.join(self.channel),
+                starttime,
+                endtime
+            )
+        except Exception as e:
+            logging.warning(e)
+            return Stream(), backlog
+
+        for tr in st:
+            cursor = tr.stats.endtime + tr.stats.delta
+            self.cursors[tr.id] = max(cursor, self.cursors.get(tr.id, cursor))
+        for tr_id, cursor in self.cursors.items():
+            if endtime - cursor > self.max_latency:
+                logging.warning(
+                    f'{tr_id}: no data since {cursor} (more than '
+                    f'{self.max_latency:.0f} s), skipped to {endtime}'
+                )
+                self.cursors[tr_id] = endtime
+        self.starttime = max(self.starttime, endtime - self.max_latency)
+        return st, backlog
+
+
+class FileDropSource:
+    """
+    Polls a directory for new waveform files.
+
+    Files are read once, when their modification time is older than
+    'settle' seconds (so that files being written are not read).
+
+    Parameters:
+    -----------
+    directory : str
+        Directory watched.
+    settle : float
+        Seconds since the last modification of a file before reading it.
+    """
+    def __init__(self, directory, settle=2):
+        self.directory = directory
+        self.settle = settle
+        self.seen = set()
+
+    def poll(self):
+        """
+        Returns:
+        --------
+        st : obspy.Stream
+            Data of the new files.
+        backlog : int
+            Number of files still being written.
+        """
+        st = Stream()
+        backlog = 0
+        now = time.time()
+        for entry in sorted(os.scandir(self.directory), key=lambda e: e.name):
+            if not entry.is_file() or entry.path in self.seen:
+                continue
+            if now - entry.stat().st_mtime < self.settle:
+                backlog += 1
+                continue
+            self.seen.add(entry.path)
+            try:
+                st += read(entry.path)
+            except Exception as e:
+                logging.warning(f'{entry.path}: {e}')
+        return st, backlog
+
+
+class CoincidenceTrigger:
+    """
+    Incremental network coincidence trigger.
+
+    Equivalent to obspy.signal.trigger.coincidence_trigger (with
+    trigger_type=None) for characteristic functions that arrive in chunks.
+    Single station triggers are switched on at thr_on and off at thr_off,
+    an event is emitted once all its overlapping single station triggers
+    are closed and no later data can join it.
+
+    Parameters:
+    -----------
+    thr_on, thr_off, thr_coincidence_sum, max_trigger_length,
+    delete_long_trigger, trigger_off_extension
+        See obspy.signal.trigger.coincidence_trigger.
+    timeout : float
+        Seconds (wall clock) without new data after which a channel stops
+        holding back the events.
+    """
+    def __init__(
+        self, thr_on, thr_off, thr_coincidence_sum, max_trigger_length=1e6,
+        delete_long_trigger=False, trigger_off_extension=0, timeout=300
+    ):
+        self.thr_on = thr_on
+        self.thr_off = thr_off
+        self.thr_coincidence_sum = thr_coincidence_sum
+        self.max_trigger_length = max_trigger_length
+        self.delete_long_trigger = delete_long_trigger
+        self.trigger_off_extension = trigger_off_extension
+        self.timeout = timeout
+
+        self.channels = {}  # Single station trigger state
+        self.triggers = []  # Closed single station triggers (on, off, id)
+        self.last_off_time = 0.
+
+    def _single_station(self, tr):
+        # Same as obspy.signal.trigger.trigger_onset: a trigger starts where
+        # the CFT rises to thr_on and lasts while it stays at thr_off or
+        # above. A trigger longer than max_trigger_length is cut (a new one
+        # can start at the next rise to thr_on) or, with
+        # delete_long_trigger, dropped until the CFT falls below thr_off.
+        state = self.channels.setdefault(
+            tr.id, dict(
+                on=None, last=None, n=0, above=False, blocked=False,
+                end=None, updated=None
+            )
+        )
+        delta = tr.stats.delta
+        max_len = int(
+            self.max_trigger_length * tr.stats.sampling_rate + 0.5
+        )
+        t0 = tr.stats.starttime.timestamp
+
+        for i, value in enumerate(tr.data):
+            t = t0 + i*delta
+            above = value >= self.thr_on
+            onset = above and not state['above']
+            state['above'] = above
+
+            if state['on'] is not None:
+                state['n'] += 1
+                if value < self.thr_off:
+                    self._close(tr.id, state['on'], state['last'])
+                    state['on'] = None
+                    continue
+                state['last'] = t
+                if state['n'] <= max_len:
+                    continue
+                if self.delete_long_trigger:
+                    state['blocked'] = True
+                else:
+                    self._close(
+                        tr.id, state['on'], state['on'] + max_len*delta
+                    )
+                state['on'] = None
+
+            if value < self.thr_off:
+                state['blocked'] = False
+            if onset and not state['blocked']:
+                state['on'], state['last'], state['n'] = t, t, 0
+
+        if tr.stats.npts > 0:
+            state['end'] = t0 + (tr.stats.npts - 1)*delta
+            state['updated'] = time.time()
+
+    def _close(self, tr_id, on, off):
+        self.triggers.append((on, off, tr_id))
+        self.triggers.sort()
+
+    def _safe_time(self):
+        """
+        No trigger can start before this time anymore.
+        """
+        now = time.time()
+        times = []
+        for state in self.channels.values():
+            if state['end'] is None or now - state['updated'] > self.timeout:
+                continue
+            if state['on'] is not None:
+                times.append(state['on'])
+            else:
+                times.append(state['end'])
+        if not times:
+            return -np.inf
+        return min(times)
+
+    def process(self, st):
+        """
+        Process new characteristic function samples.
+
+        Parameters:
+        -----------
+        st : obspy.Stream
+            New samples of the characteristic functions.
+
+        Returns:
+        --------
+        events : list of dict
+            Events closed, same format as coincidence_trigger.
+        """
+        for tr in st:
+            self._single_station(tr)
+
+        safe_time = self._safe_time()
+        events = []
+        while self.triggers:
+            on, off, tr_id = self.triggers[0]
+            event = dict(
+                time=UTCDateTime(on),
+                stations=[tr_id.split('.')[1]],
+                trace_ids=[tr_id],
+                coincidence_sum=1.,
+            )
+            for tmp_on, tmp_off, tmp_tr_id in self.triggers[1:]:
+                if tmp_tr_id in event['trace_ids']:
+                    continue
+                if tmp_on > off + self.trigger_off_extension:
+                    break
+                event['stations'].append(tmp_tr_id.split('.')[1])
+                event['trace_ids'].append(tmp_tr_id)
+                event['coincidence_sum'] += 1
+                off = max(off, tmp_off)
+
+            # Wait, a trigger still to come could join this event
+            if off + self.trigger_off_extension >= safe_time:
+                break
+
+            self.triggers.pop(0)
+            if event['coincidence_sum'] < self.thr_coincidence_sum:
+                continue
+            if off <= self.last_off_time:
+                continue
+            event['duration'] = off - on
+            events.append(event)
+            self.last_off_time = off
+        return events
+
+    @property
+    def pending(self):
+        return len(self.triggers)
+
+
+class Detector:
+    """
+    Incremental tonal signal detector.
+
+    Keeps one CFTStream per channel and a CoincidenceTrigger. Chunks that
+    overlap data already processed are trimmed, a gap restarts the
+    characteristic function of the channel.
+
+    Parameters:
+    -----------
+    c : tonus.config.Conf
+        The 'detect' section of the configuration.
+    """
+    def __init__(self, c):
+        self.c = c
+        self.streams = {}
+        self.trigger = CoincidenceTrigger(
+            c.trigger.thr_on,
+            c.trigger.thr_off,
+            c.trigger.thr_coincidence_sum,
+            max_trigger_length=c.trigger.max_trigger_length,
+            delete_long_trigger=c.trigger.delete_long_trigger,
+        )
+
+    def _new_stream(self):
+        return CFTStream(
+            self.c.window.short_win,
+            self.c.window.overlap,
+            self.c.window.pad,
+            self.c.tonality.k,
+            self.c.tonality.bin_width,
+            self.c.window.long_win,
+            **self.c.filter
+        )
+
+    def _select(self, st):
+        _st = Stream()
+        for tr in st:
+            if not any(fnmatch(tr.stats.station, s)
+                       for s in self.c.waveforms.station):
+                continue
+            if not any(fnmatch(tr.stats.channel, c)
+                       for c in self.c.waveforms.channel):
+                continue
+            _st += tr
+        _st.merge(fill_value='interpolate', interpolation_samples=-1)
+        _st.sort(keys=['starttime'])
+        return _st
+
+    def process(self, st):
+        """
+        Parameters:
+        -----------
+        st : obspy.Stream
+            New waveforms.
+
+        Returns:
+        --------
+        events : list of dict
+            Events closed, same format as coincidence_trigger.
+        """
+        cft = Stream()
+        for tr in self._select(st):
+            stream = self.streams.get(tr.id)
+            if stream is None:
+                stream = self.streams[tr.id] = self._new_stream()
+            elif stream.endtime is not None:
+                # Drop the samples already processed
+                tr = tr.slice(starttime=stream.endtime)
+                if tr.stats.npts == 0:
+                    continue
+            try:
+                cft += stream.process(tr)
+            except ValueError as e:
+                logging.warning(f'{tr.id}: {e}. Restarting.')
+                stream = self.streams[tr.id] = self._new_stream()
+                cft += stream.process(tr)
+        return self.trigger.process(cft)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+
+"""
+Butterworth bandpass filters shared by the pre-processing of the detection
+and of the analysis.
+
+The filters are designed once per (sampling rate, band, order) and applied
+as second-order sections (numerically stable at high orders and low corner
+frequencies, unlike the transfer function coefficients), to all the traces
+of a stream with the same sampling rate and length at once. BandpassFilter
+carries the state of the filter between the successive chunks of a
+stream.
+"""
+
+
+# Python Standard Library
+from functools import lru_cache
+
+# Other dependencies
+import numpy as np
+
+from obspy import Trace
+from scipy.signal import butter, sosfilt, sosfiltfilt
+
+# Local files
+
+
+__author__ = 'Leonardo van der Laat'
+__email__ = 'lvmzxc@gmail.com'
+
+
+@lru_cache(maxsize=128)
+def design_bandpass(sampling_rate, freqmin, freqmax, order):
+    """
+    Second-order sections of a Butterworth bandpass filter (array of shape
+    (n_sections, 6), cached, must not be modified).
+
+    Parameters:
+    -----------
+    sampling_rate : float
+        Sampling rate (Hz).
+    freqmin, freqmax : float
+        Corner frequencies (Hz).
+    order : int
+        Order of the filter.
+    """
+    nyquist = .5 * sampling_rate
+    return butter(
+        order, [freqmin/nyquist, freqmax/nyquist], btype='band', output='sos'
+    )
+
+
+@lru_cache(maxsize=128)
+def design_highpass(sampling_rate, freq, order=4):
+    """
+    Second-order sections of a Butterworth highpass filter, same as
+    obspy.signal.filter.highpass (cached, must not be modified).
+    """
+    freq = freq / (.5 * sampling_rate)
+    if freq > 1:
+        raise ValueError('Selected corner frequency is above Nyquist.')
+    return butter(order, freq, btype='highpass', output='sos')
+
+
+def bandpass(data, sampling_rate, freqmin, freqmax, order, zerophase=False):
+    """
+    Filters the last axis of an array.
+
+    Parameters:
+    -----------
+    data : numpy.ndarray
+        Waveform (1-D) or waveforms (2-D, one per row).
+    sampling_rate, freqmin, freqmax, order
+        See design_bandpass.
+    zerophase : bool
+        Filter forward and backward (sosfiltfilt), without phase shift and
+        with the squared amplitude response.
+
+    Returns:
+    --------
+    data : numpy.ndarray
+        Filtered array (float64), same shape as data.
+    """
+    sos = design_bandpass(sampling_rate, freqmin, freqmax, order)
+    data = np.asarray(data, dtype=np.float64)
+    if zerophase:
+        return sosfiltfilt(sos, data, axis=-1)
+    return sosfilt(sos, data, axis=-1)
+
+
+def bandpass_stream(st, freqmin, freqmax, order, zerophase=False):
+    """
+    Filters the traces of a stream (or a trace) in place, the traces with
+    the same sampling rate and number of samples as one 2-D array.
+
+    Parameters:
+    -----------
+    st : obspy.Stream or obspy.Trace
+        Modified in place.
+    freqmin, freqmax, order, zerophase
+        See bandpass.
+    """
+    if isinstance(st, Trace):
+        st = [st]
+
+    groups = {}
+    for tr in st:
+        key = (tr.stats.sampling_rate, tr.stats.npts)
+        groups.setdefault(key, []).append(tr)
+
+    for (sampling_rate, npts), traces in groups.items():
+        if npts == 0:
+            continue
+        if len(traces) == 1:
+            data = traces[0].data
+        else:
+            data = np.vstack([tr.data for tr in traces])
+        data = bandpass(
+            data, sampling_rate, freqmin, freqmax, order, zerophase
+        )
+        if len(traces) == 1:
+            traces[0].data = data
+            continue
+        for tr, _data in zip(traces, data):
+            tr.data = _data
+    return
+
+
+class BandpassFilter:
+    """
+    Causal bandpass filter of a stream of contiguous chunks, the output of
+    the concatenated chunks is the same as filtering the whole waveform
+    (with bandpass, zerophase=False).
+
+    Parameters:
+    -----------
+    sampling_rate, freqmin, freqmax, order
+        See design_bandpass.
+
+    Example:
+    --------
+    >>> f = BandpassFilter(100, 1, 16, 4)
+    >>> for data in chunks:
+    >>>     filtered = f.process(data)
+    """
+    def __init__(self, sampling_rate, freqmin, freqmax, order):
+        self.sos = design_bandpass(sampling_rate, freqmin, freqmax, order)
+        self.zi = None
+
+    def process(self, data):
+        """
+        Filters the next chunk, a 1-D array (or 2-D, one channel per row,
+        with the same channels in every chunk).
+        """
+        data = np.asarray(data, dtype=np.float64)
+        if self.zi is None:
+            self.zi = np.zeros(
+                (self.sos.shape[0],) + data.shape[:-1] + (2,)
+            )
+        data, self.zi = sosfilt(self.sos, data, axis=-1, zi=self.zi)
+        return data
+
+    def reset(self):
+        self.zi = None
+
+
+if __name__ == '__main__':
+    pass
@@ -41,6 +41,9 @@ class AppCoda(tk.Toplevel):
             self.df_files = master.df_files
         self.event_type = 'coda'
 
+        # Downloads in the background
+        self.fetcher = tonus.gui.utils.Fetcher(self)
+
         self.wm_title('tonus - tonal coda')
         self.font_title = master.font_title
         self.bd = master.bd
@@ -271,6 +274,14 @@ class AppCoda(tk.Toplevel):
         def submit(self):
             submitted = False
 
+            try:
+                tonus.database.check_event_starttime(
+                    ['coda', 'coda_peaks'], self.master.conn
+                )
+            except ValueError as e:
+                tk.messagebox.showerror('Database not migrated', e)
+                return
+
             cur = self.master.conn.cursor()
 
             # Clean channels not picked
@@ -298,13 +309,20 @@ class AppCoda(tk.Toplevel):
                 starttime = min(starttimes).datetime
                 endtime = max(endtimes).datetime
 
+                tonus.database.create_partitions(
+                    starttime, starttime, self.master.conn
+                )
                 sql_str = f"""
                 INSERT INTO event(starttime, endtime, volcano_id)
                 VALUES('{starttime}', '{endtime}', {volcano_id})
-                RETURNING id
+                RETURNING id, starttime
                 """
                 cur.execute(sql_str)
-                self.master.event_id = cur.fetchone()[0]
+                (
+                    self.master.event_id, self.master.event_starttime
+                ) = cur.fetchone()
+
+            event_starttime = self.master.event_starttime
 
             for stacha in self.master.results.keys():
                 station, channel = stacha.split()
@@ -324,10 +342,11 @@ class AppCoda(tk.Toplevel):
 
                 sql_str = f"""
                 INSERT INTO
-                    coda(channel_id, t1, t2, t3, event_id, q_alpha)
+                    coda(channel_id, t1, t2, t3, event_id, q_alpha,
+                    event_starttime)
                 VALUES(
                     {channel_id}, '{t1}', '{t2}', '{t3}',
-                    {self.master.event_id}, {q_alpha}
+                    {self.master.event_id}, {q_alpha}, '{event_starttime}'
                 )
                 RETURNING
                     id
@@ -345,10 +364,10 @@ class AppCoda(tk.Toplevel):
                             f"""
                             INSERT INTO
                                 coda_peaks(coda_id, frequency,
-                                amplitude, q_f)
+                                amplitude, q_f, event_starttime)
                             VALUES(
                                 {coda_id}, {round(f, 3)},
-                                {a}, {round(q, 2)})
+                                {a}, {round(q, 2)}, '{event_starttime}')
                             """
                         )
                     submitted = True
@@ -394,11 +413,12 @@ class AppCoda(tk.Toplevel):
 
         if len(df) > 0:
             self.event_id = df.id.to_list()[0]
+            self.event_starttime = df.starttime.to_list()[0]
 
             df = pd.read_sql_query(
                 f"""
                 SELECT * FROM coda
-                WHERE event_id = {self.event_id} ;
+                WHERE event_id = {self.event_id};
                 """,
                 self.conn
             )
@@ -433,6 +453,7 @@ class AppCoda(tk.Toplevel):
                 tk.messagebox.showwarning('Event in database', text)
         else:
             self.event_id = None
+            self.event_starttime = None
 
     def _select_trace(self, event):
         tonus.gui.utils.select_trace(self)
@@ -567,7 +588,10 @@ class AppCoda(tk.Toplevel):
             float(self.frm_process.freqmax_ent.get()),
             int(self.frm_process.order_ent.get()),
             factor,
-            distance_Hz=float(self.frm_process.distance_Hz_ent.get())
+            distance_Hz=float(self.frm_process.distance_Hz_ent.get()),
+            rms_window=self.c.process.coda.get('rms_window', 2),
+            rms_step=self.c.process.coda.get('rms_step', 1),
+            envelope=self.c.process.coda.get('envelope', 'rms'),
         )
 
         # Output
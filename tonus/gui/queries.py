@@ -1,11 +1,116 @@
 # Python Standard Library
+import itertools
+import weakref
 
 # Other dependencies
 import pandas as pd
 
+from obspy import UTCDateTime
+
 # Local files
 
+
+EVENT_TYPES = ['coda', 'tremor']
+
+# Rows fetched from the server at a time by the streaming queries
+CHUNKSIZE = 50000
+
+# Statements prepared in each connection
+_prepared = weakref.WeakKeyDictionary()
+
+# Names of the server-side cursors
+_cursor_ids = itertools.count()
+
+
+def _check_event_type(event_type):
+    # Table name, can not be a bound parameter
+    if event_type not in EVENT_TYPES:
+        raise ValueError(f'Event type must be one of {EVENT_TYPES}')
+
+
+def _execute_prepared(name, query, params, conn):
+    """
+    Executes a statement prepared once per connection (parsed and planned
+    by the server once, afterwards only the parameters are sent), the
+    parameters in the query as $1, $2...
+
+    Returns:
+    --------
+    df : pandas.DataFrame
+    """
+    prepared = _prepared.setdefault(conn, set())
+    cur = conn.cursor()
+    if name not in prepared:
+        cur.execute(f'PREPARE {name} AS {query}')
+        prepared.add(name)
+    if params:
+        placeholders = ', '.join(['%s'] * len(params))
+        cur.execute(f'EXECUTE {name} ({placeholders});', params)
+    else:
+        cur.execute(f'EXECUTE {name};')
+    columns = [column.name for column in cur.description]
+    return pd.DataFrame.from_records(cur.fetchall(), columns=columns)
+
+
+def _iter_query(query, params, conn, chunksize=CHUNKSIZE):
+    """
+    Streams the results of a query from a server-side (named) cursor, so
+    that only chunksize rows are held in memory at a time.
+
+    Yields:
+    -------
+    df : pandas.DataFrame
+        Chunks of at most chunksize rows (one empty chunk if there are no
+        results).
+    """
+    cur = conn.cursor(name=f'tonus_queries_{next(_cursor_ids)}')
+    cur.itersize = chunksize
+    try:
+        cur.execute(query, params)
+        n = 0
+        while True:
+            rows = cur.fetchmany(chunksize)
+            if n > 0 and not rows:
+                break
+            columns = [column.name for column in cur.description]
+            yield pd.DataFrame.from_records(
+                rows, columns=columns, coerce_float=True
+            )
+            n += len(rows)
+            if len(rows) < chunksize:
+                break
+    finally:
+        cur.close()
+
+
+def _time_bounds(column, starttime=None, endtime=None):
+    """
+    Conditions on a time column, so that only the partitions of the time
+    range are scanned when the tables are partitioned (tonus-db
+    partition). Empty without bounds.
+    """
+    conditions = ''
+    if starttime is not None:
+        conditions += f' AND {column} >= %(starttime)s'
+    if endtime is not None:
+        conditions += f' AND {column} < %(endtime)s'
+    return conditions
+
+
+def _params(channel_ids, starttime=None, endtime=None):
+    if starttime is not None:
+        starttime = UTCDateTime(starttime).datetime
+    if endtime is not None:
+        endtime = UTCDateTime(endtime).datetime
+    return dict(
+        channel_ids=[int(channel_id) for channel_id in channel_ids],
+        starttime=starttime,
+        endtime=endtime,
+    )
+
+
 def get_volcanoes_with_event(event_type, conn):
+    _check_event_type(event_type)
     query = f"""
     WITH
         volcano_ids
@@ -34,11 +139,14 @@ def get_volcanoes_with_event(event_type, conn):
         volcano_ids
     );
     """
-
-    return pd.read_sql_query(query, conn).volcano.tolist()
+    df = _execute_prepared(
+        f'tonus_volcanoes_with_{event_type}', query, (), conn
+    )
+    return df.volcano.tolist()
 
 
 def get_stacha_with_event(volcano, event_type, conn):
+    _check_event_type(event_type)
     query = f"""
     SELECT
         channel.station, channel.channel, channel.id
@@ -55,7 +163,7 @@ def get_stacha_with_event(volcano, event_type, conn):
     ON
         station.volcano_id = volcano.id
     WHERE
-        volcano.volcano = '{volcano}'
+        volcano.volcano = $1
     AND EXISTS (
         SELECT 1 FROM
             {event_type}
@@ -63,11 +171,13 @@ def get_stacha_with_event(volcano, event_type, conn):
         {event_type}.channel_id = channel.id LIMIT 1
     );
     """
-    df = pd.read_sql_query(query, conn)
+    df = _execute_prepared(
+        f'tonus_stacha_with_{event_type}', query, (volcano,), conn
+    )
     return df.station.tolist(), df.channel.tolist(), df.id.tolist()
 
 
-def _get_coda_data(channel_ids, conn):
+def _coda_queries(starttime=None, endtime=None):
     query = f"""
     SELECT
         coda.t1, coda.t2, coda.t3,
@@ -89,15 +199,12 @@ def _get_coda_data(channel_ids, conn):
         coda.channel_id = channel.id
 
     WHERE
-        coda.channel_id IN ({','.join(channel_ids)});
+        coda.channel_id = ANY(%(channel_ids)s)
+    {_time_bounds('coda.event_starttime', starttime, endtime)}
+    {_time_bounds('coda_peaks.event_starttime', starttime, endtime)};
     """
 
-    df = pd.read_sql_query(query, conn)
-
-    # for t in 't1 t2 t3'.split():
-        # df[t] = df[t].dt.tz_convert('America/Guatemala')
-
-    query = f"""
+    query_hist = f"""
     SELECT
         event.starttime, event.id, coda.channel_id
     FROM
@@ -108,19 +215,15 @@ def _get_coda_data(channel_ids, conn):
     ON
         coda.event_id = event.id
 
-    INNER JOIN
-        channel
-    ON
-        coda.channel_id = channel.id
-
     WHERE
-        coda.channel_id IN ({','.join(channel_ids)});
+        coda.channel_id = ANY(%(channel_ids)s)
+    {_time_bounds('coda.event_starttime', starttime, endtime)}
+    {_time_bounds('event.starttime', starttime, endtime)};
     """
-    hist = pd.read_sql_query(query, conn)
-    return df, hist
+    return query, query_hist
 
 
-def _get_tremor_data(channel_ids, conn):
+def _tremor_queries(starttime=None, endtime=None):
     query = f"""
     SELECT
         tremor.starttime, tremor.endtime, tremor.lp,
@@ -137,15 +240,11 @@ def _get_tremor_data(channel_ids, conn):
         tremor.channel_id = channel.id
 
     WHERE
-        tremor.channel_id IN ({','.join(channel_ids)});
+        tremor.channel_id = ANY(%(channel_ids)s)
+    {_time_bounds('tremor.event_starttime', starttime, endtime)};
     """
 
-    df = pd.read_sql_query(query, conn)
-
-    # for t in 'starttime endtime'.split():
-    #     df[t] = df[t].dt.tz_convert('America/Guatemala')
-
-    query = f"""
+    query_hist = f"""
     SELECT
         event.starttime, event.id, tremor.channel_id
     FROM
@@ -156,23 +255,95 @@ def _get_tremor_data(channel_ids, conn):
     ON
         tremor.event_id = event.id
 
-    INNER JOIN
-        channel
-    ON
-        tremor.channel_id = channel.id
-
     WHERE
-        tremor.channel_id IN ({','.join(channel_ids)});
+        tremor.channel_id = ANY(%(channel_ids)s)
+    {_time_bounds('tremor.event_starttime', starttime, endtime)}
+    {_time_bounds('event.starttime', starttime, endtime)};
     """
-    hist = pd.read_sql_query(query, conn)
-    return df, hist
+    return query, query_hist
 
 
-def get_data(channel_ids, event_type, conn):
+def _queries(event_type, starttime=None, endtime=None):
+    _check_event_type(event_type)
     if event_type == 'coda':
-        df, hist = _get_coda_data(channel_ids, conn)
-    elif event_type == 'tremor':
-        df, hist = _get_tremor_data(channel_ids, conn)
+        return _coda_queries(starttime, endtime)
+    return _tremor_queries(starttime, endtime)
+
+
+def iter_data(
+    channel_ids, event_type, conn, starttime=None, endtime=None,
+    chunksize=CHUNKSIZE
+):
+    """
+    Streams the results of the events of the channels (coda peaks or
+    tremor), starting between starttime and endtime (by default all).
+
+    Yields:
+    -------
+    df : pandas.DataFrame
+        Chunks of at most chunksize rows.
+    """
+    query, _ = _queries(event_type, starttime, endtime)
+    params = _params(channel_ids, starttime, endtime)
+    for df in _iter_query(query, params, conn, chunksize):
+        df['stacha'] = (
+            df.station + ' ' + df.channel + ' ' + df.channel_id.apply(str)
+        )
+        yield df
+
+
+def get_hist(channel_ids, event_type, conn, starttime=None, endtime=None):
+    """
+    Start times of the events of the channels, starting between starttime
+    and endtime (by default all).
+    """
+    _, query = _queries(event_type, starttime, endtime)
+    params = _params(channel_ids, starttime, endtime)
+    return pd.concat(
+        list(_iter_query(query, params, conn)), ignore_index=True
+    )
 
-    df['stacha'] = df.station+' '+df.channel+' '+df.channel_id.apply(str)
+
+def get_data(channel_ids, event_type, conn, starttime=None, endtime=None):
+    """
+    Results of the events of the channels, starting between starttime and
+    endtime (by default all).
+    """
+    df = pd.concat(
+        list(iter_data(channel_ids, event_type, conn, starttime, endtime)),
+        ignore_index=True
+    )
+    hist = get_hist(channel_ids, event_type, conn, starttime, endtime)
     return df, hist
+
+
+def export_data(
+    path_or_buf, channel_ids, event_type, conn, starttime=None,
+    endtime=None, chunksize=CHUNKSIZE
+):
+    """
+    Writes the results of the events of the channels (see get_data) to a
+    CSV file, chunksize rows at a time, in bounded memory however many the
+    results are.
+
+    Returns:
+    --------
+    n : int
+        Number of rows written.
+    """
+    chunks = iter_data(
+        channel_ids, event_type, conn, starttime, endtime, chunksize
+    )
+    f = path_or_buf
+    if isinstance(path_or_buf, str):
+        f = open(path_or_buf, 'w', newline='')
+
+    n = 0
+    try:
+        for i, df in enumerate(chunks):
+            df.to_csv(f, index=False, header=(i == 0))
+            n += len(df)
+    finally:
+        if f is not path_or_buf:
+            f.close()
+    return n
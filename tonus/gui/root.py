@@ -10,12 +10,14 @@ Main window of the application.
 # Python Standard Library
 import logging
 import os
+import queue
+import threading
 import tkinter as tk
 
 # Other dependencies
 import matplotlib.pyplot as plt
-from obspy import read, read_inventory
 import pandas as pd
+from obspy import read_inventory
 import psycopg2
 import tonus
 
@@ -100,6 +102,13 @@ class Root(tk.Tk):
                 variable=self.sv_waveserver,
                 command=self.switch_waveserver
             )
+            self.rbtn_cache = tk.Radiobutton(
+                self,
+                text='cache',
+                value='cache',
+                variable=self.sv_waveserver,
+                command=self.switch_waveserver
+            )
 
             self.lbl_ip = tk.Label(self, text='IP')
             self.ent_ip = tk.Entry(self, width=14)
@@ -131,6 +140,11 @@ class Root(tk.Tk):
             self.rbtn_files.grid(row=3, column=0, sticky='nw')
             self.btn_files_select.grid(row=3, column=1, sticky='nw')
 
+            self.rbtn_cache.grid(row=4, column=0, sticky='nw')
+
+            self.lbl_progress = tk.Label(self, text='')
+            self.lbl_progress.grid(row=5, column=0, columnspan=2, sticky='nw')
+
             self.lbl_port.grid(row=2, column=0, sticky='nw')
             self.ent_port.grid(row=2, column=1, sticky='nw')
 
@@ -138,7 +152,7 @@ class Root(tk.Tk):
 
         def switch_waveserver(self):
             self.master.c.waveserver.name = self.sv_waveserver.get()
-            if self.sv_waveserver.get() in ['fdsn', 'earthworm']:
+            if self.sv_waveserver.get() in ['fdsn', 'earthworm', 'cache']:
                 self.ent_ip['state'] = 'normal'
                 self.ent_port['state'] = 'normal'
                 self.btn_waveserver_connect['state'] = 'normal'
@@ -153,30 +167,96 @@ class Root(tk.Tk):
             filepaths = list(
                 tk.filedialog.askopenfilenames(title='Select waves files')
             )
-            data = []
-            for filepath in filepaths:
-                try:
-                    st = read(filepath, headonly=True)
-                    for tr in st:
-                        data.append(
-                            dict(
-                                filepath=filepath,
-                                station=tr.stats.station,
-                                channel=tr.stats.channel,
-                                starttime=tr.stats.starttime.datetime,
-                                endtime=tr.stats.endtime.datetime
-                            )
+            if not filepaths:
+                return
+
+            # The headers are read in the background, the traces are added
+            # to df_files as the files are read
+            self.master.df_files = tonus.waveindex.rows_to_dataframe([])
+            self.btn_files_select['state'] = 'disabled'
+            self.lbl_progress['text'] = 'Indexing files...'
+
+            messages = queue.Queue()
+            threading.Thread(
+                target=self._index_files,
+                args=(filepaths, messages),
+                daemon=True
+            ).start()
+            self.after(100, self._poll_index, messages)
+
+        @staticmethod
+        def _index_files(filepaths, messages):
+            try:
+                index = tonus.waveindex.WaveformIndex()
+
+                # Files already indexed (and not modified) are not read
+                outdated = {
+                    filepath for filepath, _ in index.outdated(filepaths)[0]
+                }
+                indexed = [
+                    f for f in map(os.path.abspath, filepaths)
+                    if f not in outdated
+                ]
+                if indexed:
+                    messages.put(
+                        ('rows', index.to_dataframe(filepaths=indexed))
+                    )
+
+                def callback(n_done, n_total, rows):
+                    messages.put(('progress', n_done, n_total))
+                    if rows:
+                        messages.put(
+                            ('rows', tonus.waveindex.rows_to_dataframe(rows))
                         )
-                except Exception as e:
-                    logging.error(e)
-                    continue
 
-            self.master.df_files = pd.DataFrame(data)
+                index.update(
+                    filepaths, workers=os.cpu_count() or 1, callback=callback
+                )
+                messages.put(('done', index.to_dataframe(filepaths=filepaths)))
+            except Exception as e:
+                logging.error(e)
+                messages.put(('error', e))
+
+        def _poll_index(self, messages):
+            dfs = []
+            while True:
+                try:
+                    message = messages.get_nowait()
+                except queue.Empty:
+                    break
+
+                if message[0] == 'rows':
+                    dfs.append(message[1])
+                elif message[0] == 'progress':
+                    n_done, n_total = message[1:]
+                    self.lbl_progress['text'] = (
+                        f'Indexing files... {n_done}/{n_total}'
+                    )
+                elif message[0] == 'error':
+                    self._finish_index(None)
+                    tk.messagebox.showwarning('Warning', message[1])
+                    return
+                elif message[0] == 'done':
+                    self._finish_index(message[1])
+                    return
+
+            if dfs:
+                self.master.df_files = pd.concat(
+                    [self.master.df_files] + dfs, ignore_index=True
+                )
+            self.after(100, self._poll_index, messages)
+
+        def _finish_index(self, df):
+            self.btn_files_select['state'] = 'normal'
+            self.lbl_progress['text'] = ''
+            if df is None:
+                return
+            self.master.df_files = df
 
-            if len(data) == 1:
+            if len(df) == 1:
                 text = '1 file pre-loaded'
             else:
-                text = f'{len(data)} files pre-loaded'
+                text = f'{len(df)} files pre-loaded'
             tk.messagebox.showinfo('Files pre-loaded', text)
 
     class FrameInventory(tk.LabelFrame):
@@ -245,14 +325,20 @@ class Root(tk.Tk):
 
     def connect_waveserver(self):
         name = self.frm_waveserver.sv_waveserver.get()
-        if name not in 'fdsn earthworm'.split():
+        if name not in 'fdsn earthworm cache'.split():
             return
 
         ip = self.frm_waveserver.ent_ip.get()
         port = self.frm_waveserver.ent_port.get()
 
+        # Options of the cache
+        kwargs = {
+            k: v for k, v in self.c.waveserver.items()
+            if k not in 'name ip port'.split()
+        }
+
         try:
-            self.client = tonus.waveserver.connect(name, ip, port)
+            self.client = tonus.waveserver.connect(name, ip, port, **kwargs)
         except Exception as e:
             logging.error(e)
             tk.messagebox.showwarning('Warning', e)
@@ -13,13 +13,13 @@ from matplotlib.widgets import MultiCursor
 import numpy as np
 from obspy import UTCDateTime
 import pandas as pd
+import tonus
 
 # Local files
 from tonus.gui import frames
 from tonus.gui.utils import isfloat, open_window, select_trace
 from tonus.gui.plotting import spectrogram
-from tonus.preprocess import butter_bandpass_filter
-from tonus.process.tremor import detect_f1, get_harmonics
+from tonus.process.tremor import process_tremor
 
 
 class AppTremor(tk.Toplevel):
@@ -33,6 +33,9 @@ class AppTremor(tk.Toplevel):
             self.df_files = master.df_files
         self.event_type = 'tremor'
 
+        # Downloads in the background
+        self.fetcher = tonus.gui.utils.Fetcher(self)
+
         self.wm_title('tonus - harmonic tremor')
         self.font_title = master.font_title
         self.bd = master.bd
@@ -361,6 +364,14 @@ class AppTremor(tk.Toplevel):
         def submit(self):
             submitted = False
 
+            try:
+                tonus.database.check_event_starttime(
+                    ['tremor'], self.master.conn
+                )
+            except ValueError as e:
+                tk.messagebox.showerror('Database not migrated', e)
+                return
+
             cur = self.master.conn.cursor()
 
             # Clean channels not picked
@@ -395,16 +406,23 @@ class AppTremor(tk.Toplevel):
                 starttime = min(starttimes).datetime
                 endtime = max(endtimes).datetime
 
+                tonus.database.create_partitions(
+                    starttime, starttime, self.master.conn
+                )
                 sql_str = f"""
                 INSERT INTO
                     event(starttime, endtime, volcano_id)
                 VALUES
                     ('{starttime}', '{endtime}', {volcano_id})
                 RETURNING
-                    id
+                    id, starttime
                 """
                 cur.execute(sql_str)
-                self.master.event_id = cur.fetchone()[0]
+                (
+                    self.master.event_id, self.master.event_starttime
+                ) = cur.fetchone()
+
+            event_starttime = self.master.event_starttime
 
             for stacha in self.master.results.keys():
                 station, channel = stacha.split()
@@ -453,13 +471,13 @@ class AppTremor(tk.Toplevel):
                 INSERT INTO
                     tremor(event_id, channel_id, starttime, endtime,
                     fmin, fmax, fmean, fstd, fmedian, n_harmonics, amplitude,
-                    lp_time, lp, odd, harmonics
+                    lp_time, lp, odd, harmonics, event_starttime
                     )
                 VALUES(
                     {self.master.event_id}, {channel_id}, '{starttime}',
                     '{endtime}', {fmin}, {fmax}, {fmean}, {fstd}, {fmedian},
                     {n_harmonics}, {amplitude}, {lp_time}, {lp}, {odd},
-                    {harmonics}
+                    {harmonics}, '{event_starttime}'
                 );
                 """
                 try:
@@ -508,6 +526,7 @@ class AppTremor(tk.Toplevel):
 
         if len(df) > 0:
             self.event_id = df.id.to_list()[0]
+            self.event_starttime = df.starttime.to_list()[0]
 
             df = pd.read_sql_query(
                 f"""
@@ -556,6 +575,7 @@ class AppTremor(tk.Toplevel):
                 tk.messagebox.showwarning('Event in database', text)
         else:
             self.event_id = None
+            self.event_starttime = None
 
     def _select_trace(self, event):
         select_trace(self)
@@ -682,55 +702,27 @@ class AppTremor(tk.Toplevel):
         band_width_Hz = float(self.frm_process.ent_band_width_Hz.get())
         factor = float(self.frm_process.factor_ent.get())
 
-        _tr = self.tr.copy()
-        stacha = f'{_tr.stats.station} {_tr.stats.channel}'
-        _tr.detrend()
-        butter_bandpass_filter(_tr, freqmin, freqmax, order)
-
-        tau, t, pitch = detect_f1(_tr, window_s, overlap, freqmin, thresh)
+        stacha = f'{self.tr.stats.station} {self.tr.stats.channel}'
 
-        number, time, frequency, amplitude = get_harmonics(
-            _tr,
-            t,
-            pitch,
+        summary, df, t, pitch = process_tremor(
+            self.tr,
+            freqmin,
+            freqmax,
+            order,
             window_s,
             overlap,
+            thresh,
             n_harmonics_max,
             band_width_Hz,
             factor,
-            freqmin,
-        )
-
-        df = pd.DataFrame(
-            list(zip(number, time, frequency, amplitude)),
-            columns=['number', 'time', 'frequency', 'amplitude']
         )
-        if len(df) == 0:
+        if summary is None:
             return
 
+        self.results[stacha].update(summary)
+        starttime = summary['starttime']
+        endtime = summary['endtime']
         groups = df.groupby('number')
-        df_f1 = df[df.number == 1]
-
-        self.results[stacha]['starttime'] = df.time.min()
-        self.results[stacha]['endtime'] = df.time.max()
-
-        tr_amp = self.tr.slice(df.time.min(), df.time.max())
-        self.results[stacha]['amplitude'] = np.sqrt((tr_amp.data**2).mean())
-
-        self.results[stacha]['fmin'] = df_f1.frequency.min()
-        self.results[stacha]['fmax'] = df_f1.frequency.max()
-        self.results[stacha]['fmean'] = df_f1.frequency.mean()
-        self.results[stacha]['fstd'] = df_f1.frequency.std()
-        self.results[stacha]['fmedian'] = df_f1.frequency.median()
-
-        harmonics = sorted(df.number.unique().tolist())
-        self.results[stacha]['n_harmonics'] = len(harmonics)
-        self.results[stacha]['harmonics'] = harmonics
-        odd = True
-        for harmonic in harmonics:
-            if harmonic % 2 == 0:
-                odd = False
-        self.results[stacha]['odd'] = odd
 
         # Plot
         amin = df.amplitude.min()
@@ -762,8 +754,8 @@ class AppTremor(tk.Toplevel):
 
         self.ax3.plot(t, pitch, c='b', lw=1)
 
-        start = df.time.min() - self.tr.stats.starttime
-        end = df.time.max() - self.tr.stats.starttime
+        start = starttime - self.tr.stats.starttime
+        end = endtime - self.tr.stats.starttime
 
         if start:
             self.ax3.axvline(start, c='b', lw=1, ls='--')
@@ -779,7 +771,9 @@ class AppTremor(tk.Toplevel):
                 print(e)
                 continue
 
-            _times = [t-self.tr.stats.starttime for t in _df.time]
+            _times = (
+                (_df.time.astype('int64') - self.tr.stats.starttime.ns) / 1e9
+            ).tolist()
             # Start
             # xy = (_times[0], _df.frequency.tolist()[0])
             # xytext = (_times[0]-20, _df.frequency.tolist()[0])
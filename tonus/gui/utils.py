@@ -8,14 +8,17 @@ Various and diverse utils.
 
 # Python Standard Library
 import logging
+import threading
 import tkinter as tk
 import tomllib
 
+from concurrent.futures import ThreadPoolExecutor
+
 # Other dependencies
 import matplotlib.pyplot as plt
 import tonus
 
-from obspy import read, Stream
+from obspy import read, Stream, UTCDateTime
 
 # Local files
 
@@ -50,10 +53,191 @@ def open_window(master, window):
     master.focus_force()
 
 
+class DownloadCancelled(Exception):
+    pass
+
+
+def fetch_waveforms(
+    client, name, network, station, channel, starttime, endtime, df_files,
+    inventory, cancelled
+):
+    """
+    Gets the waveforms of an event and pre-processes them, runs in the
+    background (no Tk calls).
+
+    Parameters:
+    -----------
+    client : obspy client
+        Waveform client, with the 'fdsn', 'earthworm' and 'cache' sources.
+    name : str
+        Waveform source ('fdsn', 'earthworm', 'cache' or 'files').
+    network : str
+        Network code.
+    station, channel : list of str
+        Selected stations and channels.
+    starttime, endtime : obspy.UTCDateTime
+        Time window.
+    df_files : pandas.DataFrame
+        Pre-loaded waveform files (see tonus.waveindex), with the 'files'
+        source.
+    inventory : obspy.Inventory
+        Inventory with the responses.
+    cancelled : threading.Event
+        Checked between the steps, DownloadCancelled is raised when set.
+
+    Returns:
+    --------
+    st : obspy.Stream
+        Pre-processed waveforms, sorted by station.
+    """
+    if cancelled.is_set():
+        raise DownloadCancelled
+
+    st = Stream()
+    # Download waveforms from FDSN or Earthworm server
+    if name in 'fdsn earthworm cache'.split():
+        st = client.get_waveforms(
+            network,
+            ','.join(station),
+            '--',
+            ','.join(channel),
+            starttime,
+            endtime,
+            attach_response=False
+        )
+    # Download waveforms from files source
+    elif name == 'files':
+        if df_files is None:
+            raise ValueError(
+                'No waveform files pre-loaded, go back to launch window.'
+            )
+        df = df_files
+        df = df[
+            (df.starttime <= endtime.datetime) &
+            (starttime.datetime <= df.endtime)
+        ]
+        df = df[df.station.isin(station)]
+        df = df[df.channel.isin(channel)]
+        filepaths = df.filepath.unique().tolist()
+
+        if len(filepaths) == 0:
+            raise ValueError(
+                'None of the selected files contain the requested waves'
+            )
+        for filepath in filepaths:
+            st += read(filepath, starttime=starttime, endtime=endtime)
+
+    if cancelled.is_set():
+        raise DownloadCancelled
+
+    # Preprocess the downloaded waveforms
+    if len(st) > 0:
+        pipeline = tonus.preprocess.pre_process(st, inventory)
+        logging.info(f'Pre-processing: {pipeline.report()}')
+
+    # Sort the stream by station
+    st.sort(keys=['station'])
+    return st
+
+
+class Fetcher:
+    """
+    Gets the waveforms of the events in background threads, so that the
+    Tk loop is never blocked, and keeps the prefetched waveforms of the
+    next event.
+
+    Parameters:
+    -----------
+    master : tk.Toplevel
+        The application window, the threads are stopped when it is
+        destroyed.
+    workers : int
+        Number of threads.
+    """
+    def __init__(self, master, workers=2):
+        self.executor = ThreadPoolExecutor(workers)
+        self.current = None
+        self.prefetched = None
+        master.bind('<Destroy>', self._on_destroy, add='+')
+        self.master = master
+
+    def _submit(self, key, kwargs):
+        cancelled = threading.Event()
+        future = self.executor.submit(
+            fetch_waveforms, cancelled=cancelled, **kwargs
+        )
+        return key, future, cancelled
+
+    def get(self, key, **kwargs):
+        """
+        Future of the waveforms of a request (see fetch_waveforms for the
+        keyword arguments), the prefetched one if its key is the same.
+        The current request, if any, is cancelled.
+        """
+        self.cancel()
+        if self.prefetched is not None and self.prefetched[0] == key:
+            self.current, self.prefetched = self.prefetched, None
+        else:
+            self.current = self._submit(key, kwargs)
+        return self.current[1]
+
+    def prefetch(self, key, **kwargs):
+        """
+        Starts getting the waveforms of a request, replacing the previous
+        prefetch.
+        """
+        if self.prefetched is not None:
+            if self.prefetched[0] == key:
+                return
+            self.prefetched[2].set()
+            self.prefetched[1].cancel()
+        self.prefetched = self._submit(key, kwargs)
+
+    def cancel(self):
+        """
+        Cancels the current request, its result is discarded.
+        """
+        if self.current is None:
+            return
+        key, future, cancelled = self.current
+        cancelled.set()
+        future.cancel()
+        self.current = None
+
+    def _on_destroy(self, event):
+        if event.widget is not self.master:
+            return
+        for request in [self.current, self.prefetched]:
+            if request is not None:
+                request[2].set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _request(master, starttime, endtime, station, channel):
+    key = (
+        master.c.waveserver.name, tuple(station), tuple(channel),
+        starttime, endtime
+    )
+    kwargs = dict(
+        client=getattr(master, 'client', None),
+        name=master.c.waveserver.name,
+        network=master.c.network,
+        station=station,
+        channel=channel,
+        starttime=starttime,
+        endtime=endtime,
+        df_files=getattr(master, 'df_files', None),
+        inventory=master.inventory,
+    )
+    return key, kwargs
+
+
 def download(master):
     """
-    Downloads seismic waveforms based on user-selected parameters and
-    stores them in 'master.st'.
+    Gets the seismic waveforms of the user-selected parameters in the
+    background and stores them in 'master.st' when ready. Clicking again
+    while downloading cancels the download. The waveforms of the next event
+    of the CSV file are prefetched.
 
     Parameters:
     -----------
@@ -66,14 +250,16 @@ def download(master):
     --------
     None
     """
-    # Initialize the stream to store downloaded waveforms
-    master.st = Stream()
+    btn = master.frm_waves.download_btn
+    if master.fetcher.current is not None:
+        master.fetcher.cancel()
+        btn['text'] = 'Get waveforms'
+        logging.info('Download cancelled.')
+        return
 
     # Check if an event is in the database for this volcano
     master.check_event()
 
-    logging.info('Downloading waveforms...')
-
     # Get selected stations and channels for download
     selection = master.frm_waves.station_lbx.curselection()
     station = [master.frm_waves.station_lbx.get(s) for s in selection]
@@ -81,57 +267,58 @@ def download(master):
     selection = master.frm_waves.channel_lbx.curselection()
     channel = [master.frm_waves.channel_lbx.get(s) for s in selection]
 
-    # Download waveforms from FDSN or Earthworm server
-    if master.c.waveserver.name in 'fdsn earthworm'.split():
-        try:
-            master.st = master.client.get_waveforms(
-                master.c.network,
-                ','.join(station),
-                '--',
-                ','.join(channel),
-                master.starttime,
-                master.endtime,
-                attach_response=False
+    logging.info('Downloading waveforms...')
+    key, kwargs = _request(
+        master, master.starttime, master.endtime, station, channel
+    )
+    future = master.fetcher.get(key, **kwargs)
+    btn['text'] = 'Cancel'
+    master.after(100, _poll_download, master, future)
+
+    # The next event of the CSV file, same window around its time
+    if master.frm_waves.starttime_ent['state'] == 'disabled':
+        lbx = master.frm_waves.swarm_lbx
+        i = lbx.curselection()[0] + 1
+        if i < lbx.size():
+            offset = UTCDateTime(lbx.get(i - 1)) - master.starttime
+            starttime = UTCDateTime(lbx.get(i)) - offset
+            endtime = starttime + (master.endtime - master.starttime)
+            key, kwargs = _request(
+                master, starttime, endtime, station, channel
             )
-        except Exception as e:
-            tk.messagebox.showwarning('Warning', e)
-    # Download waveforms from files source
-    elif master.c.waveserver.name == 'files':
-        starttime = master.starttime.datetime
-        endtime = master.endtime.datetime
-        try:
-            df = master.df_files
-        except Exception:
-            text = 'No waveform files pre-loaded, go back to launch window.'
-            tk.messagebox.showwarning('Warning', text)
-            return
+            master.fetcher.prefetch(key, **kwargs)
+    return
 
-        df = df[(df.starttime <= endtime) & (starttime <= df.endtime)]
-        df = df[df.station.isin(station)]
-        df = df[df.channel.isin(channel)]
-        filepaths = df.filepath.unique().tolist()
 
-        if len(filepaths) == 0:
-            text = 'None of the selected files contain the requested waves'
-            tk.messagebox.showwarning('Warning', text)
-        else:
-            # Initialize an empty stream to store the loaded waveforms
-            master.st = Stream()
-            for filepath in filepaths:
-                master.st += read(
-                    filepath,
-                    starttime=master.starttime,
-                    endtime=master.endtime
-                )
+def _poll_download(master, future):
+    if not future.done():
+        master.after(100, _poll_download, master, future)
+        return
+
+    # Result of a cancelled or replaced request
+    if master.fetcher.current is None or \
+       master.fetcher.current[1] is not future:
+        return
+    master.fetcher.current = None
+    master.frm_waves.download_btn['text'] = 'Get waveforms'
 
-    # Preprocess the downloaded waveforms and log completion
+    try:
+        master.st = future.result()
+    except DownloadCancelled:
+        return
+    except Exception as e:
+        logging.error(e)
+        master.st = Stream()
+        tk.messagebox.showwarning('Warning', e)
     if len(master.st) > 0:
-        tonus.preprocess.pre_process(master.st, master.inventory)
         logging.info('Stream downloaded and preprocessed.')
+    show_stream(master)
 
-    # Sort the stream by station
-    master.st.sort(keys=['station'])
 
+def show_stream(master):
+    """
+    Lists the traces of 'master.st' to be selected.
+    """
     # Get station/channels paris
     stachas = [f'{tr.stats.station} {tr.stats.channel}' for tr in master.st]
 
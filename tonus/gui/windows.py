@@ -15,6 +15,7 @@ import tonus
 from matplotlib.backends.backend_tkagg import (
     FigureCanvasTkAgg, NavigationToolbar2Tk
 )
+from obspy import UTCDateTime
 
 # Local files
 
@@ -269,6 +270,17 @@ class WindowPlotResults(tk.Toplevel):
             self.stacha_lbx = tk.Listbox(self, selectmode=tk.MULTIPLE,
                                          height=3)
             self.stacha_lbx.pack()
+
+            # Optional, only the events in the range are read
+            self.starttime_lbl = tk.Label(self, text='Start time')
+            self.starttime_lbl.pack()
+            self.starttime_ent = tk.Entry(self)
+            self.starttime_ent.pack()
+            self.endtime_lbl = tk.Label(self, text='End time')
+            self.endtime_lbl.pack()
+            self.endtime_ent = tk.Entry(self)
+            self.endtime_ent.pack()
+
             self.download_db_btn = tk.Button(
                 self,
                 text='Query',
@@ -297,9 +309,22 @@ class WindowPlotResults(tk.Toplevel):
             stachas = [self.stacha_lbx.get(s) for s in selection]
             channel_ids = [stacha.split()[2] for stacha in stachas]
 
+            try:
+                starttime, endtime = [
+                    UTCDateTime(ent.get()) if ent.get().strip() else None
+                    for ent in (self.starttime_ent, self.endtime_ent)
+                ]
+            except Exception:
+                tk.messagebox.showerror(
+                    'Invalid time',
+                    'Times must be like 2020-01-31 or 2020-01-31T12:00:00'
+                )
+                return
+
             self.master.df, self.master.hist = tonus.gui.queries.get_data(
-                channel_ids, self.event_type, self.conn
+                channel_ids, self.event_type, self.conn, starttime, endtime
             )
+            self.master.selection = (channel_ids, starttime, endtime)
 
             self.master.plot_selec_frm.stacha_lbx.delete(0, tk.END)
             for stacha in self.master.df.stacha.unique():
@@ -375,8 +400,14 @@ class WindowPlotResults(tk.Toplevel):
         )
         if outpath is None:
             return
-        self.df.to_csv(outpath, index=False)
-        pass
+
+        # Queried again and written in chunks, in bounded memory
+        channel_ids, starttime, endtime = self.selection
+        with outpath:
+            tonus.gui.queries.export_data(
+                outpath, channel_ids, self.event_type, self.conn, starttime,
+                endtime
+            )
 
 
 if __name__ == '__main__':
@@ -2,63 +2,427 @@
 
 
 """
+Pre-processing of the waveforms.
+
+Pipeline runs a list of stages (Detrend, Highpass, Bandpass,
+RemoveResponse) on the traces of a stream, batched in 2-D arrays, and
+times each stage. The frequency responses of the response removal are
+cached (ResponseCache).
 """
 
 
 # Python Standard Library
+import threading
+import time
+
+from collections import OrderedDict
 
 # Other dependencies
-from obspy import Trace, Stream
-from scipy.signal import butter, lfilter
+import numpy as np
+
+from obspy import Trace
+from obspy.core.inventory import PolynomialResponseStage
+from obspy.signal.invsim import cosine_taper, invert_spectrum
+from obspy.signal.util import _npts2nfft
+from scipy.signal import detrend, sosfilt
 
 # Local files
+from tonus.filters import bandpass, bandpass_stream, design_highpass
 
 
 __author__ = 'Leonardo van der Laat'
 __email__ = 'lvmzxc@gmail.com'
 
 
-def pre_process(st, inventory):
-    st.detrend()
-    st.filter('highpass', freq=0.5)
-    st.remove_response(inventory)
+class ResponseCache:
+    """
+    Frequency responses of the channels of an inventory, evaluated once per
+    (SEED id, epoch, nfft, sampling_rate, output) and reused by
+    remove_response.
+
+    Parameters:
+    -----------
+    inventory : obspy.Inventory
+        Inventory with the responses.
+    maxsize : int
+        Number of responses kept, the least recently used are dropped.
+
+    Attributes:
+    -----------
+    hits, misses : int
+        Number of responses reused and evaluated.
+    """
+    def __init__(self, inventory, maxsize=256):
+        self.inventory = inventory
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._responses = OrderedDict()
+        self._epochs = None
+        self._lock = threading.Lock()
+
+    def _get_epochs(self):
+        # SEED id: [(start_date, end_date, response), ...]
+        epochs = {}
+        for network in self.inventory:
+            for station in network:
+                for channel in station:
+                    seed_id = '.'.join([
+                        network.code, station.code, channel.location_code,
+                        channel.code
+                    ])
+                    epochs.setdefault(seed_id, []).append(
+                        (channel.start_date, channel.end_date,
+                         channel.response)
+                    )
+        return epochs
+
+    def epoch(self, tr):
+        """
+        Start date and response of the channel epoch of a trace.
+        """
+        with self._lock:
+            if self._epochs is None:
+                self._epochs = self._get_epochs()
+        t = tr.stats.starttime
+        for start_date, end_date, response in self._epochs.get(tr.id, []):
+            if response is None:
+                continue
+            if (start_date is None or start_date <= t) and \
+               (end_date is None or t <= end_date):
+                return start_date, response
+        raise ValueError(f'{tr.id}: no matching response information found')
+
+    def get(self, tr, nfft, output='VEL'):
+        """
+        Complex frequency response of the channel of a trace (read-only
+        array of nfft//2 + 1 values, see
+        obspy.core.inventory.response.Response.get_evalresp_response).
+        """
+        start_date, response = self.epoch(tr)
+        key = (
+            tr.id, None if start_date is None else start_date.ns, nfft,
+            tr.stats.sampling_rate, output
+        )
+        with self._lock:
+            if key in self._responses:
+                self._responses.move_to_end(key)
+                self.hits += 1
+                return self._responses[key]
+
+        freq_response, _ = response.get_evalresp_response(
+            tr.stats.delta, nfft, output=output
+        )
+        freq_response.flags.writeable = False
+
+        with self._lock:
+            self.misses += 1
+            self._responses[key] = freq_response
+            while len(self._responses) > self.maxsize:
+                self._responses.popitem(last=False)
+        return freq_response
+
+    def clear(self):
+        with self._lock:
+            self._responses.clear()
+            self._epochs = None
+            self.hits = 0
+            self.misses = 0
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache(inventory):
+    """
+    Response cache of an inventory, shared by the calls of remove_response
+    with the same inventory (a new one is created when it changes).
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None or _cache.inventory is not inventory:
+            _cache = ResponseCache(inventory)
+        return _cache
+
+
+class Detrend:
+    """
+    Stage of a Pipeline removing the trend of the waveforms.
+
+    Parameters:
+    -----------
+    type : str
+        'simple' (line through the first and last samples, the default of
+        obspy.Stream.detrend), 'linear' (least squares line) or 'demean'.
+    """
+    def __init__(self, type='simple'):
+        self.type = type
+        self.name = f'detrend ({type})'
+
+    def __call__(self, data, traces):
+        if self.type == 'demean':
+            data -= data.mean(axis=-1, keepdims=True)
+        elif self.type == 'linear':
+            detrend(data, axis=-1, type='linear', overwrite_data=True)
+        elif self.type == 'simple':
+            x1, x2 = data[:, :1], data[:, -1:]
+            slope = (x2 - x1) / max(data.shape[1] - 1, 1)
+            data -= x1 + np.arange(data.shape[1]) * slope
+        else:
+            raise ValueError(f'Unknown detrend type {self.type}')
+
+
+class Highpass:
+    """
+    Stage of a Pipeline applying a Butterworth highpass filter, same as
+    obspy.Stream.filter('highpass').
+
+    Parameters:
+    -----------
+    freq : float
+        Corner frequency (Hz).
+    corners : int
+        Order of the filter.
+    """
+    def __init__(self, freq, corners=4):
+        self.freq = freq
+        self.corners = corners
+        self.name = f'highpass ({freq} Hz)'
+
+    def __call__(self, data, traces):
+        sampling_rate = traces[0].stats.sampling_rate
+        sos = design_highpass(sampling_rate, self.freq, self.corners)
+        data[:] = sosfilt(sos, data, axis=-1)
+
+
+class Bandpass:
+    """
+    Stage of a Pipeline applying a Butterworth bandpass filter (see
+    tonus.filters.bandpass).
+    """
+    def __init__(self, freqmin, freqmax, order, zerophase=False):
+        self.freqmin = freqmin
+        self.freqmax = freqmax
+        self.order = order
+        self.zerophase = zerophase
+        self.name = f'bandpass ({freqmin}-{freqmax} Hz)'
+
+    def __call__(self, data, traces):
+        data[:] = bandpass(
+            data, traces[0].stats.sampling_rate, self.freqmin, self.freqmax,
+            self.order, self.zerophase
+        )
+
+
+class RemoveResponse:
+    """
+    Stage of a Pipeline removing the instrument response, same as
+    obspy.Stream.remove_response (zero mean, cosine taper, no pre-filter),
+    with the frequency responses reused from a ResponseCache. Traces with
+    polynomial responses are passed to obspy.
+
+    Parameters:
+    -----------
+    inventory : obspy.Inventory
+        Inventory with the responses.
+    output : str
+        'DISP', 'VEL' or 'ACC'.
+    water_level : float
+        Water level of the inverted response (dB), or None.
+    taper_fraction : float
+        Fraction of the cosine taper of the waveforms.
+    cache : ResponseCache
+        By default the one of get_response_cache.
+    """
+    name = 'remove_response'
+
+    def __init__(
+        self, inventory, output='VEL', water_level=60, taper_fraction=0.05,
+        cache=None
+    ):
+        self.inventory = inventory
+        self.output = output
+        self.water_level = water_level
+        self.taper_fraction = taper_fraction
+        self.cache = cache or get_response_cache(inventory)
+
+    def _obspy(self, data, i, tr):
+        _tr = Trace(data=data[i].astype(np.float64), header=tr.stats)
+        _tr.remove_response(
+            self.inventory, output=self.output,
+            water_level=self.water_level, taper_fraction=self.taper_fraction
+        )
+        data[i] = _tr.data
+
+    def __call__(self, data, traces):
+        rows = []
+        for i, tr in enumerate(traces):
+            _, response = self.cache.epoch(tr)
+            if not response.response_stages or isinstance(
+                response.response_stages[0], PolynomialResponseStage
+            ):
+                self._obspy(data, i, tr)
+            else:
+                rows.append(i)
+        if not rows:
+            return
+
+        npts = data.shape[1]
+        x = data[rows].astype(np.float64)
+        x -= x.mean(axis=-1, keepdims=True)
+        x *= cosine_taper(
+            npts, self.taper_fraction, sactaper=True, halfcosine=False
+        )
+
+        nfft = _npts2nfft(npts)
+        x = np.fft.rfft(x, n=nfft, axis=-1)
+
+        for j, i in enumerate(rows):
+            freq_response = self.cache.get(
+                traces[i], nfft, self.output
+            ).copy()
+            if self.water_level is None:
+                freq_response[0] = 0.0
+                freq_response[1:] = 1.0 / freq_response[1:]
+            else:
+                invert_spectrum(freq_response, self.water_level)
+            x[j] *= freq_response
+
+        x[:, -1] = np.abs(x[:, -1]) + 0.0j
+        data[rows] = np.fft.irfft(x, axis=-1)[:, 0:npts]
+
+
+class Pipeline:
+    """
+    Pre-processing of the waveforms of a stream by a list of stages.
+
+    The traces with the same sampling rate and number of samples are
+    copied once into a 2-D array (one trace per row) on which the stages
+    run in place, one call per stage for all the traces. The array is kept
+    (one per dtype, number of traces and samples) and reused by the next
+    run, so the rows are copied back to the traces: in place when a trace
+    owns a contiguous array of the dtype, otherwise into a new array.
+
+    A stage is a callable stage(data, traces), data the 2-D array (modified
+    in place) and traces the obspy Traces of its rows, with a name
+    attribute (see Detrend, Highpass, Bandpass and RemoveResponse).
+
+    Parameters:
+    -----------
+    stages : list
+        Stages, run in order.
+    dtype : numpy.dtype
+        float64 or float32 (half the memory, less precise).
+
+    Attributes:
+    -----------
+    timings : dict
+        Seconds spent in each stage (name), accumulated over the runs.
+    buffers : dict
+        2-D arrays of the last run by (dtype, number of traces, samples).
+
+    Example:
+    --------
+    >>> pipeline = Pipeline([Detrend(), Bandpass(1, 16, 4)])
+    >>> pipeline.run(st)
+    >>> logging.info(pipeline.report())
+    """
+    def __init__(self, stages, dtype=np.float64):
+        self.stages = stages
+        self.dtype = dtype
+        self.timings = {stage.name: 0. for stage in stages}
+        self.buffers = {}
+
+    def run(self, st):
+        """
+        Pre-processes an obspy Stream (or Trace) in place, returns it.
+        """
+        traces = [st] if isinstance(st, Trace) else st
+
+        groups = {}
+        for tr in traces:
+            if tr.stats.npts == 0:
+                continue
+            key = (tr.stats.sampling_rate, tr.stats.npts)
+            groups.setdefault(key, []).append(tr)
+
+        buffers = {}
+        for (sampling_rate, npts), _traces in groups.items():
+            key = (np.dtype(self.dtype), len(_traces), npts)
+            data = buffers.get(key, self.buffers.get(key))
+            if data is None:
+                data = np.empty((len(_traces), npts), dtype=self.dtype)
+            buffers[key] = data
+            for i, tr in enumerate(_traces):
+                data[i] = tr.data
 
+            for stage in self.stages:
+                t0 = time.perf_counter()
+                stage(data, _traces)
+                self.timings[stage.name] += time.perf_counter() - t0
 
-def _butter_bandpass_filter(tr, freqmin, freqmax, order):
-    """Filter a obspy Trace with a Butterworth filter
+            for i, tr in enumerate(_traces):
+                if (
+                    tr.data.dtype == data.dtype and tr.data.base is None and
+                    tr.data.flags.c_contiguous and tr.data.flags.writeable
+                ):
+                    tr.data[:] = data[i]
+                else:
+                    tr.data = data[i].copy()
+        # Only the buffers of this run are kept (the days have the same size)
+        self.buffers = buffers
+        return st
 
-    Relies on scipy.signal butter and lfilter functions
-    Detrending must be performed calling this function.
-    This functions alter permanently the Trace data
+    def report(self):
+        """
+        Seconds spent in each stage, as text.
+        """
+        return ', '.join(
+            f'{name} {seconds:.2f} s' for name, seconds in self.timings.items()
+        )
 
-    Parameters
-    ----------
-    tr : obspy.core.trace object
-        Will be modified, must do a copy before if you want.
-    freqmin : float
-        Lower frequency
-    freqmax : float
-        Higher frequency
-    order : int
-        Filter order
 
-    Returns
-    -------
+def remove_response(
+    st, inventory, output='VEL', water_level=60, taper_fraction=0.05,
+    cache=None
+):
     """
-    nyquist = .5 * tr.stats.sampling_rate
-    low = freqmin / nyquist
-    high = freqmax / nyquist
-    b, a = butter(order, [low, high], btype='band')
-    tr.data = lfilter(b, a, tr.data)
-    return
+    Removes the instrument response of a stream in place, see
+    RemoveResponse.
+    """
+    stage = RemoveResponse(
+        inventory, output, water_level, taper_fraction, cache
+    )
+    return Pipeline([stage]).run(st)
+
+
+def pre_process(st, inventory, taper_fraction=0.05):
+    """
+    Pre-processing of the analysis (detrend, 0.5 Hz highpass and response
+    removal), in place.
+
+    Returns:
+    --------
+    pipeline : Pipeline
+        With the timings of the stages.
+    """
+    pipeline = Pipeline([
+        Detrend(),
+        Highpass(0.5),
+        RemoveResponse(inventory, taper_fraction=taper_fraction),
+    ])
+    pipeline.run(st)
+    return pipeline
 
 
-def butter_bandpass_filter(st, freqmin, freqmax, order):
-    if isinstance(st, Trace):
-        _butter_bandpass_filter(st, freqmin, freqmax, order)
-    elif isinstance(st, Stream):
-        for tr in st:
-            _butter_bandpass_filter(tr, freqmin, freqmax, order)
+def butter_bandpass_filter(st, freqmin, freqmax, order, zerophase=False):
+    """
+    Filters an obspy Trace or Stream in place with a Butterworth bandpass
+    filter (see tonus.filters.bandpass_stream). Detrending must be
+    performed before calling this function.
+    """
+    bandpass_stream(st, freqmin, freqmax, order, zerophase)
 
 
 if __name__ == '__main__':
@@ -15,8 +15,9 @@ spectral analysis and peak detection.
 # Other dependencies
 import numpy as np
 
-from scipy.signal import find_peaks, medfilt
+from scipy.signal import find_peaks, hilbert, medfilt, peak_widths
 from scipy.stats import linregress
+from skimage.util.shape import view_as_windows
 
 from tonus.preprocess import butter_bandpass_filter
 
@@ -27,22 +28,62 @@ __author__ = 'Leonardo van der Laat'
 __email__ = 'lvmzxc@gmail.com'
 
 
-def peak_width_half_abs_height(freq, fft, peak):
+def peak_widths_half_abs_height(freq, fft, peaks):
     """
-    We search the samples that sourround the half energy level,
-    the subscripts are for left and right, 1st subscript refers to the
-    side of the spectrum relative to the peak, the 2nd subscript refers
-    to the side relative to the half energy level.
-    Then the frequency at the half energy level is obtained by
-    interpolation.
+    Frequencies at which the spectrum crosses half the absolute height of
+    each peak, for all the peaks at once.
+
+    The spectrum is followed from each peak to the left and to the right
+    until it drops below half the height of the peak, the crossing
+    frequencies are linearly interpolated between the samples above and
+    below the half level. The search stops at the edges of the spectrum, the
+    first or last frequency is then returned.
+
+    Parameters
+    ----------
+    freq : numpy.ndarray
+        1D array containing the frequency values.
+
+    fft : numpy.ndarray
+        1D array containing the magnitude values of the FFT spectrum.
+
+    peaks : numpy.ndarray
+        Indices of the peaks in the 'freq' and 'fft' arrays
 
-                            peak
+    Returns
+    -------
+    freq_left : numpy.ndarray
+        Frequencies at the left boundary of the half-height range of the
+        peaks.
 
-                   idx_lr          idx_rl
+    freq_right : numpy.ndarray
+        Frequencies at the right boundary of the half-height range of the
+        peaks.
+    """
+    peaks = np.asarray(peaks, dtype=np.intp)
+    fft = np.asarray(fft, dtype=float)
+
+    # Half of the absolute height: prominence = height, bases at the edges
+    prominence_data = (
+        fft[peaks],
+        np.zeros(len(peaks), dtype=np.intp),
+        np.full(len(peaks), len(fft) - 1, dtype=np.intp),
+    )
+    _, _, left_ips, right_ips = peak_widths(
+        fft, peaks, rel_height=0.5, prominence_data=prominence_data
+    )
 
-           ------------ half energy level ------------
+    # Interpolated sample indices to frequency
+    samples = np.arange(len(freq))
+    freq_left = np.interp(left_ips, samples, freq)
+    freq_right = np.interp(right_ips, samples, freq)
+    return freq_left, freq_right
 
-               idx_ll                     idx_rr
+
+def peak_width_half_abs_height(freq, fft, peak):
+    """
+    Frequencies at which the spectrum crosses half the absolute height of a
+    peak (see peak_widths_half_abs_height).
 
     Parameters
     ----------
@@ -63,44 +104,58 @@ def peak_width_half_abs_height(freq, fft, peak):
     freq_right : float
         Frequency at the right boundary of the half-height range of the peak.
     """
+    freq_left, freq_right = peak_widths_half_abs_height(freq, fft, [peak])
+    return freq_left[0], freq_right[0]
 
-    # Slice from peak to the left
-    fft_left = np.flip(fft[:peak+1], axis=0)
-    freq_left = np.flip(freq[:peak+1], axis=0)
 
-    i = 0
-    while fft_left[i] >= fft[peak]/2:
-        idx_lr = i
-        i += 1
-    idx_ll = i
+def amplitude_decay(data, sampling_rate, window, step, envelope='rms'):
+    """
+    Amplitude of the signal in sliding windows, computed on a strided view
+    of the data (same windows as obspy.Trace.slide).
 
-    f_ll = freq_left[idx_ll]
-    f_lr = freq_left[idx_lr]
+    Parameters
+    ----------
+    data : numpy.ndarray
+        1D array containing the signal.
 
-    e_ll = fft_left[idx_ll]
-    e_lr = fft_left[idx_lr]
+    sampling_rate : float
+        Sampling rate of the signal (Hz).
 
-    freq_left = ((fft[peak]/2 - e_ll)*(f_lr - f_ll))/(e_lr - e_ll) + f_ll
+    window : float
+        Length of the windows (seconds).
 
-    # Slice from peak to the right
-    fft_right = fft[peak:]
-    freq_right = freq[peak:]
+    step : float
+        Step between the start of consecutive windows (seconds).
 
-    i = 0
-    while fft_right[i] >= fft[peak]/2:
-        idx_rl = i
-        i += 1
-    idx_rr = i
+    envelope : str, optional (default='rms')
+        'rms' for the root mean square of the signal in each window or
+        'hilbert' for the mean of its Hilbert envelope.
 
-    f_rl = freq_right[idx_rl]
-    f_rr = freq_right[idx_rr]
+    Returns
+    -------
+    time : numpy.ndarray
+        Start time of the windows, relative to the first sample (seconds).
 
-    e_rl = fft_right[idx_rl]
-    e_rr = fft_right[idx_rr]
+    amplitude : numpy.ndarray
+        Amplitude of the windows.
+    """
+    if envelope == 'rms':
+        x = np.asarray(data, dtype=float)**2
+    elif envelope == 'hilbert':
+        x = np.abs(hilbert(data))
+    else:
+        raise ValueError(f'Unknown envelope: {envelope}')
 
-    freq_right = ((fft[peak]/2 - e_rl)*(f_rr - f_rl))/(e_rr - e_rl) + f_rl
+    window_npts = int(round(window*sampling_rate)) + 1
+    step_npts = max(int(round(step*sampling_rate)), 1)
+    if len(x) < window_npts:
+        return np.array([]), np.array([])
 
-    return freq_left, freq_right
+    amplitude = view_as_windows(x, window_npts, step_npts).mean(axis=1)
+    if envelope == 'rms':
+        amplitude = np.sqrt(amplitude)
+    time = np.arange(len(amplitude))*step_npts/sampling_rate
+    return time, amplitude
 
 
 def get_peaks(
@@ -111,7 +166,10 @@ def get_peaks(
     factor,
     distance_Hz=0.3,
     prominence_min=0.04,
-    window_length_Hz=3
+    window_length_Hz=3,
+    rms_window=2,
+    rms_step=1,
+    envelope='rms',
 ):
     """
     Analyzes a time series signal to detect and characterize peaks in its
@@ -144,6 +202,17 @@ def get_peaks(
     window_length_Hz : float, optional (default=3)
         The length of the window (in Hz) used for smoothing the spectrum.
 
+    rms_window : float, optional (default=2)
+        Length (in seconds) of the windows of the amplitude decay used to
+        compute Q_alpha.
+
+    rms_step : float, optional (default=1)
+        Step (in seconds) between the windows of the amplitude decay.
+
+    envelope : str, optional (default='rms')
+        Amplitude of the windows, 'rms' for the root mean square of the
+        signal or 'hilbert' for the mean of its Hilbert envelope.
+
     Returns:
     --------
     freq : numpy.ndarray
@@ -214,20 +283,14 @@ def get_peaks(
     a = fft[peaks]*1e6
 
     # Q = f/deltaF
-    q_f = []
-    for peak in peaks:
-        freq_left, freq_right = peak_width_half_abs_height(freq, fft, peak)
-        q_f.append(freq[peak]/(freq_right-freq_left))
+    freq_left, freq_right = peak_widths_half_abs_height(freq, fft, peaks)
+    q_f = (f/(freq_right - freq_left)).tolist()
 
     # Q = pi*f/alpha
     # alpha = pi*f/Q
-    time, amplitude = [], []
-    for window in tr.slide(window_length=2, step=1):
-        amplitude.append(np.sqrt(np.mean(window.data**2)))
-        win_time = (window.stats.starttime - tr.stats.starttime)
-        time.append(win_time)
-    time = np.asarray(time)
-    amplitude = np.asarray(amplitude)
+    time, amplitude = amplitude_decay(
+        tr.data, tr.stats.sampling_rate, rms_window, rms_step, envelope
+    )
     slope, intercept, r_value, p_value, std_err = linregress(
         time, np.log(amplitude)
     )
@@ -239,5 +302,51 @@ def get_peaks(
     return freq, fft_norm, fft_smooth, peaks, f, a, q_f, q_alpha
 
 
+def get_peaks_stream(st, *args, **kwargs):
+    """
+    Runs get_peaks on a copy of each trace of a stream (for instance the
+    channels of one event, which may be views of the data of a whole day
+    shared with the other events), the stream is not modified.
+
+    Parameters:
+    -----------
+    st : ObsPy Stream object
+        The time series data to be analyzed.
+
+    *args, **kwargs
+        Parameters of get_peaks.
+
+    Returns:
+    --------
+    results : list of dict
+        One per trace, with the keys 'id', 'starttime', 'endtime',
+        'frequency', 'amplitude', 'q_f' and 'q_alpha' (see get_peaks,
+        q_alpha is None if no peak is found), or 'id' and 'error' if the
+        trace could not be processed.
+    """
+    results = []
+    for tr in st:
+        result = dict(
+            id=tr.id,
+            starttime=tr.stats.starttime,
+            endtime=tr.stats.endtime,
+        )
+        try:
+            (
+                freq, fft_norm, fft_smooth, peaks, f, a, q_f, q_alpha
+            ) = get_peaks(tr.copy(), *args, **kwargs)
+        except Exception as e:
+            result['error'] = str(e)
+        else:
+            result.update(
+                frequency=np.asarray(f),
+                amplitude=np.asarray(a),
+                q_f=np.asarray(q_f),
+                q_alpha=q_alpha if len(f) > 0 else None,
+            )
+        results.append(result)
+    return results
+
+
 if __name__ == '__main__':
     pass
@@ -13,12 +13,16 @@ pitch and harmonics (overtones) determination.
 
 # Other dependencies
 import numpy as np
+import pandas as pd
 
-from numba import jit
-from scipy.fft import rfft
-from scipy.signal import find_peaks, medfilt
+from numba import get_num_threads, jit, prange
+from obspy import UTCDateTime
+from scipy.fft import irfft, next_fast_len, rfft
+from scipy.signal import medfilt
 from scipy.signal.windows import tukey
+from skimage.util.shape import view_as_windows
 from tonus.detection.obspy2numpy import st2windowed_data
+from tonus.preprocess import butter_bandpass_filter
 
 # Local files
 
@@ -165,7 +169,222 @@ def _detect_f1(data, fs, w_size, tau_max, hop_size, freqmin, thresh):
     return tau, t, pitch
 
 
-def detect_f1(tr, window_s, overlap, freqmin, thresh):
+def yin_fft(frames, fs, w_size, tau_max, thresh, chunk_size=256):
+    """
+    Estimate pitch for many windowed chunks of signal using the YIN
+    algorithm, computing the difference function through FFTs.
+
+    Batched equivalent of yin_block. The difference function of Eq. 6 of
+    DeCheveigné et al. (2002) is expanded as
+
+        d(tau) = E(0) + E(tau) - 2 r(tau)
+
+    where r is the cross-correlation of the first w_size samples with the
+    whole frame, computed with rfft in O(W log W), and E(tau) is the energy
+    of the lagged window, taken from a cumulative sum of the squared frame.
+
+    The results match yin_block within floating point rounding of the
+    difference function (relative to the window energy, ~1e-12), which can
+    only change the estimate when a minimum of D is at the threshold.
+
+    Parameters:
+    -----------
+    frames : numpy.ndarray
+        2D array (n_hops, w_size + tau_max) of windowed chunks of signal.
+    fs : float
+        Sampling frequency (Hz).
+    w_size : int
+        Window size (samples).
+    tau_max : int
+        Max lag for the difference function.
+    thresh : float
+        Threshold for identifying the first minimum in D.
+    chunk_size : int
+        Number of frames processed at once, bounds the memory used.
+
+    Returns:
+    --------
+    confidence : numpy.ndarray
+        Confidence level of the pitch estimates. NaN where no reliable pitch
+        estimate is found.
+    pitch : numpy.ndarray
+        Estimated fundamental frequencies (Hz). NaN where no reliable pitch
+        estimate is found.
+    """
+    n_hops, frame_size = frames.shape
+    n = next_fast_len(w_size + frame_size - 1)
+    lags = np.arange(1, tau_max)
+
+    confidence = np.full(n_hops, np.nan)
+    pitch = np.full(n_hops, np.nan)
+
+    for i0 in range(0, n_hops, chunk_size):
+        x = frames[i0:i0+chunk_size].astype(np.float64)
+
+        # Step 2: Difference function
+        head = x[:, :w_size]
+        r = irfft(np.conj(rfft(head, n)) * rfft(x, n), n)[:, :tau_max]
+        energy = np.zeros((len(x), frame_size + 1))
+        np.cumsum(x**2, axis=1, out=energy[:, 1:])
+        e_0 = energy[:, w_size:w_size+1]
+        e_tau = energy[:, w_size:w_size+tau_max] - energy[:, :tau_max]
+        r = np.maximum(e_0 + e_tau - 2*r, 0)
+        r[:, 0] = 0
+
+        # Step 3: Cumulative mean normalized difference function
+        d = np.ones_like(r)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            d[:, 1:] = r[:, 1:] * lags / np.cumsum(r[:, 1:], axis=1)
+
+        # Step 4: Absolute threshold
+        d = np.where(d < thresh, d, np.inf)
+        idx = d.argmin(axis=1)
+        c = d[np.arange(len(d)), idx]
+        found = np.isfinite(c)
+        confidence[i0:i0+len(x)][found] = c[found]
+        with np.errstate(divide='ignore'):
+            pitch[i0:i0+len(x)][found] = fs / idx[found]
+    return confidence, pitch
+
+
+def _detect_f1_fft(data, fs, w_size, tau_max, hop_size, freqmin, thresh):
+    """
+    Detect the fundamental frequency (F1) in a time-varying signal.
+
+    Same as _detect_f1, but all the analysis windows are processed at once
+    by yin_fft.
+    """
+    # Calculate the number of analysis windows (hops)
+    num_hops = (len(data) - w_size - tau_max) // hop_size + 1
+
+    # All the analysis windows, without copying the data
+    frames = view_as_windows(
+        np.ascontiguousarray(data)[:(num_hops-1)*hop_size + w_size + tau_max],
+        w_size + tau_max,
+        hop_size
+    )
+    tau, pitch = yin_fft(frames, fs, w_size, tau_max, thresh)
+
+    # Replace with NaN if below threshold
+    below = ~(pitch > freqmin)
+    pitch[below] = np.nan
+    tau[below] = np.nan
+
+    # Calculate time instants for each analysis window
+    time_hop = hop_size / fs
+    t = np.linspace(0, time_hop * num_hops, num_hops)
+    t += time_hop / 2
+    return tau, t, pitch
+
+
+@jit(nopython=True, parallel=True, error_model='numpy')
+def _yin_batch(data, fs, w_size, tau_max, hop_size, thresh, n_chunks,
+               confidence, pitch):
+    """
+    Steps 2-4 of DeCheveigné et al. (2002) for every hop of every trace.
+
+    The (trace, hop) jobs are split in n_chunks contiguous chunks processed
+    in parallel, each with its own preallocated difference function buffer.
+    Results are written in confidence and pitch, arrays of shape
+    (n_traces, num_hops).
+    """
+    num_hops = confidence.shape[1]
+    n_jobs = data.shape[0] * num_hops
+    r = np.empty((n_chunks, tau_max))
+
+    for chunk in prange(n_chunks):
+        _r = r[chunk]
+        for job in range(chunk, n_jobs, n_chunks):
+            i = job // num_hops
+            n = job % num_hops
+            x = data[i, n*hop_size:n*hop_size + w_size + tau_max]
+
+            # Step 2: Difference function
+            for tau in range(tau_max):
+                s = 0.
+                for j in range(w_size):
+                    v = x[j] - x[j+tau]
+                    s += v*v
+                _r[tau] = s
+
+            # Steps 3 and 4: Cumulative mean normalized difference function
+            # and absolute threshold, keeping the global minimum below it
+            best, best_tau = np.inf, -1
+            if 1. < thresh:
+                best, best_tau = 1., 0
+            s = _r[0]
+            for tau in range(1, tau_max):
+                s += _r[tau]
+                d = _r[tau] / ((1/tau)*s)
+                if d < thresh and d < best:
+                    best, best_tau = d, tau
+
+            if best_tau < 0:
+                confidence[i, n] = np.nan
+                pitch[i, n] = np.nan
+            else:
+                confidence[i, n] = best
+                pitch[i, n] = fs/best_tau
+    return
+
+
+def detect_f1_batch(data, fs, w_size, tau_max, hop_size, freqmin, thresh):
+    """
+    Detect the fundamental frequency (F1) of one or several signals.
+
+    Same as _detect_f1, but every analysis window of every trace is
+    processed by a single compiled, parallel function (_yin_batch), without
+    per-window Python calls or allocations.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        1D array containing the input data, or 2D array (n_traces, npts)
+        to process several traces (e.g. stations) at once.
+    fs, w_size, tau_max, hop_size, freqmin, thresh
+        See _detect_f1.
+
+    Returns
+    -------
+    tau : numpy.ndarray
+        Confidence values corresponding to the detected F1 values, with
+        shape (num_hops,) or (n_traces, num_hops).
+    t : numpy.ndarray
+        Time instants (s) at which F1 values are estimated.
+    pitch : numpy.ndarray
+        Estimated fundamental frequency (F1) values (Hz), same shape as
+        tau. Values below 'freqmin' are replaced with NaN.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    squeeze = data.ndim == 1
+    data = np.atleast_2d(data)
+
+    # Calculate the number of analysis windows (hops)
+    num_hops = (data.shape[1] - w_size - tau_max) // hop_size + 1
+
+    tau = np.empty((data.shape[0], num_hops))
+    pitch = np.empty((data.shape[0], num_hops))
+    n_chunks = max(min(get_num_threads(), tau.size), 1)
+    _yin_batch(
+        data, fs, w_size, tau_max, hop_size, thresh, n_chunks, tau, pitch
+    )
+
+    # Replace with NaN if below threshold
+    below = ~(pitch > freqmin)
+    pitch[below] = np.nan
+    tau[below] = np.nan
+
+    # Calculate time instants for each analysis window
+    time_hop = hop_size / fs
+    t = np.linspace(0, time_hop * num_hops, num_hops)
+    t += time_hop / 2
+
+    if squeeze:
+        return tau[0], t, pitch[0]
+    return tau, t, pitch
+
+
+def detect_f1(tr, window_s, overlap, freqmin, thresh, backend='batch'):
     """
     Detect the fundamental frequency (F1) in a time series signal.
 
@@ -184,6 +403,11 @@ def detect_f1(tr, window_s, overlap, freqmin, thresh):
         Minimum frequency (Hz) for identifying the fundamental frequency.
     thresh : float
         Threshold for identifying the first minimum in the YIN algorithm.
+    backend : str
+        'batch' (default) processes all the windows in a single compiled
+        parallel function (detect_f1_batch), 'fft' computes the difference
+        function of all windows at once through FFTs (_detect_f1_fft),
+        'loop' uses yin_block on each window (_detect_f1).
 
     Returns
     -------
@@ -196,6 +420,10 @@ def detect_f1(tr, window_s, overlap, freqmin, thresh):
         Values below 'freqmin' are replaced with NaN.
 
     """
+    _detect = dict(
+        batch=detect_f1_batch, fft=_detect_f1_fft, loop=_detect_f1
+    )[backend]
+
     # Calculate the window size and hop size based on input parameters
     w_size = int(window_s * tr.stats.sampling_rate)
     hop_size = int(w_size - w_size*overlap)
@@ -204,12 +432,61 @@ def detect_f1(tr, window_s, overlap, freqmin, thresh):
     tau_max = w_size - 1
 
     # Call the internal _detect_f1 function with specified parameters
-    return _detect_f1(
+    return _detect(
         tr.data, tr.stats.sampling_rate, w_size, tau_max, hop_size, freqmin,
         thresh
     )
 
 
+@jit(nopython=True)
+def _select_by_distance(peaks, heights, rows, distance):
+    '''
+    Keep the highest peaks separated by at least the distance of their row.
+
+    Same selection as the 'distance' argument of scipy.signal.find_peaks,
+    applied to the peaks of all the spectra at once.
+
+    Parameters:
+    -----------
+    peaks : numpy.ndarray
+        Frequency index of the peaks, sorted by row and frequency.
+    heights : numpy.ndarray
+        Height of the peaks.
+    rows : numpy.ndarray
+        Row (frame) of the peaks.
+    distance : numpy.ndarray
+        Minimal distance (in samples) between peaks of each row.
+
+    Returns:
+    --------
+    keep : numpy.ndarray of bool
+        Mask of the peaks selected.
+    '''
+    n = len(peaks)
+    keep = np.ones(n, dtype=np.bool_)
+    start = 0
+    while start < n:
+        stop = start
+        while stop < n and rows[stop] == rows[start]:
+            stop += 1
+        _distance = np.ceil(distance[rows[start]])
+        order = np.argsort(heights[start:stop])
+        for i in order[::-1]:
+            i += start
+            if not keep[i]:
+                continue
+            j = i - 1
+            while j >= start and peaks[i] - peaks[j] < _distance:
+                keep[j] = False
+                j -= 1
+            j = i + 1
+            while j < stop and peaks[j] - peaks[i] < _distance:
+                keep[j] = False
+                j += 1
+        start = stop
+    return keep
+
+
 def get_harmonics(
     tr, times, pitch, window_s, overlap, n_harmonics_max, window_length_Hz,
     factor, freqmin,
@@ -221,6 +498,11 @@ def get_harmonics(
     harmonic components. It identifies the number of harmonics, their
     frequencies, and their amplitudes within specified parameters.
 
+    All the spectra are processed at once: the smoothed background is
+    computed for all frames, the peaks are the local maxima above 'factor'
+    times the background and separated by half the fundamental frequency
+    (as scipy.signal.find_peaks with 'height' and 'distance').
+
     Parameters:
     -----------
     tr : ObsPy Trace object
@@ -245,24 +527,26 @@ def get_harmonics(
 
     Returns:
     --------
-    number : list of int
-        Number of the harmonic.
-    time : list of UTCDateTime
-        Time instants of harmonic detection.
-    frequency : list of float
-        Detected harmonic frequencies (Hz).
-    amplitude : list of float
-        Amplitudes of the detected harmonics.
+    df : pandas.DataFrame
+        One row per harmonic detected, with columns 'number' (number of the
+        harmonic), 'time' (datetime64[ns], UTC), 'frequency' (Hz) and
+        'amplitude'.
     '''
-    # Initialize empty lists to store harmonic information
-    number, time, frequency, amplitude = [], [], [], []
+    df = pd.DataFrame(
+        dict(
+            number=np.array([], dtype=int),
+            time=np.array([], dtype='datetime64[ns]'),
+            frequency=np.array([], dtype=float),
+            amplitude=np.array([], dtype=float),
+        )
+    )
 
     # Find indices with valid pitch estimates (F1)
     pitch_idx = np.argwhere(np.isfinite(pitch))
 
-    # Return empty lists if no valid pitch estimates exist
+    # Return an empty table if no valid pitch estimates exist
     if len(pitch_idx) == 0:
-        return number, time, frequency, amplitude
+        return df
 
     # Determine the start and end indices and times based on valid estimates
     start_idx = pitch_idx.min()
@@ -292,45 +576,155 @@ def get_harmonics(
     if window_length % 2 == 0:
         window_length += 1
 
-    # Iterate through time intervals with valid pitch estimates
-    for t, f1, Sx in zip(
-        _times[start_idx:end_idx+1],
-        pitch[start_idx:end_idx+1],
-        Sxx
-    ):
-        if np.isnan(f1):
-            continue
-
-        # Smooth the spectrum
-        Sx_smooth = medfilt(Sx, kernel_size=window_length)
-
-        # Calculate the distance for peak detection
-        distance = int(f1 * fft_sampling_rate) / 2
-
-        # Find peaks in the spectrum
-        peaks, properties = find_peaks(
-            Sx,
-            height=(factor * Sx_smooth, None),
-            distance=distance,
+    # Frames with valid pitch estimates
+    n = min(end_idx - start_idx + 1, len(Sxx))
+    _times = _times[start_idx:start_idx+n]
+    f1 = pitch[start_idx:start_idx+n]
+    valid = np.isfinite(f1)
+    _times, f1, Sxx = _times[valid], f1[valid], Sxx[:n][valid]
+    if len(Sxx) == 0:
+        return df
+
+    # Smooth each spectrum (1-D medfilt is a fast rank filter, unlike
+    # scipy.ndimage.median_filter on the 2-D array)
+    Sxx_smooth = np.array(
+        [medfilt(Sx, kernel_size=window_length) for Sx in Sxx]
+    )
+
+    # Local maxima above the background
+    center = Sxx[:, 1:-1]
+    is_peak = (
+        (center > Sxx[:, :-2]) &
+        (center > Sxx[:, 2:]) &
+        (center >= factor * Sxx_smooth[:, 1:-1])
+    )
+    rows, peaks = np.nonzero(is_peak)
+    peaks += 1
+    heights = Sxx[rows, peaks]
+
+    # Keep the highest peaks separated by half the fundamental frequency
+    distance = (f1 * fft_sampling_rate).astype(int) / 2
+    keep = _select_by_distance(peaks, heights, rows, distance)
+    rows, peaks, heights = rows[keep], peaks[keep], heights[keep]
+
+    # Harmonic number of the peaks
+    frequency = freq[peaks]
+    _f1 = f1[rows]
+    q = np.round(
+        np.maximum(frequency, _f1) / np.minimum(frequency, _f1)
+    )
+    keep = (frequency >= freqmin) & (q >= 1) & (q <= n_harmonics_max)
+    rows, q = rows[keep], q[keep]
+
+    # Absolute time of the frames, to the nanosecond
+    ns = tr.stats.starttime.ns + np.round(_times[rows]*1e9).astype(np.int64)
+
+    df = pd.DataFrame(
+        dict(
+            number=q.astype(int),
+            time=pd.to_datetime(ns, unit='ns'),
+            frequency=frequency[keep],
+            amplitude=heights[keep],
         )
+    )
+    return df
 
-        # Iterate through detected peaks and characterize harmonics
-        for i, peak in enumerate(peaks):
-            min_f = min(freq[peak], f1)
-            max_f = max(freq[peak], f1)
-            q = round(max_f / min_f, 0)
 
-            # Check if the detected frequency is within the specified range
-            if freq[peak] >= freqmin and q >= 1 and q <= n_harmonics_max:
-                number.append(int(q))
-                time.append(t)
-                frequency.append(freq[peak])
-                amplitude.append(properties['peak_heights'][i])
+def summarize_harmonics(tr, df):
+    '''
+    Summary of the harmonics of a tremor, as stored in the tremor table.
 
-    # Convert time values to UTCDateTime objects
-    time = [tr.stats.starttime + t for t in time]
+    Parameters:
+    -----------
+    tr : ObsPy Trace object
+        The time series (not filtered) used for the amplitude.
+    df : pandas.DataFrame
+        Harmonics detected (see get_harmonics), must not be empty.
 
-    return number, time, frequency, amplitude
+    Returns:
+    --------
+    summary : dict
+        starttime, endtime (UTCDateTime), amplitude (RMS between them),
+        fmin, fmax, fmean, fstd, fmedian (of the fundamental frequency),
+        n_harmonics, harmonics (sorted list) and odd (True if all the
+        harmonics are odd).
+    '''
+    starttime = UTCDateTime(ns=df.time.min().value)
+    endtime = UTCDateTime(ns=df.time.max().value)
+    tr_amp = tr.slice(starttime, endtime)
+    f1 = df.frequency[df.number == 1]
+    harmonics = sorted(df.number.unique().tolist())
+    return dict(
+        starttime=starttime,
+        endtime=endtime,
+        amplitude=np.sqrt((tr_amp.data**2).mean()),
+        fmin=f1.min(),
+        fmax=f1.max(),
+        fmean=f1.mean(),
+        fstd=f1.std(),
+        fmedian=f1.median(),
+        n_harmonics=len(harmonics),
+        harmonics=harmonics,
+        odd=all(harmonic % 2 == 1 for harmonic in harmonics),
+    )
+
+
+def process_tremor(
+    tr, freqmin, freqmax, order, window_s, overlap, thresh, n_harmonics_max,
+    band_width_Hz, factor, backend='batch'
+):
+    '''
+    Complete analysis of a tremor: filtering, fundamental frequency
+    (detect_f1), harmonics (get_harmonics) and their summary
+    (summarize_harmonics).
+
+    Parameters:
+    -----------
+    tr : ObsPy Trace object
+        The time series data to be analyzed, it is not modified.
+    freqmin, freqmax : float
+        Band of the Butterworth filter (Hz), freqmin is also the minimum
+        fundamental frequency.
+    order : int
+        Order of the filter.
+    window_s, overlap, thresh, backend
+        See detect_f1.
+    n_harmonics_max, band_width_Hz, factor
+        See get_harmonics (band_width_Hz is its window_length_Hz).
+
+    Returns:
+    --------
+    summary : dict or None
+        See summarize_harmonics, None if no harmonic is detected.
+    df : pandas.DataFrame
+        Harmonics detected (see get_harmonics).
+    times : numpy.ndarray
+        Times of the fundamental frequency estimates (s).
+    pitch : numpy.ndarray
+        Fundamental frequency estimates (Hz).
+    '''
+    _tr = tr.copy()
+    _tr.detrend()
+    butter_bandpass_filter(_tr, freqmin, freqmax, order)
+
+    tau, times, pitch = detect_f1(
+        _tr, window_s, overlap, freqmin, thresh, backend=backend
+    )
+
+    df = get_harmonics(
+        _tr,
+        times,
+        pitch,
+        window_s,
+        overlap,
+        n_harmonics_max,
+        band_width_Hz,
+        factor,
+        freqmin,
+    )
+    if len(df) == 0:
+        return None, df, times, pitch
+    return summarize_harmonics(tr, df), df, times, pitch
 
 
 if __name__ == '__main__':
@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+
+
+"""
+Local waveform cache.
+
+Each day of data requested is fetched once from the source (an FDSN or
+Earthworm client, or a directory of files), decoded and stored as one raw
+sample array (.npy) per continuous segment of each channel, with a small
+SQLite index of their times. The requested codes (comma separated, with
+wildcards) are expanded into the channels of the source, and each
+channel-day is stored once, whatever the request it came with. Later
+requests are served as memory-mapped slices of those arrays
+(copy-on-write, so the cache is never modified), without decoding miniSEED
+again, and only the missing channel-days are fetched. The least recently
+used channel-days are evicted when the cache exceeds its size.
+"""
+
+
+# Python Standard Library
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from fnmatch import fnmatch
+
+# Other dependencies
+import numpy as np
+
+from obspy import Stream, Trace, UTCDateTime
+from obspy.clients.fdsn.header import FDSNNoDataException
+
+# Local files
+from tonus.waveindex import WaveformIndex
+
+
+__author__ = 'Leonardo van der Laat'
+__email__ = 'lvmzxc@gmail.com'
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS channel_day (
+    seed_id TEXT NOT NULL,
+    day INTEGER NOT NULL,
+    nbytes INTEGER NOT NULL,
+    last_access REAL NOT NULL,
+    PRIMARY KEY (seed_id, day)
+);
+
+CREATE TABLE IF NOT EXISTS channel_segment (
+    seed_id TEXT NOT NULL,
+    day INTEGER NOT NULL,
+    starttime_ns INTEGER NOT NULL,
+    sampling_rate REAL NOT NULL,
+    npts INTEGER NOT NULL,
+    path TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS channel_segment_seed_id_day_idx
+ON channel_segment (seed_id, day);
+"""
+
+
+def _match(code, patterns):
+    return any(fnmatch(code, pattern) for pattern in patterns.split(','))
+
+
+def _round(x):
+    # Nearest sample, as obspy.Trace.trim
+    return int(np.floor(x + 0.5))
+
+
+class CacheClient:
+    """
+    Waveform client (same get_waveforms as the obspy clients) with a local
+    memory-mapped cache.
+
+    Parameters:
+    -----------
+    source : obspy client or str
+        FDSN or Earthworm client (or a tonus.waveserver.Downloader over
+        one), or directory of waveform files.
+    cache_dir : str
+        Directory of the cache.
+    max_bytes : int
+        Size of the cache, the least recently used channel-days are evicted
+        above it.
+    min_age : float
+        Days ending less than min_age seconds ago are incomplete, they are
+        requested to the source and not cached.
+    """
+    def __init__(self, source, cache_dir, max_bytes=10e9, min_age=3600):
+        self.source = source
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Held only while the index is read or written, the downloads are
+        # made outside of it
+        self.lock = threading.Lock()
+        self.index = sqlite3.connect(
+            os.path.join(self.cache_dir, 'index.sqlite'),
+            check_same_thread=False
+        )
+        self.index.executescript(SCHEMA)
+
+        # Channels of each request and day
+        self.seed_ids = {}
+        # Event of each (seed_id, day) being fetched, set when stored
+        self.fetching = {}
+
+    def _fetch(self, network, station, location, channel, starttime, endtime):
+        if isinstance(self.source, str):
+            # Imported here, tonus.waveserver imports this module
+            from tonus.waveserver import read_files
+            st = read_files(
+                self.source, starttime, endtime, station=station.split(','),
+                channel=channel.split(',')
+            )
+            return Stream([
+                tr for tr in st
+                if _match(tr.stats.network, network)
+                and _match(tr.stats.station, station)
+                and _match(tr.stats.location or '--', location)
+                and _match(tr.stats.channel, channel)
+            ])
+        try:
+            return self.source.get_waveforms(
+                network, station, location, channel, starttime, endtime
+            )
+        except FDSNNoDataException:
+            return Stream()
+
+    def _list_channels(
+        self, network, station, location, channel, starttime, endtime
+    ):
+        """
+        (network, station, location, channel) of the channels of the source
+        matching the codes, from the index of the files, the menu of the
+        Earthworm server or the station metadata of the FDSN server.
+        """
+        if isinstance(self.source, str):
+            index = WaveformIndex()
+            index.update(self.source)
+            df = index.to_dataframe(
+                starttime, endtime, network, station, location, channel,
+                directory=self.source
+            )
+            return list(zip(df.network, df.station, df.location, df.channel))
+
+        client = getattr(self.source, 'client', self.source)
+        if hasattr(client, 'get_availability'):
+            return [
+                row[:4] for row in client.get_availability(
+                    network, station, location, channel
+                )
+            ]
+        try:
+            inventory = client.get_stations(
+                network=network, station=station, location=location,
+                channel=channel, starttime=starttime, endtime=endtime,
+                level='channel'
+            )
+        except FDSNNoDataException:
+            return []
+        return [
+            (net.code, sta.code, cha.location_code, cha.code)
+            for net in inventory for sta in net for cha in sta
+        ]
+
+    def _get_seed_ids(self, network, station, location, channel, day):
+        """
+        SEED ids (NET.STA.LOC.CHA) of the channels matching the codes in a
+        day, None if the source can not list them.
+        """
+        key = ('.'.join([network, station, location, channel]), day)
+        with self.lock:
+            if key in self.seed_ids:
+                return self.seed_ids[key]
+
+        day_start = UTCDateTime(day*86400)
+        try:
+            channels = self._list_channels(
+                network, station, location, channel, day_start,
+                day_start + 86400
+            )
+        except Exception as e:
+            logging.warning(f'Channels of {key[0]} unknown, not cached: {e}')
+            return None
+
+        seed_ids = set()
+        for _network, _station, _location, _channel in channels:
+            # Empty location code, '--' for the Earthworm servers
+            _location = '' if _location == '--' else _location
+            if (
+                _match(_network, network)
+                and _match(_station, station)
+                and _match(_location or '--', location)
+                and _match(_channel, channel)
+            ):
+                seed_ids.add(
+                    '.'.join([_network, _station, _location, _channel])
+                )
+        seed_ids = sorted(seed_ids)
+        with self.lock:
+            self.seed_ids[key] = seed_ids
+        return seed_ids
+
+    def _store(self, seed_ids, day, st):
+        """
+        Writes the segments of the channel-days, a channel without data is
+        stored empty (so that it is not requested again).
+        """
+        day_start = UTCDateTime(day*86400)
+        day_end = day_start + 86400
+
+        # Continuous segments within the day
+        st = Stream([tr for tr in st if tr.id in seed_ids])
+        st.merge()
+        st = st.split()
+        st.trim(day_start, day_end, nearest_sample=False)
+
+        rows = []
+        nbytes = dict.fromkeys(seed_ids, 0)
+        for i, tr in enumerate(st):
+            if tr.stats.npts > 0 and tr.stats.endtime >= day_end:
+                tr.data = tr.data[:-1]
+            if tr.stats.npts == 0:
+                continue
+            dirpath = os.path.join(
+                self.cache_dir, tr.stats.network, tr.stats.station
+            )
+            os.makedirs(dirpath, exist_ok=True)
+            path = os.path.join(dirpath, f'{tr.id}.{day_start.date}.{i}.npy')
+            np.save(path, np.ascontiguousarray(tr.data))
+            nbytes[tr.id] += tr.data.nbytes
+            rows.append((
+                tr.id, day, tr.stats.starttime.ns, tr.stats.sampling_rate,
+                tr.stats.npts, path
+            ))
+
+        with self.lock, self.index:
+            self.index.executemany(
+                'INSERT INTO channel_segment VALUES (?, ?, ?, ?, ?, ?)', rows
+            )
+            self.index.executemany(
+                'INSERT OR REPLACE INTO channel_day VALUES (?, ?, ?, ?)',
+                [
+                    (seed_id, day, n, time.time())
+                    for seed_id, n in nbytes.items()
+                ]
+            )
+
+    def _lookup(self, seed_id, day):
+        with self.index:
+            cur = self.index.execute(
+                'UPDATE channel_day SET last_access = ? '
+                'WHERE seed_id = ? AND day = ?',
+                (time.time(), seed_id, day)
+            )
+            if cur.rowcount == 0:
+                return None
+            return self.index.execute(
+                'SELECT * FROM channel_segment WHERE seed_id = ? AND day = ?',
+                (seed_id, day)
+            ).fetchall()
+
+    def _slice(self, rows, starttime, endtime):
+        st = Stream()
+        for (
+            seed_id, day, starttime_ns, sampling_rate, npts, path
+        ) in rows:
+            network, station, location, channel = seed_id.split('.')
+            t0 = UTCDateTime(ns=starttime_ns)
+            i0 = max(_round((starttime - t0)*sampling_rate), 0)
+            i1 = min(_round((endtime - t0)*sampling_rate) + 1, npts)
+            if i1 <= i0:
+                continue
+            data = np.load(path, mmap_mode='c')[i0:i1]
+            st += Trace(
+                data=data,
+                header=dict(
+                    network=network,
+                    station=station,
+                    location=location,
+                    channel=channel,
+                    sampling_rate=sampling_rate,
+                    starttime=t0 + i0/sampling_rate,
+                )
+            )
+        return st
+
+    def _evict(self):
+        with self.index:
+            total = self.index.execute(
+                'SELECT COALESCE(SUM(nbytes), 0) FROM channel_day'
+            ).fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            channel_days = self.index.execute(
+                'SELECT seed_id, day, nbytes FROM channel_day '
+                'ORDER BY last_access'
+            ).fetchall()
+            for seed_id, day, nbytes in channel_days:
+                if total <= self.max_bytes:
+                    break
+                paths = self.index.execute(
+                    'SELECT path FROM channel_segment '
+                    'WHERE seed_id = ? AND day = ?',
+                    (seed_id, day)
+                ).fetchall()
+                for path, in paths:
+                    try:
+                        os.remove(path)
+                    except OSError as e:
+                        logging.warning(e)
+                for table in ['channel_segment', 'channel_day']:
+                    self.index.execute(
+                        f'DELETE FROM {table} WHERE seed_id = ? AND day = ?',
+                        (seed_id, day)
+                    )
+                total -= nbytes
+
+    def _fetch_day(self, seed_ids, day):
+        """
+        Fetches and stores channel-days, one request per station (of the
+        missing channels only).
+        """
+        day_start = UTCDateTime(day*86400)
+        requests = {}
+        for seed_id in sorted(seed_ids):
+            network, station, location, channel = seed_id.split('.')
+            requests.setdefault((network, station, location), []).append(
+                channel
+            )
+
+        st = Stream()
+        for (network, station, location), channels in requests.items():
+            logging.info(
+                f'Caching {network}.{station}.{location}.{",".join(channels)} '
+                f'{day_start.date}...'
+            )
+            st += self._fetch(
+                network, station, location or '--', ','.join(channels),
+                day_start, day_start + 86400
+            )
+        self._store(set(seed_ids), day, st)
+
+    def _get_day(self, seed_ids, day, starttime, endtime):
+        """
+        Slices of the channel-days, the missing ones are fetched first. A
+        channel-day being fetched by another thread is waited for, not
+        fetched twice.
+        """
+        st = Stream()
+        pending = seed_ids
+        while pending:
+            fetch, wait = [], []
+            with self.lock:
+                for seed_id in pending:
+                    rows = self._lookup(seed_id, day)
+                    if rows is not None:
+                        st += self._slice(rows, starttime, endtime)
+                    elif (seed_id, day) in self.fetching:
+                        wait.append(seed_id)
+                    else:
+                        self.fetching[(seed_id, day)] = threading.Event()
+                        fetch.append(seed_id)
+                events = [self.fetching[(seed_id, day)] for seed_id in wait]
+
+            try:
+                if fetch:
+                    self._fetch_day(fetch, day)
+            finally:
+                with self.lock:
+                    for seed_id in fetch:
+                        self.fetching.pop((seed_id, day)).set()
+            for event in events:
+                event.wait()
+
+            # Looked up again (fetched again if the other thread failed)
+            pending = fetch + wait
+        return st
+
+    def get_waveforms(
+        self, network, station, location, channel, starttime, endtime,
+        **kwargs
+    ):
+        """
+        Same parameters as the get_waveforms method of the obspy clients
+        (comma separated codes, wildcards are allowed), other keyword
+        arguments are ignored.
+
+        Returns:
+        --------
+        st : obspy.Stream
+            Traces of the cached days are memory-mapped views, copied only
+            when a request spans several days.
+        """
+        now = UTCDateTime()
+
+        st = Stream()
+        day = int(starttime.timestamp // 86400)
+        while day*86400 <= endtime.timestamp:
+            day_start = UTCDateTime(day*86400)
+            day_end = day_start + 86400
+            seed_ids = None
+            if day_end <= now - self.min_age:
+                seed_ids = self._get_seed_ids(
+                    network, station, location, channel, day
+                )
+            if seed_ids is None:
+                # Incomplete day (or unknown channels), not cached
+                _st = self._fetch(
+                    network, station, location, channel,
+                    max(day_start, starttime), min(day_end, endtime)
+                )
+                st += _st.trim(starttime, endtime)
+            else:
+                st += self._get_day(seed_ids, day, starttime, endtime)
+            day += 1
+
+        with self.lock:
+            self._evict()
+
+        # Join the days (this copies)
+        if len(st) > len({tr.id for tr in st}):
+            st.merge(-1)
+        return st
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+
+
+"""
+Persistent index of waveform files.
+
+The headers of the waveform files (network, station, location, channel,
+start and end times, sampling rate) are stored in a SQLite database with
+the modification time and size of each file. Updating the index only reads
+the files that are new or changed since the last update, and queries by
+channel and time interval return the files to open without reading any of
+them.
+"""
+
+
+# Python Standard Library
+import logging
+import multiprocessing
+import os
+import sqlite3
+
+from concurrent.futures import ProcessPoolExecutor
+
+# Other dependencies
+import pandas as pd
+
+from obspy import read
+
+# Local files
+
+
+__author__ = 'Leonardo van der Laat'
+__email__ = 'lvmzxc@gmail.com'
+
+
+DEFAULT_PATH = os.path.join(
+    os.path.expanduser('~'), '.tonus', 'waveindex.sqlite'
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS file (
+    filepath TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS trace (
+    filepath TEXT NOT NULL,
+    network TEXT NOT NULL,
+    station TEXT NOT NULL,
+    location TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    starttime REAL NOT NULL,
+    endtime REAL NOT NULL,
+    sampling_rate REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS file_directory_idx ON file (directory);
+CREATE INDEX IF NOT EXISTS trace_filepath_idx ON trace (filepath);
+CREATE INDEX IF NOT EXISTS trace_channel_time_idx
+    ON trace (station, channel, starttime, endtime);
+"""
+
+COLUMNS = [
+    'filepath', 'network', 'station', 'location', 'channel', 'starttime',
+    'endtime', 'sampling_rate'
+]
+
+
+def scan_file(filepath):
+    """
+    Reads the headers of a waveform file.
+
+    Returns:
+    --------
+    rows : list of tuple
+        (filepath, network, station, location, channel, starttime, endtime,
+        sampling_rate) of each trace, times as POSIX timestamps. Empty if the
+        file can not be read.
+    """
+    try:
+        st = read(filepath, headonly=True)
+    except Exception as e:
+        logging.debug(f'{filepath}: {e}')
+        return []
+    return [
+        (
+            filepath,
+            tr.stats.network,
+            tr.stats.station,
+            tr.stats.location,
+            tr.stats.channel,
+            tr.stats.starttime.timestamp,
+            tr.stats.endtime.timestamp,
+            tr.stats.sampling_rate,
+        )
+        for tr in st
+    ]
+
+
+def _list_files(paths, recursive=False):
+    """
+    Files of a directory (and its subdirectories if recursive) or of a list
+    of files, with their stat.
+    """
+    if isinstance(paths, str):
+        if not recursive:
+            entries = [e for e in os.scandir(paths) if e.is_file()]
+            return [(os.path.abspath(e.path), e.stat()) for e in entries]
+        files = []
+        for dirpath, dirnames, filenames in os.walk(paths):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                filepath = os.path.abspath(os.path.join(dirpath, filename))
+                try:
+                    files.append((filepath, os.stat(filepath)))
+                except OSError as e:
+                    logging.warning(e)
+        return files
+    files = []
+    for path in paths:
+        try:
+            files.append((os.path.abspath(path), os.stat(path)))
+        except OSError as e:
+            logging.warning(e)
+    return files
+
+
+def rows_to_dataframe(rows):
+    """
+    Trace rows (see scan_file) to a DataFrame, times as datetime.
+    """
+    df = pd.DataFrame(rows, columns=COLUMNS)
+    for column in ['starttime', 'endtime']:
+        df[column] = pd.to_datetime(df[column], unit='s').dt.round('us')
+    return df
+
+
+def _patterns(column, patterns):
+    """
+    SQL condition of a column matching any of the wildcard patterns.
+    """
+    if patterns is None:
+        return '1', []
+    if isinstance(patterns, str):
+        patterns = patterns.split(',')
+    # Empty location code
+    patterns = ['' if p == '--' else p for p in patterns]
+    condition = ' OR '.join(f'{column} GLOB ?' for _ in patterns)
+    return f'({condition})', list(patterns)
+
+
+class WaveformIndex:
+    """
+    Parameters:
+    -----------
+    path : str
+        SQLite file of the index, created if missing.
+    """
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+
+    def outdated(self, paths, recursive=False):
+        """
+        Files of a directory (and its subdirectories if recursive) or list of
+        files that are not in the index or have changed since they were
+        indexed.
+
+        Returns:
+        --------
+        files : list of (filepath, os.stat_result)
+        stale : list of str
+            Files indexed in the directory that no longer exist (only when
+            paths is a directory).
+        """
+        files = _list_files(paths, recursive)
+        filepaths = [filepath for filepath, _ in files]
+
+        indexed = {}
+        for i in range(0, len(filepaths), 500):
+            chunk = filepaths[i:i+500]
+            rows = self.conn.execute(
+                'SELECT filepath, mtime, size FROM file WHERE filepath IN '
+                f'({", ".join("?" for _ in chunk)})',
+                chunk
+            )
+            indexed.update((row[0], row[1:]) for row in rows)
+
+        outdated = [
+            (filepath, stat) for filepath, stat in files
+            if indexed.get(filepath) != (stat.st_mtime, stat.st_size)
+        ]
+
+        stale = []
+        if isinstance(paths, str):
+            existing = set(filepaths)
+            directory = os.path.abspath(paths)
+            if recursive:
+                rows = self.conn.execute(
+                    'SELECT filepath, directory FROM file '
+                    'WHERE directory = ? OR directory LIKE ?',
+                    (directory, directory + os.sep + '%')
+                )
+            else:
+                rows = self.conn.execute(
+                    'SELECT filepath, directory FROM file WHERE directory = ?',
+                    (directory,)
+                )
+            stale = [
+                filepath for filepath, _directory in rows
+                if filepath not in existing and (
+                    _directory == directory or
+                    _directory.startswith(directory + os.sep)
+                )
+            ]
+        return outdated, stale
+
+    def add(self, filepath, stat, rows):
+        """
+        Stores the headers of a file (see scan_file), replacing the previous
+        ones.
+        """
+        self.add_many([(filepath, stat, rows)])
+
+    def add_many(self, files):
+        """
+        Same as add for a list of (filepath, stat, rows), in one
+        transaction.
+        """
+        with self.conn:
+            for filepath, stat, rows in files:
+                self.conn.execute(
+                    'DELETE FROM trace WHERE filepath = ?', (filepath,)
+                )
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO file VALUES (?, ?, ?, ?)',
+                    (
+                        filepath, os.path.dirname(filepath), stat.st_mtime,
+                        stat.st_size
+                    )
+                )
+                self.conn.executemany(
+                    'INSERT INTO trace VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows
+                )
+
+    def remove(self, filepaths):
+        with self.conn:
+            for filepath in filepaths:
+                self.conn.execute(
+                    'DELETE FROM trace WHERE filepath = ?', (filepath,)
+                )
+                self.conn.execute(
+                    'DELETE FROM file WHERE filepath = ?', (filepath,)
+                )
+
+    def update(
+        self, paths, recursive=False, workers=1, callback=None,
+        chunk_size=500
+    ):
+        """
+        Indexes the new and modified files of a directory or of a list of
+        files, and forgets the files removed from the directory.
+
+        Parameters:
+        -----------
+        paths : str or list of str
+            Directory or list of files.
+        recursive : bool
+            Include the subdirectories of the directory.
+        workers : int
+            Number of processes reading the headers.
+        callback : callable
+            Called as callback(n_done, n_total, rows) after each file is
+            read, rows are its traces (see scan_file).
+        chunk_size : int
+            Files stored per transaction.
+
+        Returns:
+        --------
+        n : int
+            Number of files read.
+        """
+        outdated, stale = self.outdated(paths, recursive)
+        self.remove(stale)
+        if not outdated:
+            return 0
+
+        filepaths = [filepath for filepath, _ in outdated]
+        executor = None
+        if workers > 1 and len(outdated) > 1:
+            # Spawned, not forked: the update may run in a thread of the GUI
+            executor = ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context('spawn')
+            )
+            results = executor.map(scan_file, filepaths, chunksize=16)
+        else:
+            results = map(scan_file, filepaths)
+
+        files = []
+        try:
+            for i, ((filepath, stat), rows) in enumerate(
+                zip(outdated, results)
+            ):
+                files.append((filepath, stat, rows))
+                if len(files) >= chunk_size:
+                    self.add_many(files)
+                    files = []
+                if callback is not None:
+                    callback(i + 1, len(outdated), rows)
+            self.add_many(files)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        return len(outdated)
+
+    def query(
+        self, starttime=None, endtime=None, network=None, station=None,
+        location=None, channel=None, directory=None, filepaths=None
+    ):
+        """
+        Files with data of the channels in a time interval.
+
+        Parameters:
+        -----------
+        starttime, endtime : obspy.UTCDateTime
+            Interval (both optional).
+        network, station, location, channel : str or list of str
+            Codes (comma separated or list), wildcards are allowed.
+        directory : str
+            Only the files of this directory.
+        filepaths : list of str
+            Only these files.
+
+        Returns:
+        --------
+        filepaths : list of str
+        """
+        df = self.to_dataframe(
+            starttime, endtime, network, station, location, channel,
+            directory, filepaths
+        )
+        return df.filepath.unique().tolist()
+
+    def to_dataframe(
+        self, starttime=None, endtime=None, network=None, station=None,
+        location=None, channel=None, directory=None, filepaths=None
+    ):
+        """
+        Same parameters as query.
+
+        Returns:
+        --------
+        df : pandas.DataFrame
+            One row per trace, with the columns filepath, network, station,
+            location, channel, starttime, endtime (datetime) and
+            sampling_rate.
+        """
+        conditions, params = [], []
+        if starttime is not None:
+            conditions.append('trace.endtime >= ?')
+            params.append(starttime.timestamp)
+        if endtime is not None:
+            conditions.append('trace.starttime <= ?')
+            params.append(endtime.timestamp)
+        for column, patterns in zip(
+            ['network', 'station', 'location', 'channel'],
+            [network, station, location, channel]
+        ):
+            condition, _params = _patterns(f'trace.{column}', patterns)
+            conditions.append(condition)
+            params += _params
+        if directory is not None:
+            conditions.append('file.directory = ?')
+            params.append(os.path.abspath(directory))
+
+        query = """
+        SELECT
+            trace.*
+        FROM
+            trace
+        INNER JOIN
+            file
+        ON
+            trace.filepath = file.filepath
+        WHERE
+            {}
+        ORDER BY
+            trace.filepath, trace.starttime
+        """
+        if filepaths is None:
+            query = query.format(' AND '.join(conditions) or '1')
+            rows = self.conn.execute(query, params).fetchall()
+            return rows_to_dataframe(rows)
+
+        # Sorted chunks, so that the rows stay in order
+        filepaths = sorted({os.path.abspath(f) for f in filepaths})
+        rows = []
+        for i in range(0, len(filepaths), 500):
+            chunk = filepaths[i:i+500]
+            condition = (
+                f'trace.filepath IN ({", ".join("?" for _ in chunk)})'
+            )
+            rows += self.conn.execute(
+                query.format(' AND '.join(conditions + [condition])),
+                params + chunk
+            ).fetchall()
+        return rows_to_dataframe(rows)
+
+
+if __name__ == '__main__':
+    pass
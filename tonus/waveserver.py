@@ -9,17 +9,53 @@ Deals with the waveforms
 # Python Standard Library
 import importlib
 import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
 
 # Other dependencies
+from obspy import read, Stream
+from obspy.clients.fdsn.header import FDSNNoDataException
 
 # Local files
+from tonus.wavecache import CacheClient
+from tonus.waveindex import WaveformIndex
 
 
 __author__ = 'Leonardo van der Laat'
 __email__ = 'lvmzxc@gmail.com'
 
 
-def connect(name, ip, port):
+def connect(name, ip=None, port=None, **kwargs):
+    """
+    Parameters:
+    -----------
+    name : str
+        'fdsn', 'earthworm' or 'cache'.
+    ip, port
+        Address of the server ('IRIS' as ip for the IRIS FDSN server).
+    **kwargs
+        Options of the 'cache' client (see tonus.wavecache.CacheClient):
+        source ('fdsn', 'earthworm' or 'files'), input_dir (with the 'files'
+        source), cache_dir and cache_size (GB). Other keys of the
+        configuration are ignored. The downloads of the cache are made by a
+        Downloader (chunk_length, workers, retries and backoff keys).
+    """
+    if name == 'cache':
+        source = kwargs.get('source', 'fdsn')
+        if source == 'files':
+            source = kwargs['input_dir']
+        else:
+            source = Downloader(connect(source, ip, port), **kwargs)
+        client = CacheClient(
+            source,
+            kwargs.get('cache_dir', '~/.tonus/cache'),
+            max_bytes=kwargs.get('cache_size', 10)*1e9,
+        )
+        logging.info(f'Waveform cache in {client.cache_dir}.\n')
+        return client
+
     waveserver = importlib.import_module(f'obspy.clients.{name}')
 
     logging.info(f'Connecting to {ip}...')
@@ -34,5 +70,186 @@ def connect(name, ip, port):
     return client
 
 
+class Downloader:
+    """
+    Download manager over an FDSN or Earthworm client (same get_waveforms
+    as the obspy clients).
+
+    A request is split by station and in time chunks, the chunks are
+    downloaded concurrently and merged into one stream. A chunk that fails
+    is requested again after a delay (doubled after each attempt), and
+    dropped with a warning after the last attempt, so that one failure
+    does not lose the whole request.
+
+    Parameters:
+    -----------
+    client : obspy client
+        FDSN or Earthworm client (see connect).
+    chunk_length : float
+        Length of the time chunks (s).
+    workers : int
+        Number of concurrent downloads.
+    retries : int
+        Attempts after the first failure of a chunk.
+    backoff : float
+        Delay before the first retry (s).
+    **kwargs
+        Other keys of the configuration are ignored.
+    """
+    def __init__(
+        self, client, chunk_length=3600, workers=4, retries=3, backoff=1,
+        **kwargs
+    ):
+        self.client = client
+        self.chunk_length = chunk_length
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+
+    def chunks(self, network, station, location, channel, starttime, endtime):
+        """
+        Requests (network, station, location, channel, starttime, endtime)
+        of each station and time chunk.
+        """
+        chunks = []
+        for _station in station.split(','):
+            t0 = starttime
+            while t0 < endtime:
+                t1 = min(t0 + self.chunk_length, endtime)
+                chunks.append((network, _station, location, channel, t0, t1))
+                t0 = t1
+        return chunks
+
+    def _download(self, chunk):
+        for attempt in range(self.retries + 1):
+            try:
+                return self.client.get_waveforms(*chunk)
+            except FDSNNoDataException:
+                return Stream()
+            except Exception as e:
+                if attempt == self.retries:
+                    logging.warning(
+                        f'{".".join(chunk[:4])} {chunk[4]} - {chunk[5]}: '
+                        f'{e}, dropped after {attempt + 1} attempts'
+                    )
+                    return Stream()
+                delay = self.backoff*2**attempt
+                logging.info(
+                    f'{".".join(chunk[:4])} {chunk[4]} - {chunk[5]}: {e}, '
+                    f'retrying in {delay:.1f} s'
+                )
+                time.sleep(delay)
+
+    def get_waveforms(
+        self, network, station, location, channel, starttime, endtime,
+        **kwargs
+    ):
+        """
+        Same parameters as the get_waveforms method of the obspy clients
+        (comma separated codes, wildcards are allowed), other keyword
+        arguments are ignored.
+
+        Returns:
+        --------
+        st : obspy.Stream
+            Chunks of each channel joined (gaps are kept).
+        """
+        chunks = self.chunks(
+            network, station, location, channel, starttime, endtime
+        )
+        if self.workers > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(self.workers) as executor:
+                streams = list(executor.map(self._download, chunks))
+        else:
+            streams = [self._download(chunk) for chunk in chunks]
+
+        st = Stream()
+        for _st in streams:
+            st += _st
+        # Adjacent chunks (or sharing their boundary sample) are joined
+        st.merge(-1)
+        return st
+
+
+def read_files(input_dir, starttime, endtime, station=None, channel=None):
+    """
+    Reads the waveforms of the files of a directory between two times.
+
+    The directory is indexed first (see tonus.waveindex, only new or
+    modified files are read), then only the files with data of the
+    requested channels in the time window are opened.
+
+    Parameters:
+    -----------
+    input_dir : str
+        Directory of the waveform files.
+    starttime, endtime : obspy.UTCDateTime
+        Time window.
+    station, channel : list of str
+        Codes, wildcards are allowed (all if None).
+    """
+    index = WaveformIndex()
+    index.update(input_dir)
+    filepaths = index.query(
+        starttime, endtime, station=station, channel=channel,
+        directory=input_dir
+    )
+
+    st = Stream()
+    for filepath in filepaths:
+        try:
+            st += read(filepath, starttime=starttime, endtime=endtime)
+        except Exception as e:
+            logging.warning(f'{filepath}: {e}')
+    return st
+
+
+def get_waveforms(client, waveforms, starttime, endtime, input_dir=None):
+    """
+    Gets the waveforms of the selected channels, merged and trimmed.
+
+    Parameters:
+    -----------
+    client : obspy client or None
+        FDSN or Earthworm client (see connect), if None the waveforms are
+        read from the files in input_dir.
+    waveforms : tonus.config.Conf
+        The 'detect.waveforms' section of the configuration (lists of
+        network, station, location and channel codes, wildcards are
+        allowed).
+    starttime, endtime : obspy.UTCDateTime
+        Time window.
+    input_dir : str
+        Directory of the waveform files.
+
+    Returns:
+    --------
+    st : obspy.Stream
+    """
+    if client is None:
+        st = read_files(
+            input_dir, starttime, endtime, station=waveforms.station,
+            channel=waveforms.channel
+        )
+    else:
+        st = client.get_waveforms(
+            ','.join(waveforms.network),
+            ','.join(waveforms.station),
+            ','.join(waveforms.location),
+            ','.join(waveforms.channel),
+            starttime,
+            endtime
+        )
+
+    st = Stream([
+        tr for tr in st
+        if any(fnmatch(tr.stats.station, s) for s in waveforms.station)
+        and any(fnmatch(tr.stats.channel, s) for s in waveforms.channel)
+    ])
+    st.merge(fill_value='interpolate', interpolation_samples=-1)
+    st.trim(starttime, endtime)
+    return st
+
+
 if __name__ == '__main__':
     pass